@@ -0,0 +1,63 @@
+"""Compares the overlap detection of ChatHistoryController.update with the previous quadratic search.
+
+Run from the project root with a configured .env:
+    python -m benchmarks.chat_history_overlap
+"""
+import copy
+import timeit
+from typing import List
+
+from core.chat_history import ChatHistoryMessage, ChatHistoryFile, find_overlap
+
+
+def naive_overlap(old_history: List[ChatHistoryMessage], new_history: List[ChatHistoryMessage], min_overlap: int = 1) -> int | None:
+    """Previous implementation: compares the message lists for every candidate length"""
+
+    for length in range(len(old_history), min_overlap, -1):
+        if old_history[-length:] == new_history[:length]:
+            return length
+    return None
+
+
+def build_histories(message_count: int, repetitive: bool = False):
+
+    if repetitive:
+        # Every candidate length matches until its last message
+        messages = [ChatHistoryMessage(role="user", content="ok") for _ in range(message_count)]
+        return messages[:-1] + [ChatHistoryMessage(role="user", content="ok?")], copy.deepcopy(messages[:-1])
+
+    messages = [
+        ChatHistoryMessage(
+            role="user" if i % 2 else "assistant",
+            content=f"<#Message from=\"<@{1000 + i % 7}>\" at=\"12:{i % 60:02}\">Message number {i}</Message>",
+            files=[ChatHistoryFile(f"image-{i}.png", "image/png")] if i % 5 == 0 else [],
+        )
+        for i in range(message_count + 1)
+    ]
+
+    # The new history is shifted by one message, like after a single new mention,
+    # and rendered again from Discord (equal but not identical objects)
+    return messages[:-1], copy.deepcopy(messages[1:])
+
+
+def main():
+
+    for repetitive in (False, True):
+
+        print("Repetitive messages (worst case)" if repetitive else "Distinct messages")
+
+        for message_count in (15, 100, 1000):
+
+            old_history, new_history = build_histories(message_count, repetitive)
+
+            assert naive_overlap(old_history, new_history) == find_overlap(old_history, new_history)
+
+            number = max(1, 200 // message_count)
+            naive = timeit.timeit(lambda: naive_overlap(old_history, new_history), number=number) / number
+            hashed = timeit.timeit(lambda: find_overlap(old_history, new_history), number=number) / number
+
+            print(f"{message_count:>5} messages: naive {naive * 1000:9.3f} ms, fingerprint {hashed * 1000:7.3f} ms, speedup {naive / hashed:7.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,148 @@
+import asyncio
+import hashlib
+import logging
+import mimetypes
+import os
+from pathlib import Path
+from typing import Dict, List
+
+import discord
+
+from core.chat_history import ChatHistoryFileSaved
+from core.chat_store import chat_store
+from core.config import Config
+from core.download_sweeper import download_sweeper
+from core.executors import thread_executor
+
+
+class AttachmentStore:
+    """Content addressed store for Discord attachments.
+
+    Files are saved once per content hash under DOWNLOAD_FOLDER/attachments and shared
+    across channels. Known attachment ids are answered without any network I/O."""
+
+    def __init__(self, folder: Path | None = None, max_concurrent_downloads: int = Config.ATTACHMENT_DOWNLOAD_CONCURRENCY):
+        self.folder = folder if folder else Config.DOWNLOAD_FOLDER / "attachments"
+        self._semaphore = asyncio.Semaphore(max_concurrent_downloads)
+        self._by_attachment_id: Dict[int, ChatHistoryFileSaved] = {}
+        self._by_hash: Dict[str, asyncio.Task[Path]] = {}
+        self._pending: Dict[int, asyncio.Future[ChatHistoryFileSaved]] = {}
+
+        self.hits = 0
+        self.misses = 0
+        self.bytes_downloaded = 0
+        self.bytes_saved = 0
+
+    async def get(self, attachment: discord.Attachment) -> ChatHistoryFileSaved:
+
+        if saved := self._by_attachment_id.get(attachment.id):
+            self.hits += 1
+            self.bytes_saved += attachment.size
+            logging.info("ATTACHMENT STORE HIT: %s", attachment.filename)
+            return saved
+
+        if pending := self._pending.get(attachment.id): # Same attachment requested concurrently
+            try:
+                return await asyncio.shield(pending)
+            except asyncio.CancelledError:
+                if not pending.cancelled(): # This request was cancelled
+                    raise
+                return await self.get(attachment) # The downloading request was cancelled, take over
+
+        future = asyncio.get_running_loop().create_future()
+        self._pending[attachment.id] = future
+
+        try:
+            saved = await chat_store.load_attachment(attachment.id) # Saved by a previous run
+
+            if saved:
+                self.hits += 1
+                self.bytes_saved += attachment.size
+            else:
+                saved = await self.download(attachment)
+                chat_store.save_attachment(attachment.id, saved)
+
+            self._by_attachment_id[attachment.id] = saved
+            future.set_result(saved)
+            return saved
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except BaseException as e:
+            future.set_exception(e)
+            future.exception() # Mark as retrieved if nobody else awaits it
+            raise
+        finally:
+            self._pending.pop(attachment.id, None)
+
+    async def download(self, attachment: discord.Attachment) -> ChatHistoryFileSaved:
+
+        self.misses += 1
+
+        async with self._semaphore:
+            file_bytes = await attachment.read()
+
+        self.bytes_downloaded += len(file_bytes)
+
+        if not file_bytes:
+            logging.exception("Empty attachment: %s", attachment)
+
+        digest = hashlib.sha256(file_bytes).hexdigest()
+
+        if write := self._by_hash.get(digest):
+            path = await write
+            self.bytes_saved += len(file_bytes)
+            logging.info("ATTACHMENT STORE: Deduplicated %s as %s", attachment.filename, path)
+        else:
+            ext = Path(attachment.filename).suffix or mimetypes.guess_extension(attachment.content_type or "") or ""
+            path = self.folder / f"{digest}{ext}"
+            write = self._by_hash[digest] = asyncio.create_task(thread_executor.run("attachment_write", self._write, path, file_bytes))
+            try:
+                await write
+            except BaseException: # Also when cancelled, the cancelled write must not be shared
+                self._by_hash.pop(digest, None)
+                raise
+            logging.info(f"Saved {path}")
+
+        return ChatHistoryFileSaved(attachment.filename, attachment.content_type, path, temporary=False)
+
+    def forget(self, paths: List[Path]) -> None:
+        """Deleted files are downloaded again when their attachment is needed"""
+
+        deleted = set(paths)
+
+        for attachment_id, saved in list(self._by_attachment_id.items()):
+            if saved.full_path in deleted:
+                del self._by_attachment_id[attachment_id]
+
+        for digest, write in list(self._by_hash.items()):
+            if write.done() and not write.exception() and write.result() in deleted:
+                del self._by_hash[digest]
+
+    @staticmethod
+    def _write(path: Path, file_bytes: bytes) -> Path:
+
+        if path.exists(): # Already saved by a previous run
+            return path
+
+        os.makedirs(path.parent, exist_ok=True)
+        tmp_path = path.with_name(f"{path.name}.tmp")
+        tmp_path.write_bytes(file_bytes)
+        tmp_path.replace(path)
+
+        return path
+
+    def stats(self) -> Dict[str, int | float]:
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0,
+            "bytes_downloaded": self.bytes_downloaded,
+            "bytes_saved": self.bytes_saved,
+        }
+
+
+attachment_store = AttachmentStore()
+download_sweeper.on_delete.append(attachment_store.forget)
+download_sweeper.on_delete.append(chat_store.forget_attachments)
@@ -0,0 +1,69 @@
+import asyncio
+import logging
+from dataclasses import dataclass
+from typing import Dict, Callable, Awaitable
+
+import discord
+
+
+@dataclass
+class ChannelQueueState:
+    pending: discord.Message | None = None
+    """Newest mention that is waiting for the running generation"""
+    pending_count: int = 0
+    task: asyncio.Task | None = None
+
+
+class ChannelScheduler:
+    """Serializes the handling of mentions per channel.
+
+    Mentions arriving while a generation is running are coalesced into one follow-up call
+    for the newest of them. Its history already contains all the waiting messages."""
+
+    def __init__(self):
+        self.channels: Dict[int, ChannelQueueState] = {}
+        self.submitted = 0
+        self.executed = 0
+
+    async def submit(self, message: discord.Message, handler: Callable[[discord.Message], Awaitable[None]]) -> None:
+
+        state = self.channels.setdefault(message.channel.id, ChannelQueueState())
+
+        self.submitted += 1
+        state.pending = message
+        state.pending_count += 1
+
+        if state.task and not state.task.done():
+            logging.info(f"SCHEDULER: Coalescing message {message.id} in channel {message.channel.id} ({state.pending_count} waiting)")
+            return
+
+        state.task = asyncio.create_task(self._run(message.channel.id, state, handler))
+        await state.task
+
+    async def _run(self, channel_id: int, state: ChannelQueueState, handler: Callable[[discord.Message], Awaitable[None]]) -> None:
+
+        try:
+            while state.pending:
+
+                message, count = state.pending, state.pending_count
+                state.pending, state.pending_count = None, 0
+
+                self.executed += 1
+                logging.info(f"SCHEDULER: Handling {count} message(s) in channel {channel_id}: {self.stats()}")
+
+                try:
+                    await handler(message)
+                except Exception as e:
+                    logging.exception(e)
+        finally:
+            if self.channels.get(channel_id) is state and not state.pending:
+                del self.channels[channel_id]
+
+    def stats(self) -> Dict[str, int | float]:
+        return {
+            "submitted": self.submitted,
+            "executed": self.executed,
+            "coalescing_ratio": self.submitted / self.executed if self.executed else 0,
+            "active_channels": sum(1 for state in self.channels.values() if state.task and not state.task.done()),
+            "queue_depth": sum(state.pending_count for state in self.channels.values()),
+        }
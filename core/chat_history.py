@@ -1,11 +1,16 @@
+import json
 import logging
-from dataclasses import dataclass, field
-from typing import Literal, Tuple, Dict, List, Type
+import time
+from dataclasses import dataclass, field, replace
+from functools import cache
+from typing import Literal, Tuple, Dict, List, Type, Any, Callable, TYPE_CHECKING
 from pathlib import Path
 
-import tiktoken
-
 from core.config import Config
+from core.executors import thread_executor
+
+if TYPE_CHECKING:
+    import tiktoken
 
 
 @dataclass(kw_only=True)
@@ -49,8 +54,7 @@ class ChatHistoryFileSaved(ChatHistoryFile):
 
     async def save(self, file_bytes) -> None:
 
-        with open(self.full_path, "wb") as f:
-            f.write(file_bytes)
+        await thread_executor.run("file_save", self.full_path.write_bytes, file_bytes)
 
         logging.info(f"Saved {self.full_path}")
 
@@ -69,6 +73,45 @@ class ChatHistoryFileText(ChatHistoryFile):
 
     text_content: str
 
+
+@cache
+def get_default_tokenizer() -> "tiktoken.Encoding":
+    """Loaded on first use instead of at import, the encoding file takes a while to load"""
+
+    import tiktoken
+
+    start = time.perf_counter()
+    tokenizer = tiktoken.get_encoding("cl100k_base")
+    logging.info(f"Loaded tokenizer in {time.perf_counter() - start:.3f}s")
+
+    return tokenizer
+
+
+@dataclass(frozen=True)
+class PromptSegment:
+    """Part of a prompt with its precomputed token count"""
+
+    text: str
+    token_count: int
+    volatile: bool = False
+    """Changes between requests, volatile segments are placed after the stable prefix"""
+
+    @classmethod
+    def compile(cls, text: str, tokenizer: "tiktoken.Encoding | None" = None, volatile: bool = False) -> "PromptSegment":
+        tokenizer = tokenizer if tokenizer else get_default_tokenizer()
+        return cls(text, len(tokenizer.encode(text)), volatile)
+
+
+@cache
+def count_role_prefix_tokens(tokenizer: "tiktoken.Encoding", role: str) -> int:
+    return len(tokenizer.encode(f"{role}: "))
+
+
+def encode_lengths(tokenizer: "tiktoken.Encoding", texts: List[str]) -> List[int]:
+    """Blocking, runs in the thread executor on plain strings"""
+    return [len(tokenizer.encode(text)) for text in texts]
+
+
 @dataclass(kw_only=True)
 class ChatHistoryMessage:
 
@@ -80,17 +123,165 @@ class ChatHistoryMessage:
 
     is_temporary: bool = False
 
+    _token_count: Tuple[int, int] | None = field(default=None, init=False, repr=False, compare=False)
+    """(content hash, token count) of the last count"""
+    _fingerprint: Tuple[Tuple, int] | None = field(default=None, init=False, repr=False, compare=False)
+    _formatted: Dict[type, Tuple[int, Any]] = field(default_factory=dict, init=False, repr=False, compare=False)
+    """Provider payload per provider class with the fingerprint it was formatted for"""
+    _segments: Tuple[PromptSegment, ...] = field(default=(), init=False, repr=False, compare=False)
+    """Precompiled parts of the content with their token counts, used while they still add up to the content"""
+
+    def count_tokens(self, tokenizer: "tiktoken.Encoding") -> int:
+        """Token count of the prompt line of this message, memoized until role or content change"""
+
+        key = self.token_count_key(tokenizer)
+
+        if self._token_count is None or self._token_count[0] != key:
+            self._token_count = (key, len(tokenizer.encode(self.prompt_line())))
+
+        return self._token_count[1]
+
+    def token_count_key(self, tokenizer: "tiktoken.Encoding") -> int:
+        return hash((id(tokenizer), self.role, self.content))
+
+    def prompt_line(self) -> str:
+        return f"{self.role}: {self.content}"
+
+    def is_counted(self, tokenizer: "tiktoken.Encoding") -> bool:
+        return self._token_count is not None and self._token_count[0] == self.token_count_key(tokenizer)
+
+    @classmethod
+    def from_segments(cls, role: Literal["system", "user", "assistant", "tool"], segments: List[PromptSegment], tokenizer: "tiktoken.Encoding | None" = None) -> "ChatHistoryMessage":
+        """Joins the segments, stable ones first. The token count is summed up from the segments instead of tokenizing the content again"""
+
+        tokenizer = tokenizer if tokenizer else get_default_tokenizer()
+        segments = [segment for segment in segments if not segment.volatile] + [segment for segment in segments if segment.volatile]
+
+        message = cls(role=role, content="".join(segment.text for segment in segments))
+        message._segments = tuple(segments)
+        message._token_count = (
+            message.token_count_key(tokenizer),
+            count_role_prefix_tokens(tokenizer, role) + sum(segment.token_count for segment in segments),
+        )
+
+        return message
+
+    def as_segments(self, tokenizer: "tiktoken.Encoding") -> List[PromptSegment]:
+        """Segments this message was built from, or its content as one segment with the memoized token count"""
+
+        if self._segments and "".join(segment.text for segment in self._segments) == self.content:
+            return list(self._segments)
+
+        return [PromptSegment(self.content or "", self.count_tokens(tokenizer) - count_role_prefix_tokens(tokenizer, self.role))]
+
+    def stable_prefix(self) -> str:
+        """Content of the non volatile segments, the part of the prompt that providers can cache"""
+
+        if self._segments:
+            return "".join(segment.text for segment in self._segments if not segment.volatile)
+
+        return self.content or ""
+
+    def fingerprint(self) -> int:
+        """Hash over all compared fields, equal messages always have equal fingerprints.
+
+        Memoized until role, content or the number of files and tool calls change."""
+
+        key = (self.role, self.content, len(self.files), len(self.tool_calls), bool(self.tool_response), self.is_temporary)
+
+        if self._fingerprint is None or self._fingerprint[0] != key:
+            self._fingerprint = (key, hash((
+                key,
+                tuple((type(file), file.name, file.mime_type, getattr(file, "full_path", None), getattr(file, "text_content", None)) for file in self.files),
+                tuple((tool_call.id, tool_call.name, json.dumps(tool_call.arguments, sort_keys=True, default=str)) for tool_call in self.tool_calls),
+                (self.tool_response[0].id, self.tool_response[1]) if self.tool_response else None,
+            )))
+
+        return self._fingerprint[1]
+
+
+    def formatted(self, provider: type, formatter: Callable[["ChatHistoryMessage"], Any]) -> Any:
+        """Provider payload of this message, memoized per provider class until the message changes.
+
+        Messages with saved files are formatted every time, their image parts come from the encoded
+        file cache, which bounds the memory of the encoded images."""
+
+        if any(isinstance(file, ChatHistoryFileSaved) for file in self.files):
+            return formatter(self)
+
+        key = self.fingerprint()
+        cached = self._formatted.get(provider)
+
+        if cached is None or cached[0] != key:
+            cached = self._formatted[provider] = (key, formatter(self))
+
+        return cached[1]
+
+
+def find_overlap(old_history: List[ChatHistoryMessage], new_history: List[ChatHistoryMessage], min_overlap: int = 1) -> int | None:
+    """Length of the longest suffix of old_history that is a prefix of new_history, if longer than min_overlap.
+
+    Runs Knuth-Morris-Pratt over the message fingerprints in linear time, the found overlap is
+    verified once with a full comparison in case of hash collisions."""
+
+    pattern = [msg.fingerprint() for msg in new_history[:len(old_history)]]
+
+    if not pattern:
+        return None
+
+    failure = [0] * len(pattern)
+    k = 0
+    for i in range(1, len(pattern)):
+        while k and pattern[i] != pattern[k]:
+            k = failure[k - 1]
+        if pattern[i] == pattern[k]:
+            k += 1
+        failure[i] = k
+
+    matched = 0
+    for msg in old_history:
+        fingerprint = msg.fingerprint()
+        while matched and (matched == len(pattern) or fingerprint != pattern[matched]):
+            matched = failure[matched - 1]
+        if fingerprint == pattern[matched]:
+            matched += 1
+
+    while matched > min_overlap:
+        if old_history[-matched:] == new_history[:matched]:
+            return matched
+        matched = failure[matched - 1]
+
+    return None
+
 
 class ChatHistoryController:
 
     history: List[ChatHistoryMessage]
 
-    def __init__(self, history: List[ChatHistoryMessage] | None = None, max_tokens: int = Config.MAX_TOKENS, tokenizer: tiktoken = tiktoken.get_encoding("cl100k_base")):
+    def __init__(self, history: List[ChatHistoryMessage] | None = None, max_tokens: int = Config.MAX_TOKENS, tokenizer: "tiktoken.Encoding | None" = None):
         self.history = history if history else []
         self.max_tokens = max_tokens
-        self.tokenizer = tokenizer
+        self._tokenizer = tokenizer
+
+        # Running token total of self.history, see running_token_count
+        self._token_total = 0
+        self._counted_length = 0
+        self._counted_first: ChatHistoryMessage | None = None
+        self._counted_last: ChatHistoryMessage | None = None
+        self._counted_first_tokens = 0
+
+        self._trimmed_at: ChatHistoryMessage | None = None
+        """First message kept by the last trim, the messages before it in a new history were dropped"""
 
 
+    @property
+    def tokenizer(self) -> "tiktoken.Encoding":
+        return self._tokenizer if self._tokenizer else get_default_tokenizer()
+
+    @tokenizer.setter
+    def tokenizer(self, value: "tiktoken.Encoding"):
+        self._tokenizer = value
+
     @property
     def system_entry(self) -> ChatHistoryMessage | None:
         if self.history and self.history[0].role == "system":
@@ -104,19 +295,20 @@ class ChatHistoryController:
         else:
             self.history[0] = value
 
-    def update(self, new_history: List[ChatHistoryMessage], instructions_entry: ChatHistoryMessage | None = None, min_overlap=1, max_tokens:int|None = None, tokenizer: Type[tiktoken]|None = None):
+    def update(self, new_history: List[ChatHistoryMessage], instructions_entry: ChatHistoryMessage | None = None, min_overlap=1, max_tokens:int|None = None, tokenizer: "Type[tiktoken] | None" = None):
 
         old_history = self.history
         old_history_without_temporary_messages = [x for x in old_history if not x.is_temporary]
 
-        max_overlap_length = len(old_history_without_temporary_messages)
-        overlap_length = None
+        offset = self.dropped_prefix_length(new_history)
+        overlap_length = find_overlap(old_history_without_temporary_messages, new_history[offset:], min_overlap)
 
-        for length in range(max_overlap_length, min_overlap, -1):
-            if old_history_without_temporary_messages[-length:] == new_history[:length]:
-                overlap_length = length
-                logging.info(f"OVERLAP LENGTH: {overlap_length}")
-                break
+        if not overlap_length and offset:
+            offset = 0
+            overlap_length = find_overlap(old_history_without_temporary_messages, new_history, min_overlap)
+
+        if overlap_length:
+            logging.info(f"OVERLAP LENGTH: {overlap_length}, AFTER {offset} TRIMMED MESSAGES")
 
         if not overlap_length:
             logging.info("NO OVERLAP")
@@ -124,6 +316,7 @@ class ChatHistoryController:
             logging.info(new_history)
             self.history = [instructions_entry] if instructions_entry else []
             self.history.extend(new_history)
+            self._trimmed_at = None
         else:
 
             if instructions_entry and self.system_entry != instructions_entry:
@@ -132,31 +325,106 @@ class ChatHistoryController:
                 logging.info(instructions_entry)
                 self.system_entry = instructions_entry
 
-            self.history = self.history + new_history[overlap_length:]
+            self.history = self.history + new_history[offset + overlap_length:]
 
         logging.info(f"TOKEN COUNT: {self.count_tokens(tokenizer=tokenizer)}")
         logging.info(f"SYSTEM MESSAGE TOKEN COUNT: {self.count_tokens(history=[self.system_entry], tokenizer=tokenizer)}")
 
-        if self.count_tokens(tokenizer=tokenizer) > (max_tokens if max_tokens else self.max_tokens):
-            logging.info("CUTTING BECAUSE OF EXCEEDING TOKEN COUNT")
-            self.history = [instructions_entry] if instructions_entry else []
-            self.history.extend(new_history)
-            logging.info(self.history)
+        self.trim_to_budget(max_tokens)
+
+        self.delete_unused_temporary_files(old_history)
+
+
+    def dropped_prefix_length(self, new_history: List[ChatHistoryMessage]) -> int:
+        """Number of messages at the start of new_history that the last trim dropped, they are not added again"""
+
+        if self._trimmed_at is None:
+            return 0
+
+        fingerprint = self._trimmed_at.fingerprint()
+
+        return next((i for i, msg in enumerate(new_history) if msg.fingerprint() == fingerprint and msg == self._trimmed_at), 0)
 
 
+    def trim_to_budget(self, max_tokens: int | None = None, reserved_tokens: int | None = None) -> None:
+        """Drops the oldest messages until the history fits into max_tokens minus the reserved output tokens.
+
+        The system entry and the latest user turn (the last user message and everything after it) are kept.
+        If they alone exceed the budget, their longest contents are shortened."""
+
+        max_tokens = max_tokens if max_tokens else self.max_tokens
+        reserved_tokens = reserved_tokens if reserved_tokens is not None else Config.RESPONSE_TOKEN_RESERVE
+        budget = max_tokens - reserved_tokens
+
+        total = self.count_tokens()
+
+        if total <= budget:
+            return
+
+        logging.info(f"CUTTING BECAUSE OF EXCEEDING TOKEN COUNT: {total} > {budget}")
+
+        old_history = self.history
+        start = 1 if self.system_entry else 0
+        protected_from = max(start, max((i for i, msg in enumerate(old_history) if msg.role == "user"), default=start))
+
+        cut = start
+        while cut < protected_from and (total > budget or old_history[cut].role == "tool"): # No tool results without their call
+            total -= old_history[cut].count_tokens(self.tokenizer) + 1
+            cut += 1
+
+        history = old_history[:start] + old_history[cut:]
+
+        if cut > start:
+            self._trimmed_at = next((msg for msg in old_history[cut:] if not msg.is_temporary), None)
+
+        if total > budget:
+            history = self.shrink_messages(history, total - budget, start)
+
+        self.history = history
+
+        logging.info(f"DROPPED {cut - start} MESSAGES, TOKEN COUNT: {self.count_tokens()}")
+
         self.delete_unused_temporary_files(old_history)
 
 
+    def shrink_messages(self, history: List[ChatHistoryMessage], excess: int, start: int) -> List[ChatHistoryMessage]:
+        """Shortens the longest contents after index start by excess tokens, the messages are copied and not changed"""
+
+        history = list(history)
+        marker = " [...]"
+        marker_tokens = len(self.tokenizer.encode(marker))
+
+        for i in sorted(range(start, len(history)), key=lambda i: history[i].count_tokens(self.tokenizer), reverse=True):
+
+            if excess <= 0:
+                break
+
+            msg = history[i]
+            if not msg.content:
+                continue
+
+            tokens = self.tokenizer.encode(msg.content)
+            keep = max(len(tokens) - excess - marker_tokens, 0)
+
+            shortened = replace(msg, content=self.tokenizer.decode(tokens[:keep]) + marker)
+            excess -= msg.count_tokens(self.tokenizer) - shortened.count_tokens(self.tokenizer)
+            history[i] = shortened
+
+            logging.info(f"SHORTENED MESSAGE {i} TO {keep} TOKENS")
+
+        return history
+
+
     def delete_unused_temporary_files(self, old_history: List[ChatHistoryMessage], new_history: list[ChatHistoryMessage]|None = None):
 
         new_history = new_history if new_history else self.history
 
-        old_files = [file for entry in old_history for file in entry.files if isinstance(file, ChatHistoryFileSaved) and file.temporary]
-        new_files = [file for entry in new_history for file in entry.files if isinstance(file, ChatHistoryFileSaved) and file.temporary]
+        new_paths = {file.full_path for entry in new_history for file in entry.files if isinstance(file, ChatHistoryFileSaved) and file.temporary}
 
-        for old_file in old_files:
-            if old_file not in new_files:
-                old_file.delete()
+        for entry in old_history:
+            for old_file in entry.files:
+                if isinstance(old_file, ChatHistoryFileSaved) and old_file.temporary and old_file.full_path not in new_paths:
+                    old_file.delete()
 
 
 
@@ -171,7 +439,64 @@ class ChatHistoryController:
             prompt_lines.append(f"{msg.role}: {msg.content}")
         return "\n".join(prompt_lines)
 
-    def count_tokens(self, history: List[ChatHistoryMessage]|None=None, tokenizer: Type[tiktoken]|None = None) -> int:
-        prompt = self.build_prompt(history)
+    def count_tokens(self, history: List[ChatHistoryMessage]|None=None, tokenizer: "Type[tiktoken] | None" = None) -> int:
+        """Token count of build_prompt, summed up from the memoized per message counts"""
+
         tokenizer = tokenizer if tokenizer else self.tokenizer
-        return len(tokenizer.encode(prompt))
\ No newline at end of file
+
+        if history is None and tokenizer is self.tokenizer:
+            return self.running_token_count()
+
+        history = self.history if history is None else history
+
+        return self.sum_tokens(history, tokenizer)
+
+    @staticmethod
+    async def prepare_token_counts(history: List[ChatHistoryMessage], tokenizer: "tiktoken.Encoding") -> None:
+        """Tokenizes the messages without a memoized count in the thread executor.
+
+        Only the strings go to the worker, the counts are stored on the event loop, where the
+        message cache reads the same messages."""
+
+        pending = [(msg, msg.token_count_key(tokenizer), msg.prompt_line()) for msg in history if not msg.is_counted(tokenizer)]
+
+        if not pending:
+            return
+
+        lengths = await thread_executor.run("count_tokens", encode_lengths, tokenizer, [line for _, _, line in pending])
+
+        for (msg, key, _), length in zip(pending, lengths):
+            msg._token_count = (key, length) # Counted again on use if the content changed meanwhile
+
+    @staticmethod
+    def sum_tokens(history: List[ChatHistoryMessage], tokenizer: "tiktoken.Encoding") -> int:
+        return sum(msg.count_tokens(tokenizer) for msg in history) + max(len(history) - 1, 0) # One token per line break
+
+    def running_token_count(self) -> int:
+        """Keeps the total of self.history up to date.
+
+        Appended messages are added to the total and a swapped or changed system entry only
+        corrects its own count. Any other change (e.g. trimming) sums up the memoized counts again."""
+
+        history = self.history
+        counted = self._counted_length
+
+        appended_only = (
+            0 < counted <= len(history)
+            and history[counted - 1] is self._counted_last
+            and (history[0] is self._counted_first or counted > 1 and history[0].role == self._counted_first.role == "system")
+        )
+
+        if appended_only:
+            first_tokens = history[0].count_tokens(self.tokenizer)
+            self._token_total += first_tokens - self._counted_first_tokens
+            self._token_total += sum(msg.count_tokens(self.tokenizer) + 1 for msg in history[counted:])
+        else:
+            self._token_total = self.sum_tokens(history, self.tokenizer)
+
+        self._counted_length = len(history)
+        self._counted_first = history[0] if history else None
+        self._counted_last = history[-1] if history else None
+        self._counted_first_tokens = history[0].count_tokens(self.tokenizer) if history else 0
+
+        return self._token_total
\ No newline at end of file
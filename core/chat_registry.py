@@ -0,0 +1,126 @@
+import logging
+import time
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from typing import Dict, Callable, Awaitable
+
+from core.chat_history import ChatHistoryController
+from core.chat_store import chat_store
+from core.config import Config
+from core.download_sweeper import download_sweeper
+
+
+class ChatRegistry:
+    """Bounded LRU of the chat controllers per channel.
+
+    Channels idle for longer than CHAT_MAX_IDLE or beyond the entry and token budgets are evicted,
+    least recently used first. Leased controllers are never evicted. With the chat store enabled,
+    every controller is saved when its lease ends, so evicted channels are restored on demand."""
+
+    def __init__(self, max_entries: int = Config.CHAT_MAX_ENTRIES, max_tokens: int | None = Config.CHAT_MAX_TOKENS, max_idle: float | None = Config.CHAT_MAX_IDLE):
+        self.max_entries = max_entries
+        self.max_tokens = max_tokens
+        self.max_idle = max_idle
+        self.entries: OrderedDict[str, ChatHistoryController] = OrderedDict()
+        self._last_used: Dict[str, float] = {}
+        self._leases: Dict[str, int] = {}
+
+        self.hits = 0
+        self.misses = 0
+        self.restores = 0
+        self.evictions = 0
+        """Over the entry or token budget, idle evictions are counted separately"""
+        self.idle_evictions = 0
+
+    def __contains__(self, channel: str) -> bool:
+        return channel in self.entries
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def __getitem__(self, channel: str) -> ChatHistoryController:
+        return self.entries[channel]
+
+    @asynccontextmanager
+    async def lease(self, channel: str, factory: Callable[[], Awaitable[ChatHistoryController]]):
+        """Controller of the channel, restored from the chat store or created by factory if not in memory"""
+
+        chat = self.entries.get(channel)
+
+        if chat is not None:
+            self.hits += 1
+        else:
+            self.misses += 1
+            chat = await chat_store.load(channel)
+
+            if chat is not None:
+                self.restores += 1
+            else:
+                chat = await factory()
+
+            chat = self.entries.setdefault(channel, chat) # Another lease may have loaded it meanwhile
+            logging.info(f"CHAT REGISTRY: Loaded {channel}: {self.stats()}")
+
+        self.entries.move_to_end(channel)
+        self._leases[channel] = self._leases.get(channel, 0) + 1
+
+        try:
+            yield chat
+        finally:
+            self._leases[channel] -= 1
+            if not self._leases[channel]:
+                del self._leases[channel]
+
+            self._last_used[channel] = time.monotonic()
+            chat_store.save(channel, chat)
+            download_sweeper.track(channel, chat.history)
+            self.evict()
+
+    def total_tokens(self) -> int:
+        return sum(chat.count_tokens() for chat in self.entries.values())
+
+    def evict(self) -> None:
+
+        now = time.monotonic()
+
+        if self.max_idle is not None:
+            for channel in list(self.entries):
+                if channel not in self._leases and now - self._last_used.get(channel, now) > self.max_idle:
+                    self.remove(channel)
+                    self.idle_evictions += 1
+
+        total_tokens = self.total_tokens() if self.max_tokens is not None else 0
+
+        for channel in list(self.entries): # Least recently used first
+            if len(self.entries) <= self.max_entries and (self.max_tokens is None or total_tokens <= self.max_tokens):
+                break
+            if channel in self._leases:
+                continue
+            if self.max_tokens is not None:
+                total_tokens -= self.entries[channel].count_tokens()
+            self.remove(channel)
+            self.evictions += 1
+
+    def remove(self, channel: str) -> None:
+
+        self.entries.pop(channel, None)
+        self._last_used.pop(channel, None)
+
+        if not chat_store.enabled: # Otherwise the files stay referenced by the stored history
+            download_sweeper.untrack(channel)
+
+        logging.info(f"CHAT REGISTRY: Evicted {channel}{' (spilled to the chat store)' if chat_store.enabled else ''}: {self.stats()}")
+
+    def stats(self) -> Dict[str, int | float]:
+        total = self.hits + self.misses
+        return {
+            "entries": len(self.entries),
+            "leased": len(self._leases),
+            "tokens": self.total_tokens(),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / total, 3) if total else 0,
+            "restores": self.restores,
+            "evictions": self.evictions,
+            "idle_evictions": self.idle_evictions,
+        }
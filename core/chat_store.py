@@ -0,0 +1,345 @@
+import asyncio
+import json
+import logging
+import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import asdict
+from pathlib import Path
+from typing import Dict, Any, List, Tuple, Callable, TypeVar, Set
+
+from core.chat_history import ChatHistoryController, ChatHistoryMessage, ChatHistoryFile, ChatHistoryFileSaved, ChatHistoryFileText, LLMToolCall, PromptSegment
+from core.config import Config
+from core.executors import InstrumentedExecutor, executors
+
+T = TypeVar("T")
+
+COMPACT_EVERY = 100
+"""Flushes between two compactions of the database file"""
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS chats (
+    channel TEXT PRIMARY KEY,
+    saved_at REAL NOT NULL,
+    state TEXT NOT NULL,
+    files TEXT NOT NULL DEFAULT '[]'
+);
+CREATE TABLE IF NOT EXISTS attachments (
+    attachment_id INTEGER PRIMARY KEY,
+    name TEXT NOT NULL,
+    mime_type TEXT,
+    path TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS attachments_path ON attachments (path);
+"""
+
+
+def serialize_file(file: ChatHistoryFile) -> Dict[str, Any]:
+
+    if isinstance(file, ChatHistoryFileSaved):
+        return {"type": "saved", "name": file.name, "mime_type": file.mime_type, "path": str(file.full_path), "temporary": file.temporary}
+    if isinstance(file, ChatHistoryFileText):
+        return {"type": "text", "name": file.name, "mime_type": file.mime_type, "text_content": file.text_content}
+
+    return {"type": "file", "name": file.name, "mime_type": file.mime_type}
+
+
+def deserialize_file(data: Dict[str, Any]) -> ChatHistoryFile:
+
+    match data["type"]:
+        case "saved":
+            path = Path(data["path"])
+            if path.exists():
+                return ChatHistoryFileSaved(data["name"], data["mime_type"], path, temporary=data["temporary"])
+            return ChatHistoryFile(data["name"], data["mime_type"]) # Deleted in the meantime, only the name is left
+        case "text":
+            return ChatHistoryFileText(data["name"], data["mime_type"], data["text_content"])
+        case _:
+            return ChatHistoryFile(data["name"], data["mime_type"])
+
+
+def serialize_message(message: ChatHistoryMessage) -> Dict[str, Any]:
+    return {
+        "role": message.role,
+        "content": message.content,
+        "files": [serialize_file(file) for file in message.files],
+        "tool_calls": [asdict(tool_call) for tool_call in message.tool_calls],
+        "tool_response": [asdict(message.tool_response[0]), message.tool_response[1]] if message.tool_response else None,
+        "is_temporary": message.is_temporary,
+        "segments": [[segment.text, segment.token_count, segment.volatile] for segment in message._segments],
+    }
+
+
+def saved_file_paths(history: List[Dict[str, Any]]) -> List[str]:
+    """Paths of the saved files in a serialized history"""
+    return [file["path"] for message in history for file in message["files"] if file["type"] == "saved"]
+
+
+def deserialize_message(data: Dict[str, Any]) -> ChatHistoryMessage:
+
+    message = ChatHistoryMessage(
+        role=data["role"],
+        content=data["content"],
+        files=[deserialize_file(file) for file in data["files"]],
+        tool_calls=[LLMToolCall(**tool_call) for tool_call in data["tool_calls"]],
+        tool_response=(LLMToolCall(**data["tool_response"][0]), data["tool_response"][1]) if data["tool_response"] else [],
+        is_temporary=data["is_temporary"],
+    )
+    message._segments = tuple(PromptSegment(text, token_count, volatile) for text, token_count, volatile in data.get("segments", []))
+
+    return message
+
+
+class ChatStore:
+    """SQLite store for the chat controllers and the saved attachments, one row per channel.
+
+    Saves are collected in memory (the newest state per channel wins) and written in one
+    transaction per FLUSH_INTERVAL on a dedicated writer thread, replacing the channel's row.
+    The store is opened at startup, channels are loaded lazily on their first message. Freed
+    pages are returned to the file system every COMPACT_EVERY flushes."""
+
+    def __init__(self, path: Path | None = Config.CHAT_STORE_PATH, flush_interval: float = Config.CHAT_STORE_FLUSH_INTERVAL):
+        self.path = path
+        self.flush_interval = flush_interval
+        self._executor = InstrumentedExecutor("chat_store", lambda: ThreadPoolExecutor(max_workers=1, thread_name_prefix="chat-store")) # sqlite connections are bound to their thread
+        executors.append(self._executor)
+        self._connection: sqlite3.Connection | None = None
+        self._pending_chats: Dict[str, List[Dict[str, Any]]] = {}
+        self._pending_attachments: Dict[int, ChatHistoryFileSaved] = {}
+        self._forgotten_paths: Set[str] = set()
+        self._flush_task: asyncio.Task | None = None
+
+        self.loads = 0
+        self.restored = 0
+        self.saves = 0
+        self.flushes = 0
+        self.rows_written = 0
+        self.avg_flush_time = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.path is not None
+
+    async def run(self, function: Callable[..., T], *args) -> T:
+        return await self._executor.run(function.__name__.lstrip("_"), function, *args)
+
+    def _connect(self) -> sqlite3.Connection:
+
+        if self._connection is None:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            connection = sqlite3.connect(self.path)
+            connection.execute("PRAGMA auto_vacuum=INCREMENTAL") # Only takes effect for a new file
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            connection.executescript(SCHEMA)
+            self._connection = connection
+            logging.info(f"CHAT STORE: Opened {self.path}")
+
+        return self._connection
+
+    def _open(self) -> None:
+        self._connect()
+
+    async def open(self) -> None:
+        """Opens the database at startup, so the first message of a channel only reads its row"""
+
+        if not self.enabled:
+            return
+
+        try:
+            await self.run(self._open)
+        except Exception as e:
+            logging.exception(f"CHAT STORE: Opening {self.path} failed: {e}")
+
+    def _compact(self) -> None:
+        self._connect().execute("PRAGMA incremental_vacuum")
+        self._connect().execute("PRAGMA wal_checkpoint(TRUNCATE)")
+
+    def _load(self, channel: str) -> List[ChatHistoryMessage] | None:
+        """Parses in the writer thread as well, the files are checked on disk"""
+
+        row = self._connect().execute("SELECT state FROM chats WHERE channel = ?", (channel,)).fetchone()
+        return [deserialize_message(message) for message in json.loads(row[0])] if row else None
+
+    async def load(self, channel: str) -> ChatHistoryController | None:
+
+        if not self.enabled:
+            return None
+
+        self.loads += 1
+
+        if channel in self._pending_chats: # Saved but not yet written
+            history = [deserialize_message(message) for message in self._pending_chats[channel]]
+        else:
+            try:
+                history = await self.run(self._load, channel)
+            except Exception as e:
+                logging.exception(f"CHAT STORE: Loading {channel} failed: {e}")
+                return None
+
+            if history is None:
+                return None
+
+        self.restored += 1
+        controller = ChatHistoryController(history)
+        logging.info(f"CHAT STORE: Restored {len(controller.history)} messages of {channel}: {self.stats()}")
+
+        return controller
+
+    def save(self, channel: str, chat: ChatHistoryController) -> None:
+        """Snapshots the history now, it is written with the next batch"""
+
+        if not self.enabled:
+            return
+
+        self._pending_chats[channel] = [serialize_message(message) for message in chat.history]
+        self.saves += 1
+        self.schedule_flush()
+
+    def _load_attachment(self, attachment_id: int) -> Tuple[str, str | None, str] | None:
+        row = self._connect().execute("SELECT name, mime_type, path FROM attachments WHERE attachment_id = ?", (attachment_id,)).fetchone()
+        return row if row and Path(row[2]).exists() else None
+
+    async def load_attachment(self, attachment_id: int) -> ChatHistoryFileSaved | None:
+        """Attachment saved by a previous run, if its file still exists"""
+
+        if not self.enabled:
+            return None
+
+        if saved := self._pending_attachments.get(attachment_id):
+            return saved
+
+        try:
+            row = await self.run(self._load_attachment, attachment_id)
+        except Exception as e:
+            logging.exception(f"CHAT STORE: Loading attachment {attachment_id} failed: {e}")
+            return None
+
+        if row is None:
+            return None
+
+        return ChatHistoryFileSaved(row[0], row[1], Path(row[2]), temporary=False)
+
+    def save_attachment(self, attachment_id: int, saved: ChatHistoryFileSaved) -> None:
+
+        if not self.enabled:
+            return
+
+        self._pending_attachments[attachment_id] = saved
+        self.schedule_flush()
+
+    def forget_attachments(self, paths: List[Path]) -> None:
+        """Drops the attachments of deleted files with the next batch"""
+
+        if not self.enabled or not paths:
+            return
+
+        deleted = {str(path) for path in paths}
+        self._forgotten_paths |= deleted
+        self._pending_attachments = {attachment_id: saved for attachment_id, saved in self._pending_attachments.items() if str(saved.full_path) not in deleted}
+        self.schedule_flush()
+
+    def _referenced_files(self) -> Dict[str, List[str]]:
+        return {channel: json.loads(files) for channel, files in self._connect().execute("SELECT channel, files FROM chats")}
+
+    async def referenced_files(self) -> Dict[str, List[str]]:
+        """Saved file paths per channel of all stored histories, including the ones not yet written"""
+
+        if not self.enabled:
+            return {}
+
+        files = await self.run(self._referenced_files)
+
+        for channel, history in self._pending_chats.items():
+            files[channel] = saved_file_paths(history)
+
+        return files
+
+    def schedule_flush(self) -> None:
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.create_task(self.flush_later())
+
+    async def flush_later(self) -> None:
+        await asyncio.sleep(self.flush_interval)
+        await self.flush()
+
+    def _write(self, chats: Dict[str, List[Dict[str, Any]]], attachments: Dict[int, ChatHistoryFileSaved], forgotten_paths: Set[str]) -> None:
+
+        connection = self._connect()
+        now = time.time()
+
+        with connection:
+            connection.executemany(
+                "INSERT OR REPLACE INTO chats (channel, saved_at, state, files) VALUES (?, ?, ?, ?)",
+                [
+                    (channel, now, json.dumps(history, ensure_ascii=False, default=str), json.dumps(saved_file_paths(history)))
+                    for channel, history in chats.items()
+                ],
+            )
+            connection.executemany(
+                "INSERT OR REPLACE INTO attachments (attachment_id, name, mime_type, path) VALUES (?, ?, ?, ?)",
+                [(attachment_id, saved.name, saved.mime_type, str(saved.full_path)) for attachment_id, saved in attachments.items()],
+            )
+            connection.executemany("DELETE FROM attachments WHERE path = ?", [(path,) for path in forgotten_paths])
+
+    async def flush(self) -> None:
+
+        if not self._pending_chats and not self._pending_attachments and not self._forgotten_paths:
+            return
+
+        chats, self._pending_chats = self._pending_chats, {}
+        attachments, self._pending_attachments = self._pending_attachments, {}
+        forgotten_paths, self._forgotten_paths = self._forgotten_paths, set()
+
+        start = time.perf_counter()
+
+        try:
+            await self.run(self._write, chats, attachments, forgotten_paths)
+        except Exception as e:
+            logging.exception(f"CHAT STORE: Writing {len(chats)} chats failed: {e}")
+            self._pending_chats = {**chats, **self._pending_chats} # Retried with the next batch, newer saves win
+            self._pending_attachments = {**attachments, **self._pending_attachments}
+            self._forgotten_paths |= forgotten_paths
+            return
+
+        flush_time = time.perf_counter() - start
+        self.flushes += 1
+        self.rows_written += len(chats) + len(attachments)
+        self.avg_flush_time = 0.9 * self.avg_flush_time + 0.1 * flush_time if self.avg_flush_time else flush_time
+        logging.debug(f"CHAT STORE: Wrote {len(chats)} chats and {len(attachments)} attachments in {flush_time:.3f}s")
+
+        if self.flushes % COMPACT_EVERY == 0:
+            try:
+                await self.run(self._compact)
+            except Exception as e:
+                logging.exception(f"CHAT STORE: Compaction failed: {e}")
+
+    async def close(self) -> None:
+
+        if not self.enabled:
+            return
+
+        if self._flush_task and not self._flush_task.done():
+            self._flush_task.cancel()
+
+        await self.flush()
+
+        if self._connection is not None:
+            await self.run(self._connection.close)
+            self._connection = None
+
+        self._executor.shutdown()
+
+    def stats(self) -> Dict[str, int | float]:
+        return {
+            "loads": self.loads,
+            "restored": self.restored,
+            "saves": self.saves,
+            "pending": len(self._pending_chats) + len(self._pending_attachments),
+            "flushes": self.flushes,
+            "rows_written": self.rows_written,
+            "avg_flush_time": round(self.avg_flush_time, 4),
+        }
+
+
+chat_store = ChatStore()
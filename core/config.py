@@ -60,6 +60,16 @@ class Config:
         return timeparse(value)
 
 
+    @staticmethod
+    def extract_response_token_reserve(value: str, max_tokens: int) -> int:
+
+        reserve = int(value)
+
+        if not 0 <= reserve < max_tokens:
+            raise ValueError(f"RESPONSE_TOKEN_RESERVE must be at least 0 and below MAX_TOKENS ({max_tokens}): {reserve}")
+
+        return reserve
+
     @staticmethod
     def require_env(name: str) -> str:
         value = os.getenv(name)
@@ -67,6 +77,14 @@ class Config:
             raise RuntimeError(f"Environment variable '{name}' is required but not set.")
         return value
 
+    @staticmethod
+    def require_envs(names: List[str]) -> None:
+        """Validates settings that are only required by some backends"""
+
+        missing = [name for name in names if not os.getenv(name)]
+        if missing:
+            raise RuntimeError(f"Environment variables {', '.join(repr(name) for name in missing)} are required but not set.")
+
 
 
 
@@ -75,54 +93,91 @@ class Config:
     DISCORD_TOKEN: str|None = os.getenv("DISCORD_TOKEN")
 
     DOWNLOAD_FOLDER: Path = Path(require_env("DOWNLOAD_FOLDER"))
+    DOWNLOAD_QUOTA_BYTES: int = int(float(os.getenv("DOWNLOAD_QUOTA_MB", "2048")) * 1024 * 1024)
+    DOWNLOAD_CHANNEL_QUOTA_BYTES: int = int(float(os.getenv("DOWNLOAD_CHANNEL_QUOTA_MB", "256")) * 1024 * 1024)
+    DOWNLOAD_MAX_AGE: float | int = extract_duration(os.getenv("DOWNLOAD_MAX_AGE", "24h"))
+    DOWNLOAD_MIN_AGE: float | int = extract_duration(os.getenv("DOWNLOAD_MIN_AGE", "10m"))
+    DOWNLOAD_SWEEP_INTERVAL: float | int = extract_duration(os.getenv("DOWNLOAD_SWEEP_INTERVAL", "5m"))
+    ATTACHMENT_DOWNLOAD_CONCURRENCY: int = int(os.getenv("ATTACHMENT_DOWNLOAD_CONCURRENCY", "4"))
+    VISION_CACHE_MAX_BYTES: int = int(float(os.getenv("VISION_CACHE_SIZE_MB", "256")) * 1024 * 1024)
+    IO_WORKERS: int = int(os.getenv("IO_WORKERS", "8"))
+    CPU_WORKERS: int = int(os.getenv("CPU_WORKERS", "2"))
+    CHAT_STORE_PATH: Path | None = Path(value) if (value := os.getenv("CHAT_STORE_PATH")) else None
+    CHAT_STORE_FLUSH_INTERVAL: float | int = extract_duration(os.getenv("CHAT_STORE_FLUSH_INTERVAL", "2s"))
+    CHAT_MAX_ENTRIES: int = int(os.getenv("CHAT_MAX_ENTRIES", "256"))
+    CHAT_MAX_TOKENS: int | None = int(value) if (value := os.getenv("CHAT_MAX_TOKENS")) else None
+    CHAT_MAX_IDLE: float | int | None = extract_duration(os.getenv("CHAT_MAX_IDLE", "6h"))
 
     AI: Literal["ollama", "mistral"] = require_env("AI")
+    AI_BACKENDS: List[str] = extract_csv_tags(os.getenv("AI_BACKENDS"))
+    ROUTER_HEDGING: bool = os.getenv("ROUTER_HEDGING", "").lower() == "true"
+    ROUTER_MAX_CONSECUTIVE_ERRORS: int = int(os.getenv("ROUTER_MAX_CONSECUTIVE_ERRORS", "3"))
+    ROUTER_COOLDOWN: float | int | None = extract_duration(os.getenv("ROUTER_COOLDOWN", "1m"))
 
     MISTRAL_API_KEY: str|None = os.getenv("MISTRAL_API_KEY")
-    MISTRAL_MODEL: str = require_env("MISTRAL_MODEL")
+    MISTRAL_MODEL: str|None = os.getenv("MISTRAL_MODEL")
     MISTRAL_VISION: bool = os.getenv("MISTRAL_VISION", "").lower() == "true"
-    MISTRAL_VISION_MODEL_TYPES: List[str] = extract_csv_tags(require_env("MISTRAL_VISION_MODEL_TYPES"))
+    MISTRAL_VISION_MODEL_TYPES: List[str] = extract_csv_tags(os.getenv("MISTRAL_VISION_MODEL_TYPES"))
+    MISTRAL_VISION_MAX_EDGE: int = int(os.getenv("MISTRAL_VISION_MAX_EDGE", "1540"))
+    MISTRAL_MAX_CONCURRENT_CALLS: int = int(os.getenv("MISTRAL_MAX_CONCURRENT_CALLS", "8"))
 
     AZURE_OPENAI_API_KEY: str|None = os.getenv("AZURE_OPENAI_API_KEY")
-    AZURE_OPENAI_API_VERSION: str = require_env("AZURE_OPENAI_API_VERSION")
-    AZURE_OPENAI_ENDPOINT: str = require_env("AZURE_OPENAI_ENDPOINT")
-    AZURE_OPENAI_MODEL: str = require_env("AZURE_OPENAI_MODEL")
+    AZURE_OPENAI_API_VERSION: str|None = os.getenv("AZURE_OPENAI_API_VERSION")
+    AZURE_OPENAI_ENDPOINT: str|None = os.getenv("AZURE_OPENAI_ENDPOINT")
+    AZURE_OPENAI_MODEL: str|None = os.getenv("AZURE_OPENAI_MODEL")
     AZURE_OPENAI_VISION: bool = os.getenv("AZURE_OPENAI_VISION", "").lower() == "true"
-    AZURE_OPENAI_VISION_MODEL_TYPES: List[str] = extract_csv_tags(require_env("AZURE_OPENAI_VISION_MODEL_TYPES"))
+    AZURE_OPENAI_VISION_MODEL_TYPES: List[str] = extract_csv_tags(os.getenv("AZURE_OPENAI_VISION_MODEL_TYPES"))
+    AZURE_OPENAI_VISION_MAX_EDGE: int = int(os.getenv("AZURE_OPENAI_VISION_MAX_EDGE", "2048"))
+    AZURE_OPENAI_MAX_CONCURRENT_CALLS: int = int(os.getenv("AZURE_OPENAI_MAX_CONCURRENT_CALLS", "8"))
 
     GEMINI_API_KEY: str|None = os.getenv("GEMINI_API_KEY")
-    GEMINI_ENDPOINT: str = require_env("GEMINI_ENDPOINT")
-    GEMINI_MODEL: str = require_env("GEMINI_MODEL")
+    GEMINI_ENDPOINT: str|None = os.getenv("GEMINI_ENDPOINT")
+    GEMINI_MODEL: str|None = os.getenv("GEMINI_MODEL")
     GEMINI_VISION: bool = os.getenv("GEMINI_VISION", "").lower() == "true"
-    GEMINI_VISION_MODEL_TYPES: List[str] = extract_csv_tags(require_env("GEMINI_VISION_MODEL_TYPES"))
+    GEMINI_VISION_MODEL_TYPES: List[str] = extract_csv_tags(os.getenv("GEMINI_VISION_MODEL_TYPES"))
+    GEMINI_VISION_MAX_EDGE: int = int(os.getenv("GEMINI_VISION_MAX_EDGE", "3072"))
+    GEMINI_MAX_CONCURRENT_CALLS: int = int(os.getenv("GEMINI_MAX_CONCURRENT_CALLS", "8"))
 
     OPENAI_API_KEY: str|None = os.getenv("OPENAI_API_KEY")
-    OPENAI_MODEL: str = require_env("OPENAI_MODEL")
+    OPENAI_MODEL: str|None = os.getenv("OPENAI_MODEL")
     OPENAI_VISION: bool = os.getenv("OPENAI_VISION", "").lower() == "true"
-    OPENAI_VISION_MODEL_TYPES: List[str] = extract_csv_tags(require_env("OPENAI_VISION_MODEL_TYPES"))
+    OPENAI_VISION_MODEL_TYPES: List[str] = extract_csv_tags(os.getenv("OPENAI_VISION_MODEL_TYPES"))
+    OPENAI_VISION_MAX_EDGE: int = int(os.getenv("OPENAI_VISION_MAX_EDGE", "2048"))
+    OPENAI_MAX_CONCURRENT_CALLS: int = int(os.getenv("OPENAI_MAX_CONCURRENT_CALLS", "8"))
 
-    OLLAMA_URL: str = require_env("OLLAMA_URL")
-    OLLAMA_MODEL: str = require_env("OLLAMA_MODEL")
+    OLLAMA_URL: str|None = os.getenv("OLLAMA_URL")
+    OLLAMA_MODEL: str|None = os.getenv("OLLAMA_MODEL")
     OLLAMA_MODEL_TEMPERATURE: float|None = float(value) if (value := os.getenv("OLLAMA_MODEL_TEMPERATURE")) else None
     OLLAMA_THINK: bool|Literal["low", "medium", "high"]|None = extract_ollama_think(os.getenv("OLLAMA_THINK"))
     OLLAMA_KEEP_ALIVE: float | int | None = extract_duration(os.getenv("OLLAMA_KEEP_ALIVE"))
     OLLAMA_TIMEOUT: float | int | None = extract_duration(os.getenv("OLLAMA_TIMEOUT"))
     OLLAMA_VISION: bool = os.getenv("OLLAMA_VISION", "").lower() == "true"
-    OLLAMA_VISION_MODEL_TYPES: List[str] = extract_csv_tags(require_env("OLLAMA_VISION_MODEL_TYPES"))
+    OLLAMA_VISION_MODEL_TYPES: List[str] = extract_csv_tags(os.getenv("OLLAMA_VISION_MODEL_TYPES"))
+    OLLAMA_VISION_MAX_EDGE: int = int(os.getenv("OLLAMA_VISION_MAX_EDGE", "1024"))
     OLLAMA_REQUIRED_VRAM_IN_GB: float | int | None = int(value) if (value := os.getenv("OLLAMA_REQUIRED_VRAM_IN_GB")) else None
-    OLLAMA_WAIT_FOR_REQUIRED_VRAM: float | int = extract_duration(require_env("OLLAMA_WAIT_FOR_REQUIRED_VRAM"))
+    OLLAMA_WAIT_FOR_REQUIRED_VRAM: float | int | None = extract_duration(os.getenv("OLLAMA_WAIT_FOR_REQUIRED_VRAM"))
+    OLLAMA_MAX_CONCURRENT_CALLS: int = int(os.getenv("OLLAMA_MAX_CONCURRENT_CALLS", "1"))
+    OLLAMA_MAX_CONNECTIONS: int = int(os.getenv("OLLAMA_MAX_CONNECTIONS", "10"))
+    OLLAMA_MAX_KEEPALIVE_CONNECTIONS: int = int(os.getenv("OLLAMA_MAX_KEEPALIVE_CONNECTIONS", "5"))
 
     TOOL_INTEGRATION: bool = os.getenv("TOOL_INTEGRATION", "").lower() == "true"
     MCP_SERVER_URL: str|None = os.getenv("MCP_SERVER_URL")
+    MCP_SESSION_POOL_SIZE: int = int(os.getenv("MCP_SESSION_POOL_SIZE", "4"))
+    MCP_MAX_PARALLEL_TOOL_CALLS: int = int(os.getenv("MCP_MAX_PARALLEL_TOOL_CALLS", "4"))
+    MCP_TOOL_CACHE_TTL: float | int | None = extract_duration(os.getenv("MCP_TOOL_CACHE_TTL", "5m"))
+    MCP_TOOL_CACHE_SIZE: int = int(os.getenv("MCP_TOOL_CACHE_SIZE", "256"))
     MCP_INTEGRATION_CLASS: str = require_env("MCP_INTEGRATION_CLASS")
     MCP_TOOL_TAGS: List[str] = extract_csv_tags(os.getenv("MCP_TOOL_TAGS"))
     MCP_ERROR_HELP_DISCORD_ID: int | None = int(value) if (value := os.getenv("MCP_ERROR_HELP_DISCORD_ID")) else None
 
     MAX_TOKENS: int = int(require_env("MAX_TOKENS"))
+    RESPONSE_TOKEN_RESERVE: int = extract_response_token_reserve(os.getenv("RESPONSE_TOKEN_RESERVE", "2048"), MAX_TOKENS)
     MAX_MESSAGE_COUNT: int = int(require_env("MAX_MESSAGE_COUNT"))
     TOTAL_MESSAGE_SEARCH_COUNT: int = int(require_env("TOTAL_MESSAGE_SEARCH_COUNT"))
     MAX_TOOL_CALLS: int = int(require_env("MAX_TOOL_CALLS"))
     DENY_RECURSIVE_TOOL_CALLING: bool = os.getenv("DENY_RECURSIVE_TOOL_CALLING", "").lower() == "true"
+    STREAMING: bool = os.getenv("STREAMING", "").lower() == "true"
+    LLM_MAX_QUEUE_WAIT: float | int | None = extract_duration(os.getenv("LLM_MAX_QUEUE_WAIT"))
 
     NAME: str = require_env("NAME")
     INSTRUCTIONS: str = os.getenv("INSTRUCTIONS", "")
@@ -3,9 +3,9 @@ import traceback
 from enum import StrEnum
 
 import discord
-from fastmcp import Client
 
 from core.config import Config
+from providers.utils.mcp_session_pool import mcp_session_pool
 
 
 class BotActions(StrEnum):
@@ -23,22 +23,18 @@ class BotAction:
         try:
             match action:
                 case BotActions.INTERRUPT:
-                    client = Client(Config.MCP_SERVER_URL)
-                    async with client:
-                        try:
-                            await client.call_tool("interrupt_image_generation", {})
-                            return "🛑 Generierung abgebrochen"
-                        except Exception as e:
-                            return f"❌ Ausnahmefehler: {str(e)}"
+                    try:
+                        await mcp_session_pool.call_tool("interrupt_image_generation", {})
+                        return "🛑 Generierung abgebrochen"
+                    except Exception as e:
+                        return f"❌ Ausnahmefehler: {str(e)}"
 
                 case BotActions.UNLOAD_COMFY:
-                    client = Client(Config.MCP_SERVER_URL)
-                    async with client:
-                        try:
-                            await client.call_tool("free_image_generation_vram", {})
-                            return "✅ Modelle werden entladen"
-                        except Exception as e:
-                            return f"❌ Ausnahmefehler: {str(e)}"
+                    try:
+                        await mcp_session_pool.call_tool("free_image_generation_vram", {})
+                        return "✅ Modelle werden entladen"
+                    except Exception as e:
+                        return f"❌ Ausnahmefehler: {str(e)}"
 
                 case BotActions.RESET:
                     await interaction.channel.send(Config.HISTORY_RESET_TEXT)
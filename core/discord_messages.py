@@ -3,7 +3,7 @@ import io
 import logging
 import time
 from dataclasses import dataclass, field
-from typing import Dict, runtime_checkable, Protocol, Tuple
+from typing import Dict, runtime_checkable, Protocol, Tuple, List, Callable
 
 import discord
 from discord import Message, TextChannel
@@ -67,6 +67,34 @@ class DiscordMessageRemoveTmp(DiscordMessage, DiscordMessageTmpMixin):
     value: None = field(init=False)
     pass
 
+@dataclass(kw_only=True)
+class DiscordMessageStream(DiscordMessage):
+    """Text delta of a streamed reply, all deltas with the same key end up in the same message(s)"""
+    value: str
+    key: str
+    done: bool = False
+
+
+
+def split_message(text: str, limit: int = 2000) -> List[str]:
+    """Splits a text into Discord sized messages, preferably at line breaks or spaces"""
+
+    chunks = []
+    text = text.strip()
+
+    while len(text) > limit:
+        cut = text.rfind("\n", 0, limit)
+        if cut <= 0:
+            cut = text.rfind(" ", 0, limit)
+        if cut <= 0:
+            cut = limit
+        chunks.append(text[:cut].rstrip())
+        text = text[cut:].strip()
+
+    if text:
+        chunks.append(text)
+
+    return chunks
 
 
 class DiscordTemporaryMessagesController:
@@ -78,19 +106,30 @@ class DiscordTemporaryMessagesController:
         self.error_deletion_delay = error_deletion_delay
         self.min_update_interval = min_update_interval
         self._last_update: Dict[str, float] = {}
+        self.streams: Dict[str, Tuple[str, List[Tuple[str, Message]]]] = {}
+        """Streamed text and the sent (content, message) pairs per key, these messages are not deleted"""
 
 
-    async def set_message(self, message: DiscordMessageTmpProtocol, view: discord.ui.View = None):
+    def is_throttled(self, key: str, force: bool = False) -> bool:
+        """Limits the updates per key to one every min_update_interval"""
 
         now = time.monotonic()
+        last = self._last_update.get(key, 0)
+
+        if now - last < self.min_update_interval and not force:
+            return True
+
+        self._last_update[key] = now
+        return False
+
+
+    async def set_message(self, message: DiscordMessageTmpProtocol, view: discord.ui.View = None):
 
         # Wenn es sich um Progress handelt → throttlen
         if isinstance(message, DiscordMessageProgressTmp):
-            last = self._last_update.get(message.key, 0)
             # Update nur, wenn Intervall überschritten oder 100% erreicht
-            if now - last < self.min_update_interval and message.progress < message.total:
+            if self.is_throttled(message.key, force=message.progress >= message.total):
                 return
-            self._last_update[message.key] = now
 
 
         async with self._lock:
@@ -138,6 +177,37 @@ class DiscordTemporaryMessagesController:
                 logging.error(f"Ungültiger Temp Message Typ: {message}")
 
 
+    async def stream(self, message: DiscordMessageStream, formatter: Callable[[str], str] = lambda text: text):
+        """Progressively edits one Discord message and continues in a new one at the length limit"""
+
+        text, sent = self.streams.get(message.key, ("", []))
+        text += message.value
+        self.streams[message.key] = (text, sent)
+
+        if self.is_throttled(f"stream-{message.key}", force=message.done):
+            return
+
+        async with self._lock:
+
+            chunks = split_message(formatter(text))
+
+            for i, chunk in enumerate(chunks):
+                if i < len(sent):
+                    content, discord_msg = sent[i]
+                    if content != chunk:
+                        await discord_msg.edit(content=chunk)
+                        sent[i] = (chunk, discord_msg)
+                else:
+                    sent.append((chunk, await self.channel.send(chunk)))
+
+            for _, discord_msg in sent[len(chunks):]: # The formatted text got shorter
+                await discord_msg.delete()
+            del sent[len(chunks):]
+
+        if message.done:
+            self.streams.pop(message.key, None)
+
+
     async def __aenter__(self):
         logging.debug("Discord Controller gestartet")
         return self
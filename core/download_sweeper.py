@@ -0,0 +1,245 @@
+import asyncio
+import logging
+import os
+import time
+from collections import Counter
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Dict, List, Set, Tuple, Callable, Iterable
+
+from core.chat_history import ChatHistoryMessage, ChatHistoryFileSaved
+from core.chat_store import chat_store
+from core.config import Config
+from core.executors import thread_executor
+
+
+@dataclass
+class DownloadedFile:
+    path: Path
+    size: int
+    mtime: float
+
+
+def reference_key(path: Path | str) -> Tuple[str, str]:
+    """Folder and base name, so derived files like <name>.1024px.webp belong to their original"""
+
+    path = os.path.abspath(path)
+    return os.path.dirname(path), os.path.basename(path).split(".", 1)[0]
+
+
+def scan_folder(folder: Path) -> List[DownloadedFile]:
+    """Blocking, runs in a worker thread"""
+
+    files = []
+    stack = [folder]
+
+    while stack:
+        try:
+            with os.scandir(stack.pop()) as entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        stack.append(Path(entry.path))
+                    elif entry.is_file(follow_symlinks=False):
+                        stat = entry.stat(follow_symlinks=False)
+                        files.append(DownloadedFile(Path(entry.path), stat.st_size, stat.st_mtime))
+        except FileNotFoundError:
+            continue
+
+    return files
+
+
+def delete_files(paths: List[Path]) -> List[Path]:
+    """Blocking, returns the deleted paths"""
+
+    deleted = []
+
+    for path in paths:
+        try:
+            path.unlink(missing_ok=True)
+            deleted.append(path)
+        except Exception as e:
+            logging.exception(f"Deletion of '{path}' failed: {e}")
+
+    return deleted
+
+
+class DownloadSweeper:
+    """Deletes unreferenced files in DOWNLOAD_FOLDER in the background.
+
+    The chat registries report the saved files of each channel's history, the histories in the
+    chat store are loaded before the first sweep. Files still referenced by a history are never
+    deleted. Unreferenced files are kept for DOWNLOAD_MAX_AGE
+    (attachments are shared by content hash and may come back), the oldest ones go earlier while
+    the folder exceeds DOWNLOAD_QUOTA or a channel exceeds DOWNLOAD_CHANNEL_QUOTA. Scanning and
+    deleting run in the thread executor, in batches."""
+
+    def __init__(self, folder: Path = Config.DOWNLOAD_FOLDER, interval: float = Config.DOWNLOAD_SWEEP_INTERVAL,
+                 quota: int = Config.DOWNLOAD_QUOTA_BYTES, channel_quota: int = Config.DOWNLOAD_CHANNEL_QUOTA_BYTES,
+                 max_age: float = Config.DOWNLOAD_MAX_AGE, min_age: float = Config.DOWNLOAD_MIN_AGE, batch_size: int = 100):
+        self.folder = folder
+        self.interval = interval
+        self.quota = quota
+        self.channel_quota = channel_quota
+        self.max_age = max_age
+        self.min_age = min_age
+        """Grace period for files that are downloaded but not yet in a history"""
+        self.batch_size = batch_size
+        self.protected = {reference_key(Config.CHAT_STORE_PATH)} if Config.CHAT_STORE_PATH else set()
+        """Never deleted, e.g. the chat store if it is kept in the download folder"""
+
+        self._references: Dict[str, Set[Tuple[str, str]]] = {}
+        self._referenced: Counter[Tuple[str, str]] = Counter()
+        self._owners: Dict[Tuple[str, str], str] = {}
+        """Channel that referenced the file last, its disk usage counts for that channel"""
+        self._stored_loaded = False
+        self._task: asyncio.Task | None = None
+
+        self.on_delete: List[Callable[[List[Path]], None]] = []
+        """Called with the deleted paths, e.g. to forget cached lookups"""
+
+        self.sweeps = 0
+        self.files = 0
+        self.bytes = 0
+        self.deleted = 0
+        self.bytes_freed = 0
+        self.avg_sweep_time = 0
+
+    def track(self, channel: str, history: Iterable[ChatHistoryMessage]) -> None:
+        """Replaces the references of the channel with the saved files in its history"""
+
+        self.set_references(channel, {reference_key(file.full_path) for message in history for file in message.files if isinstance(file, ChatHistoryFileSaved)})
+
+    def set_references(self, channel: str, keys: Set[Tuple[str, str]]) -> None:
+
+        old_keys = self._references.get(channel, set())
+
+        self._referenced.update(keys - old_keys)
+        self._referenced.subtract(old_keys - keys)
+        for key in old_keys - keys:
+            if self._referenced[key] <= 0:
+                del self._referenced[key]
+
+        for key in keys:
+            self._owners[key] = channel
+
+        self._references[channel] = keys
+
+    def untrack(self, channel: str) -> None:
+        self.track(channel, [])
+        del self._references[channel]
+
+    def is_referenced(self, path: Path) -> bool:
+        key = reference_key(path)
+        return key in self._referenced or key in self.protected
+
+    def start(self) -> None:
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self.run())
+
+    async def close(self) -> None:
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def load_stored_references(self) -> None:
+        """References of the stored histories, channels already tracked in memory are newer"""
+
+        for channel, paths in (await chat_store.referenced_files()).items():
+            if channel not in self._references:
+                self.set_references(channel, {reference_key(path) for path in paths})
+
+        self._stored_loaded = True
+        logging.info(f"DOWNLOAD SWEEPER: Loaded the references of the chat store: {self.stats()}")
+
+    async def run(self) -> None:
+        while True:
+            try:
+                if not self._stored_loaded: # Otherwise files of stored histories look unreferenced
+                    await self.load_stored_references()
+                await self.sweep()
+            except Exception as e:
+                logging.exception(f"DOWNLOAD SWEEPER: Sweep failed: {e}")
+            await asyncio.sleep(self.interval)
+
+    def select(self, files: List[DownloadedFile]) -> List[DownloadedFile]:
+        """Unreferenced files to delete, oldest first"""
+
+        now = time.time()
+        total = sum(file.size for file in files)
+        channel_bytes: Counter[str] = Counter()
+
+        for file in files:
+            if owner := self._owners.get(reference_key(file.path)):
+                channel_bytes[owner] += file.size
+
+        selected = []
+
+        for file in sorted(files, key=lambda file: file.mtime):
+
+            age = now - file.mtime
+
+            if age < self.min_age or self.is_referenced(file.path):
+                continue
+
+            owner = self._owners.get(reference_key(file.path))
+
+            if age > self.max_age or total > self.quota or (owner and channel_bytes[owner] > self.channel_quota):
+                selected.append(file)
+                total -= file.size
+                if owner:
+                    channel_bytes[owner] -= file.size
+
+        if total > self.quota:
+            logging.warning(f"DOWNLOAD SWEEPER: Referenced files alone exceed the quota: {total} bytes")
+
+        return selected
+
+    async def sweep(self) -> None:
+
+        start = time.perf_counter()
+
+        files = await thread_executor.run("download_scan", scan_folder, self.folder)
+        self.files = len(files)
+        self.bytes = sum(file.size for file in files)
+
+        selected = self.select(files)
+        deleted_count = 0
+
+        for i in range(0, len(selected), self.batch_size):
+
+            batch = [file for file in selected[i:i + self.batch_size] if not self.is_referenced(file.path)] # Referenced again meanwhile
+            deleted = await thread_executor.run("download_delete", delete_files, [file.path for file in batch])
+            deleted_set = set(deleted)
+
+            deleted_count += len(deleted)
+            self.deleted += len(deleted)
+            self.bytes_freed += sum(file.size for file in batch if file.path in deleted_set)
+
+            for key in {reference_key(path) for path in deleted}:
+                if key not in self._referenced:
+                    self._owners.pop(key, None)
+
+            for callback in self.on_delete:
+                callback(deleted)
+
+        sweep_time = time.perf_counter() - start
+        self.sweeps += 1
+        self.avg_sweep_time = 0.9 * self.avg_sweep_time + 0.1 * sweep_time if self.avg_sweep_time else sweep_time
+
+        logging.info(f"DOWNLOAD SWEEPER: Deleted {deleted_count} files in {sweep_time:.2f}s: {self.stats()}")
+
+    def stats(self) -> Dict[str, int | float]:
+        return {
+            "files": self.files,
+            "bytes": self.bytes,
+            "channels": len(self._references),
+            "referenced": len(self._referenced),
+            "deleted": self.deleted,
+            "bytes_freed": self.bytes_freed,
+            "sweeps": self.sweeps,
+            "avg_sweep_time": round(self.avg_sweep_time, 3),
+        }
+
+
+download_sweeper = DownloadSweeper()
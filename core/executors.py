@@ -0,0 +1,106 @@
+import asyncio
+import logging
+import time
+from concurrent.futures import Executor, ThreadPoolExecutor, ProcessPoolExecutor
+from dataclasses import dataclass
+from typing import Dict, Callable, TypeVar, Tuple, Any, List
+
+from core.config import Config
+
+T = TypeVar("T")
+
+
+def timed_call(function: Callable[..., T], *args) -> Tuple[float, T]:
+    """Runs in the worker, wall clock time so it is comparable across processes"""
+
+    started = time.time()
+    return started, function(*args)
+
+
+@dataclass
+class CallSiteStats:
+    calls: int = 0
+    errors: int = 0
+    avg_wait: float = 0
+    avg_run: float = 0
+    max_wait: float = 0
+    max_run: float = 0
+
+    def record(self, wait: float, run: float) -> None:
+        self.avg_wait = 0.9 * self.avg_wait + 0.1 * wait if self.calls else wait
+        self.avg_run = 0.9 * self.avg_run + 0.1 * run if self.calls else run
+        self.max_wait = max(self.max_wait, wait)
+        self.max_run = max(self.max_run, run)
+        self.calls += 1
+
+    def stats(self) -> Dict[str, int | float]:
+        return {
+            "calls": self.calls,
+            "errors": self.errors,
+            "avg_wait": round(self.avg_wait, 4),
+            "avg_run": round(self.avg_run, 4),
+            "max_wait": round(self.max_wait, 4),
+            "max_run": round(self.max_run, 4),
+        }
+
+
+class InstrumentedExecutor:
+    """Runs blocking functions off the event loop and measures the queue wait and run time per call site.
+
+    The pool is created on first use. Functions for process pools must be picklable (module level)."""
+
+    def __init__(self, name: str, factory: Callable[[], Executor]):
+        self.name = name
+        self.factory = factory
+        self._executor: Executor | None = None
+        self.sites: Dict[str, CallSiteStats] = {}
+
+    @property
+    def executor(self) -> Executor:
+        if self._executor is None:
+            self._executor = self.factory()
+        return self._executor
+
+    async def run(self, site: str, function: Callable[..., T], *args) -> T:
+
+        stats = self.sites.setdefault(site, CallSiteStats())
+        submitted = time.time()
+
+        try:
+            started, result = await asyncio.get_running_loop().run_in_executor(self.executor, timed_call, function, *args)
+        except Exception:
+            stats.errors += 1
+            raise
+
+        finished = time.time()
+        stats.record(started - submitted, finished - started)
+        logging.debug(f"EXECUTOR {self.name}: {site} waited {started - submitted:.4f}s, ran {finished - started:.4f}s")
+
+        return result
+
+    def shutdown(self) -> None:
+        if self._executor:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+    def stats(self) -> Dict[str, Dict[str, int | float]]:
+        return {site: stats.stats() for site, stats in self.sites.items()}
+
+
+thread_executor = InstrumentedExecutor("threads", lambda: ThreadPoolExecutor(max_workers=Config.IO_WORKERS, thread_name_prefix="io"))
+"""File I/O and C extensions that release the GIL (e.g. tiktoken)"""
+
+process_executor = InstrumentedExecutor("processes", lambda: ProcessPoolExecutor(max_workers=Config.CPU_WORKERS))
+"""CPU bound Python work, e.g. image processing"""
+
+executors: List[InstrumentedExecutor] = [thread_executor, process_executor]
+
+
+def executor_stats() -> Dict[str, Any]:
+    return {executor.name: executor.stats() for executor in executors}
+
+
+def shutdown_executors() -> None:
+    logging.info(f"EXECUTORS: {executor_stats()}")
+    for executor in executors:
+        executor.shutdown()
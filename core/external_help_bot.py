@@ -3,6 +3,7 @@ import logging
 import discord
 
 from core.config import Config
+from core.member_directory import member_directory
 
 
 def use_help_bot(message: discord.Message) -> bool:
@@ -12,8 +13,7 @@ def use_help_bot(message: discord.Message) -> bool:
 
         logging.debug("DISCORD HELP BOT: Discord Text Channel - check if the Help Bot should be used")
 
-        logging.debug("DISCORD HELP BOT: %s", [member.id for member in message.channel.members])
-        is_member = Config.MCP_ERROR_HELP_DISCORD_ID in [member.id for member in message.channel.members]
+        is_member = Config.MCP_ERROR_HELP_DISCORD_ID is not None and member_directory.is_member(message.channel, Config.MCP_ERROR_HELP_DISCORD_ID)
 
         logging.debug(f"DISCORD HELP BOT: Is {Config.MCP_ERROR_HELP_DISCORD_ID} member: {is_member}")
 
@@ -1,22 +1,45 @@
-import csv
 import logging
-import os
-from typing import List, Dict
+from functools import lru_cache
 
 import discord
-from discord import Status
 
+from core.chat_history import ChatHistoryMessage, PromptSegment
 from core.config import Config
+from core.executors import thread_executor
+from core.member_directory import member_directory
+from core.message_handling import replace_instruction_patterns
 
 
-def get_instructions_from_discord_info(message: discord.Message) -> str:
+async def get_system_instructions(message: discord.Message) -> ChatHistoryMessage:
+    """System entry with the persona as stable prefix and the channel info with the member list as volatile suffix.
+
+    Keeps the beginning of the prompt identical across requests for the prefix caches of the providers."""
+
+    discord_info = "\n\n" + await get_instructions_from_discord_info(message)
+
+    return ChatHistoryMessage.from_segments("system", [
+        get_persona_segment(replace_instruction_patterns(Config.INSTRUCTIONS)),
+        await thread_executor.run("count_tokens", get_discord_info_segment, discord_info), # Member lists can be long
+    ])
+
+
+@lru_cache(maxsize=4)
+def get_persona_segment(persona: str) -> PromptSegment:
+    return PromptSegment.compile(persona)
+
+
+@lru_cache(maxsize=64)
+def get_discord_info_segment(discord_info: str) -> PromptSegment:
+    return PromptSegment.compile(discord_info, volatile=True)
+
+
+async def get_instructions_from_discord_info(message: discord.Message) -> str:
 
     if not isinstance(message.channel, discord.DMChannel):
 
-        member_list = get_member_list(message.channel.members)
-        member_list = "\n".join([f" - {m}" for m in member_list])
+        member_list = await member_directory.get_member_block(message.channel)
 
-        logging.info(member_list)
+        logging.debug(member_list)
 
         match Config.LANGUAGE:
             case "de":
@@ -55,18 +78,3 @@ Do not modify the format, and make sure to include the angle brackets and the nu
                 raise TypeError(f"Invalid Language: {Config.LANGUAGE}")
 
     return instructions
-
-
-def get_member_list(members: List[discord.Member]) -> List[Dict[str, str | int]]:
-
-    member_dict = {m.id: {"Discord": m.display_name, "Discord ID": m.id} for m in members if m.status in [Status.online, Status.idle]}
-    extra_dict = {}
-    if Config.USERNAMES_CSV_FILE_PATH and os.path.exists(Config.USERNAMES_CSV_FILE_PATH):
-        with open(Config.USERNAMES_CSV_FILE_PATH, 'r', encoding='utf-8') as datei:
-            csv_reader = csv.DictReader(datei)
-            extra_dict = {int(row["Discord ID"]): {**row, "Discord ID": int(row["Discord ID"])} for row in csv_reader}
-
-    return [
-        { **extra_dict.get(key, {}), **member_dict.get(key, {}) }
-        for key in (member_dict.keys() | extra_dict.keys())
-    ]
\ No newline at end of file
@@ -0,0 +1,129 @@
+import csv
+import logging
+import os
+from typing import Dict, List, Tuple
+
+import discord
+from discord import Status
+
+from core.config import Config
+from core.executors import thread_executor
+
+LISTED_STATUSES = (Status.online, Status.idle)
+
+
+def read_usernames_csv(path: str) -> Dict[int, Dict[str, str | int]]:
+    """Blocking, runs in the thread executor"""
+
+    with open(path, 'r', encoding='utf-8') as datei:
+        csv_reader = csv.DictReader(datei)
+        return {int(row["Discord ID"]): {**row, "Discord ID": int(row["Discord ID"])} for row in csv_reader}
+
+
+def get_member_list(members: List[discord.Member], extra_dict: Dict[int, Dict[str, str | int]]) -> List[Dict[str, str | int]]:
+
+    member_dict = {m.id: {"Discord": m.display_name, "Discord ID": m.id} for m in members if m.status in LISTED_STATUSES}
+
+    return [
+        { **extra_dict.get(key, {}), **member_dict.get(key, {}) }
+        for key in (member_dict.keys() | extra_dict.keys())
+    ]
+
+
+class MemberDirectory:
+    """Rendered member lists per channel, kept current from the gateway events.
+
+    Each guild has a version for its members, roles and channel permissions and one for the
+    listed presences. A channel's member block is rendered again only when one of them or the
+    usernames CSV changed, the CSV is parsed again only when its mtime changed."""
+
+    def __init__(self, usernames_path: str | None = Config.USERNAMES_CSV_FILE_PATH):
+        self.usernames_path = usernames_path
+        self._usernames: Dict[int, Dict[str, str | int]] = {}
+        self._usernames_mtime: float | None = None
+
+        self._versions: Dict[int, int] = {}
+        """Guild id -> version of members, roles and permissions"""
+        self._presence_versions: Dict[int, int] = {}
+        self._blocks: Dict[int, Tuple[Tuple[int, int, float | None], str]] = {}
+        """Channel id -> (versions it was rendered for, member block)"""
+
+        self.hits = 0
+        self.misses = 0
+        self.usernames_reloads = 0
+
+    @staticmethod
+    def is_member(channel: discord.abc.GuildChannel, user_id: int) -> bool:
+        """Same as user_id in channel.members, without building the member list"""
+
+        member = channel.guild.get_member(user_id)
+        return member is not None and channel.permissions_for(member).read_messages
+
+    async def get_usernames(self) -> Dict[int, Dict[str, str | int]]:
+
+        if not self.usernames_path:
+            return {}
+
+        try:
+            mtime = os.stat(self.usernames_path).st_mtime
+        except FileNotFoundError:
+            self._usernames, self._usernames_mtime = {}, None
+            return self._usernames
+
+        if mtime != self._usernames_mtime:
+            self._usernames = await thread_executor.run("usernames_csv", read_usernames_csv, self.usernames_path)
+            self._usernames_mtime = mtime
+            self.usernames_reloads += 1
+            logging.info(f"MEMBER DIRECTORY: Loaded {len(self._usernames)} users from {self.usernames_path}")
+
+        return self._usernames
+
+    async def get_member_block(self, channel: discord.TextChannel | discord.Thread) -> str:
+
+        usernames = await self.get_usernames()
+        key = (self._versions.get(channel.guild.id, 0), self._presence_versions.get(channel.guild.id, 0), self._usernames_mtime)
+
+        cached = self._blocks.get(channel.id)
+
+        if cached and cached[0] == key:
+            self.hits += 1
+            return cached[1]
+
+        self.misses += 1
+        block = "\n".join([f" - {m}" for m in get_member_list(channel.members, usernames)])
+        self._blocks[channel.id] = (key, block)
+
+        logging.info(f"MEMBER DIRECTORY: Rendered the members of {channel.name}: {self.stats()}")
+
+        return block
+
+    def invalidate(self, guild: discord.Guild | None) -> None:
+        """Members, roles or permissions changed"""
+
+        if guild:
+            self._versions[guild.id] = self._versions.get(guild.id, 0) + 1
+
+    def invalidate_all(self) -> None:
+        """Gateway events may have been missed, e.g. while disconnected"""
+
+        self._blocks.clear()
+
+    def presence_changed(self, before: discord.Member, after: discord.Member) -> None:
+        """Only changes that are visible in the member list count"""
+
+        if (before.status in LISTED_STATUSES) != (after.status in LISTED_STATUSES) or before.display_name != after.display_name:
+            self._presence_versions[after.guild.id] = self._presence_versions.get(after.guild.id, 0) + 1
+
+    def stats(self) -> Dict[str, int | float]:
+        total = self.hits + self.misses
+        return {
+            "channels": len(self._blocks),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / total, 3) if total else 0,
+            "usernames": len(self._usernames),
+            "usernames_reloads": self.usernames_reloads,
+        }
+
+
+member_directory = MemberDirectory()
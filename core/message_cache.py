@@ -0,0 +1,197 @@
+import logging
+from collections import OrderedDict
+from datetime import datetime
+from typing import Dict, List, Iterable, Tuple
+
+import discord
+from discord.ext import commands
+
+from core.chat_history import ChatHistoryMessage
+from core.config import Config
+from core.message_handling import handle_message
+
+
+class CachedDiscordMessage:
+
+    def __init__(self, message: discord.Message):
+        self.message = message
+        self.rendered: ChatHistoryMessage | None = None
+        self.rendered_at: datetime | None = None
+        self.is_rendered = False
+
+    def update(self, message: discord.Message):
+        self.message = message
+        self.is_rendered = False
+
+    async def render(self, bot: commands.Bot) -> ChatHistoryMessage | None:
+        """Renders the message only once per edit"""
+
+        if not self.is_rendered or self.rendered_at != self.message.edited_at:
+            self.rendered = await handle_message(bot, self.message)
+            self.rendered_at = self.message.edited_at
+            self.is_rendered = True
+
+        return self.rendered
+
+
+class ChannelMessageBuffer:
+    """Ring buffer of the newest messages of one channel, ordered by message id"""
+
+    def __init__(self, size: int):
+        self.size = size
+        self.entries: OrderedDict[int, CachedDiscordMessage] = OrderedDict()
+        self.exhausted = False
+        """No older messages exist in the channel than the oldest one in the buffer"""
+        self.filling = True
+        """The initial REST fetch is still running"""
+        self.deleted: set[int] = set()
+
+    def put(self, message: discord.Message):
+
+        if message.id in self.deleted:
+            return
+
+        if message.id in self.entries:
+            self.entries[message.id].update(message)
+            return
+
+        newest_id = next(reversed(self.entries), None)
+        self.entries[message.id] = CachedDiscordMessage(message)
+
+        if newest_id is not None and message.id < newest_id: # Out of order (e.g. REST results during gateway events)
+            self.entries = OrderedDict(sorted(self.entries.items()))
+
+        while len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+            self.exhausted = False
+
+    def remove(self, message_ids: Iterable[int]):
+        for message_id in message_ids:
+            self.entries.pop(message_id, None)
+            if self.filling:
+                self.deleted.add(message_id)
+
+
+class DiscordMessageCache:
+    """Per channel cache of the Discord history, kept current by gateway events.
+
+    Falls back to a REST fetch of the channel history on a cold miss or when deletions
+    left the buffer too short to fill the context."""
+
+    def __init__(self, bot: commands.Bot, size: int = Config.TOTAL_MESSAGE_SEARCH_COUNT):
+        self.bot = bot
+        self.size = size
+        self.channels: Dict[int, ChannelMessageBuffer] = {}
+        self.hits = 0
+        self.misses = 0
+
+    # ---------- Gateway Events ----------
+    def add(self, message: discord.Message):
+        buffer = self.channels.get(message.channel.id)
+        if buffer:
+            buffer.put(message)
+
+    def edit(self, message: discord.Message):
+        buffer = self.channels.get(message.channel.id)
+        if buffer and message.id in buffer.entries:
+            buffer.put(message)
+
+    def delete(self, channel_id: int, message_ids: Iterable[int]):
+        buffer = self.channels.get(channel_id)
+        if buffer:
+            buffer.remove(message_ids)
+
+    def invalidate(self, channel_id: int | None = None):
+        """Forgets a channel (or all channels if None), e.g. after a gateway disconnect"""
+
+        if channel_id is None:
+            logging.info("MESSAGE CACHE: Invalidating all channels")
+            self.channels.clear()
+        else:
+            self.channels.pop(channel_id, None)
+
+    # ---------- History ----------
+    async def get_history(self, message: discord.Message) -> List[ChatHistoryMessage]:
+
+        buffer = self.channels.get(message.channel.id)
+
+        if buffer and not buffer.filling and message.id in buffer.entries:
+            history, complete = await self.build_history(buffer)
+            if complete:
+                self.hits += 1
+                logging.info("MESSAGE CACHE HIT: %s", self.stats())
+                return history
+            logging.info("MESSAGE CACHE: Gap detected in channel %s", message.channel.id)
+
+        self.misses += 1
+        logging.info("MESSAGE CACHE MISS: %s", self.stats())
+
+        buffer = await self.fetch(message.channel)
+        history, _ = await self.build_history(buffer)
+
+        return history
+
+    async def fetch(self, channel: discord.abc.Messageable) -> ChannelMessageBuffer:
+
+        old_buffer = self.channels.get(channel.id)
+        buffer = ChannelMessageBuffer(self.size)
+        self.channels[channel.id] = buffer  # Gateway events during the fetch land in the new buffer
+
+        try:
+            messages = [msg async for msg in channel.history(limit=self.size, oldest_first=False)]
+        except Exception:
+            self.channels.pop(channel.id, None)
+            raise
+
+        for msg in reversed(messages):
+            if msg.id not in buffer.entries:
+                buffer.put(msg)
+
+        if old_buffer: # Keep already rendered messages
+            for message_id, entry in buffer.entries.items():
+                old_entry = old_buffer.entries.get(message_id)
+                if old_entry and old_entry.is_rendered and old_entry.rendered_at == entry.message.edited_at:
+                    entry.rendered, entry.rendered_at, entry.is_rendered = old_entry.rendered, old_entry.rendered_at, True
+
+        buffer.exhausted = len(messages) < self.size
+        buffer.filling = False
+        buffer.deleted.clear()
+
+        return buffer
+
+    async def build_history(self, buffer: ChannelMessageBuffer) -> Tuple[List[ChatHistoryMessage], bool]:
+        """Returns the history and whether the buffer was long enough to build it"""
+
+        history: List[ChatHistoryMessage] = []
+
+        for entry in reversed(list(buffer.entries.values())):
+
+            if entry.message.content == Config.HISTORY_RESET_TEXT:
+                break
+
+            if len(history) >= Config.MAX_MESSAGE_COUNT:
+                break
+
+            history_message = await entry.render(self.bot)
+
+            if not history_message:
+                continue
+
+            history.append(history_message)
+
+        else:
+            if not buffer.exhausted and len(buffer.entries) < self.size:
+                return [], False
+
+        history.reverse()
+
+        return history, True
+
+    def stats(self) -> Dict[str, int | float]:
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0,
+            "channels": len(self.channels),
+        }
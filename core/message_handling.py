@@ -1,20 +1,20 @@
 import asyncio
 import io
 import logging
-import os
 import re
 from datetime import datetime
-from typing import List, Literal
+from typing import List, Literal, Awaitable, Tuple
 
 import discord
 from babel.dates import format_time, format_date
 from discord.ext import commands
 
+from core.attachment_store import attachment_store
 from core.chat_history import ChatHistoryMessage, ChatHistoryFile, ChatHistoryFileSaved
 from core.config import Config
 from core.discord_buttons import ProgressButton
 from core.discord_messages import DiscordMessage, DiscordMessageReply, DiscordMessageFile, DiscordMessageTmpMixin, \
-    DiscordTemporaryMessagesController
+    DiscordTemporaryMessagesController, DiscordMessageStream
 
 
 def clean_reply(reply: str) -> str:
@@ -27,32 +27,6 @@ def clean_reply(reply: str) -> str:
 def is_relevant_message(bot: commands.Bot,message: discord.Message) -> bool:
     return bot.user in message.mentions or isinstance(message.channel, discord.DMChannel)
 
-async def handle_messages(bot: commands.Bot, message: discord.Message) -> List[ChatHistoryMessage]:
-
-    history: List[ChatHistoryMessage] = []
-
-    async for msg in message.channel.history(limit=Config.TOTAL_MESSAGE_SEARCH_COUNT, oldest_first=False):
-
-        if msg.content == Config.HISTORY_RESET_TEXT:
-            break
-
-        if len(history) >= Config.MAX_MESSAGE_COUNT:
-            break
-
-        history_message = await handle_message(bot, msg)
-
-        if not history_message:
-            continue
-
-        history.append(history_message)
-
-
-    history.reverse() # Hoffentlich nicht
-
-
-    return history
-
-
 async def handle_message(bot: commands.Bot, message: discord.Message) -> ChatHistoryMessage|None:
 
     role: Literal["user", "assistant"] = "assistant" if message.author == bot.user else "user"
@@ -73,7 +47,8 @@ async def handle_message(bot: commands.Bot, message: discord.Message) -> ChatHis
 
 async def handle_attachments(bot: commands.Bot, message: discord.Message) -> List[ChatHistoryFile]:
 
-    files: List[ChatHistoryFile] = []
+    files: List[ChatHistoryFile | None] = []
+    downloads: List[Tuple[int, Awaitable[ChatHistoryFileSaved]]] = []
 
     for attachment in message.attachments:
 
@@ -88,11 +63,13 @@ async def handle_attachments(bot: commands.Bot, message: discord.Message) -> Lis
                 "openai":  Config.OPENAI_VISION,
                 "ollama":  Config.OLLAMA_VISION,
             }
+            vision_configs["router"] = any(vision_configs.get(backend) for backend in Config.AI_BACKENDS)
 
             is_vision_enabled = vision_configs.get(Config.AI)
 
             if is_vision_enabled:
-                files.append(await save_file(bot, message, attachment))
+                downloads.append((len(files), save_file(bot, message, attachment)))
+                files.append(None)
             else:
                 logging.info("Add only Filename: %s", attachment)
                 files.append(ChatHistoryFile(attachment.filename, attachment.content_type))
@@ -100,28 +77,19 @@ async def handle_attachments(bot: commands.Bot, message: discord.Message) -> Lis
         else:
             logging.exception("No content type present: %s", attachment)
 
+    # Downloads run concurrently, the order of the attachments is kept
+    saved_files = await asyncio.gather(*[download for _, download in downloads])
+    for (index, _), saved_file in zip(downloads, saved_files):
+        files[index] = saved_file
+
     logging.info("Files: %s", files)
+    logging.info("Attachment Store: %s", attachment_store.stats())
 
     return files
 
 
 async def save_file(bot: commands.Bot, message: discord.Message, attachment: discord.Attachment) -> ChatHistoryFileSaved:
-
-    path = Config.DOWNLOAD_FOLDER / str(message.channel.id)
-    unique_filename = f"{message.id}-{attachment.filename}"
-
-    os.makedirs(Config.DOWNLOAD_FOLDER / str(message.channel.id), exist_ok=True)
-
-    file_bytes = await attachment.read()
-
-    if not file_bytes:
-        logging.exception("Empty attachment: %s", attachment)
-
-    chat_history_file = ChatHistoryFileSaved(attachment.filename, attachment.content_type, path / unique_filename)
-
-    await chat_history_file.save(file_bytes)
-
-    return chat_history_file
+    return await attachment_store.get(attachment)
 
 
 def get_queue_listener(bot: commands.Bot, message: discord.Message):
@@ -146,6 +114,9 @@ def get_queue_listener(bot: commands.Bot, message: discord.Message):
                     file = discord.File(io.BytesIO(event.value), filename=event.filename)
                     await message.channel.send(file=file)
 
+                elif isinstance(event, DiscordMessageStream):
+                    await tmp_controller.stream(event, clean_reply)
+
                 elif isinstance(event, DiscordMessageReply):
                     reply = clean_reply(event.value)
                     if not reply:
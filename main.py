@@ -1,3 +1,6 @@
+import time
+_startup_start = time.perf_counter()
+
 import asyncio
 import logging
 from typing import List
@@ -7,17 +10,23 @@ from discord.ext import commands
 from dotenv import load_dotenv
 
 from core.chat_history import ChatHistoryMessage
+from core.chat_store import chat_store
+from core.channel_scheduler import ChannelScheduler
 from core.config import Config
-from core.discord_messages import DiscordMessage, DiscordTemporaryMessagesController, DiscordMessageReplyTmpError
+from core.download_sweeper import download_sweeper
+from core.executors import shutdown_executors
+from core.discord_messages import DiscordMessage, DiscordTemporaryMessagesController, DiscordMessageReplyTmpError, DiscordMessageReply
 from core.external_help_bot import use_help_bot
-from core.instructions import get_instructions_from_discord_info
+from core.instructions import get_system_instructions
+from core.member_directory import member_directory
 from core.logging_config import setup_logging
-from core.message_handling import is_relevant_message, handle_messages, get_queue_listener, replace_instruction_patterns
-from providers.azure import AzureLLM
-from providers.gemini import GeminiLLM
-from providers.mistral import MistralLLM
-from providers.ollama import OllamaLLM
-from providers.openai import OpenAILLM
+from core.message_cache import DiscordMessageCache
+from core.message_handling import is_relevant_message, get_queue_listener
+from providers.registry import create_provider, import_times
+from providers.utils.admission import LLMBusyError
+from providers.utils.mcp_session_pool import mcp_session_pool
+
+_core_import_time = time.perf_counter() - _startup_start
 
 load_dotenv()
 
@@ -31,28 +40,39 @@ intents.messages = True
 intents.members = True
 intents.presences = True
 
-bot = commands.Bot(command_prefix="!", intents=intents)
+class DiscordBot(commands.Bot):
+
+    async def close(self):
+        try:
+            await llm.close()
+            await mcp_session_pool.close()
+            await chat_store.close()
+            await download_sweeper.close()
+            shutdown_executors()
+        except Exception as e:
+            logging.exception(f"Shutdown failed: {e}")
+        await super().close()
+
+
+bot = DiscordBot(command_prefix="!", intents=intents)
 
+message_cache = DiscordMessageCache(bot)
+channel_scheduler = ChannelScheduler()
 
-match Config.AI:
-    case "mistral":
-        llm = MistralLLM()
-    case "azure":
-        llm = AzureLLM()
-    case "gemini":
-        llm = GeminiLLM()
-    case "openai":
-        llm = OpenAILLM()
-    case "ollama":
-        llm = OllamaLLM()
-    case _:
-        raise ValueError("Invalid value for AI in the configuration")
 
+llm = create_provider(Config.AI) # Imports only the SDK of the configured backend
 
-async def call_ai(history: List[ChatHistoryMessage], instructions: ChatHistoryMessage, queue: asyncio.Queue[DiscordMessage|None], channel: str, use_help_bot: bool = True):
+startup_profile = {"core imports": _core_import_time, **import_times, "total": time.perf_counter() - _startup_start}
+print("⏱️ Startup: " + ", ".join(f"{name} {seconds:.2f}s" for name, seconds in startup_profile.items()))
+logging.info(f"STARTUP PROFILE: {startup_profile}")
+
+
+async def call_ai(history: List[ChatHistoryMessage], instructions: ChatHistoryMessage, queue: asyncio.Queue[DiscordMessage|None], channel: str, use_help_bot: bool = True, is_dm: bool = False):
     try:
         logging.info(llm)
-        await llm.call(history, instructions, queue, channel, use_help_bot)
+        await llm.call(history, instructions, queue, channel, use_help_bot, is_dm)
+    except LLMBusyError as e:
+        await queue.put(DiscordMessageReply(value=str(e)))
     except Exception as e:
         logging.exception(e, exc_info=True)
         await queue.put(DiscordMessageReplyTmpError(value=str(e)))
@@ -75,23 +95,18 @@ async def handle_message(message: discord.Message):
                 listener = get_queue_listener(bot, message)
 
 
-                history = await handle_messages(bot, message)
+                history = await message_cache.get_history(message)
                 logging.info(history)
 
 
                 channel_id = message.channel.id # message.author.display_name if isinstance(message.channel, discord.DMChannel) else message.channel.name
 
-                instructions = ChatHistoryMessage(role="system", content="")
-
-                instructions.content += get_instructions_from_discord_info(message)
-                instructions.content += Config.INSTRUCTIONS
-
-                instructions.content = replace_instruction_patterns(instructions.content)
+                instructions = await get_system_instructions(message)
 
                 logging.info(instructions)
 
                 task1 = asyncio.create_task(listener(queue, tmp_controller))
-                task2 = asyncio.create_task(call_ai(history, instructions, queue, str(channel_id), use_help_bot(message)))
+                task2 = asyncio.create_task(call_ai(history, instructions, queue, str(channel_id), use_help_bot(message), isinstance(message.channel, discord.DMChannel)))
 
                 await asyncio.gather(task1, task2)
 
@@ -100,8 +115,7 @@ async def handle_message(message: discord.Message):
                 await message.channel.send(str(e))
 
 
-@bot.event
-async def on_message(message: discord.Message):
+async def respond(message: discord.Message):
     try:
         await handle_message(message)
     except Exception as e:
@@ -109,9 +123,107 @@ async def on_message(message: discord.Message):
         await message.reply(f"Error: {e}")
 
 
+@bot.event
+async def on_message(message: discord.Message):
+    message_cache.add(message)
+
+    if message.author == bot.user or not is_relevant_message(bot, message):
+        return
+
+    await channel_scheduler.submit(message, respond)
+
+
+@bot.event
+async def on_raw_message_edit(payload: discord.RawMessageUpdateEvent):
+    message_cache.edit(payload.message)
+
+
+@bot.event
+async def on_raw_message_delete(payload: discord.RawMessageDeleteEvent):
+    message_cache.delete(payload.channel_id, [payload.message_id])
+
+
+@bot.event
+async def on_raw_bulk_message_delete(payload: discord.RawBulkMessageDeleteEvent):
+    message_cache.delete(payload.channel_id, payload.message_ids)
+
+
+@bot.event
+async def on_member_join(member: discord.Member):
+    member_directory.invalidate(member.guild)
+
+
+@bot.event
+async def on_member_remove(member: discord.Member):
+    member_directory.invalidate(member.guild)
+
+
+@bot.event
+async def on_member_update(before: discord.Member, after: discord.Member):
+    member_directory.invalidate(after.guild) # Roles or nickname
+
+
+@bot.event
+async def on_user_update(before: discord.User, after: discord.User):
+    for guild in after.mutual_guilds:
+        member_directory.invalidate(guild)
+
+
+@bot.event
+async def on_presence_update(before: discord.Member, after: discord.Member):
+    member_directory.presence_changed(before, after)
+
+
+@bot.event
+async def on_guild_role_update(before: discord.Role, after: discord.Role):
+    member_directory.invalidate(after.guild)
+
+
+@bot.event
+async def on_guild_role_delete(role: discord.Role):
+    member_directory.invalidate(role.guild)
+
+
+@bot.event
+async def on_guild_channel_update(before: discord.abc.GuildChannel, after: discord.abc.GuildChannel):
+    member_directory.invalidate(after.guild) # Permission overwrites
+
+
+@bot.event
+async def on_guild_update(before: discord.Guild, after: discord.Guild):
+    member_directory.invalidate(after)
+
+
+@bot.event
+async def on_thread_member_join(member: discord.ThreadMember):
+    member_directory.invalidate(member.thread.guild)
+
+
+@bot.event
+async def on_thread_member_remove(member: discord.ThreadMember):
+    member_directory.invalidate(member.thread.guild)
+
+
+@bot.event
+async def on_disconnect():
+    message_cache.invalidate() # Events during the disconnect may be lost
+    member_directory.invalidate_all()
+
+
+@bot.event
+async def on_resumed():
+    member_directory.invalidate_all() # Events missed before the resume are not replayed
+
+
 @bot.event
 async def on_ready():
     print(f"🤖 Bot online as {bot.user}!")
+
+    await chat_store.open()
+    download_sweeper.start()
+
+    if Config.MCP_SERVER_URL:
+        await mcp_session_pool.start()
     # Alle Cogs laden
     await bot.load_extension("cogs.commands")
     await bot.tree.sync()
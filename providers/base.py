@@ -2,13 +2,18 @@ import asyncio
 import importlib
 import logging
 import pkgutil
+from pathlib import Path
 from abc import ABC, abstractmethod
-from typing import Dict, List, TYPE_CHECKING, Type, Any, Tuple
+from typing import Dict, List, TYPE_CHECKING, Type, Any, Tuple, AsyncIterator, Literal
 
-from core.chat_history import ChatHistoryMessage, LLMToolCall, LLMResponse, ChatHistoryController
+from core.chat_history import ChatHistoryMessage, LLMToolCall, LLMResponse, ChatHistoryController, ChatHistoryFileSaved
+from core.chat_registry import ChatRegistry
 from core.config import Config
 from core.discord_messages import DiscordMessage
 from providers.utils import mcp_client_integrations
+from providers.utils.admission import AdmissionController, get_admission_controller
+from providers.utils.encoding_cache import encoded_file_cache
+from providers.utils.image_preprocessing import image_preprocessor, get_vision_profile
 
 if TYPE_CHECKING:
     from providers.utils.mcp_client_integrations.base import MCPIntegration
@@ -16,9 +21,20 @@ if TYPE_CHECKING:
 
 class BaseLLM(ABC):
 
+    provider: str
+    """Name of the backend as used in Config.AI"""
+    vision_payload: Literal["data_url", "bytes", "path"] = "data_url"
+    """How format_history_entry passes images, decides what prepare_vision_inputs preloads"""
+
     def __init__(self):
-        self.chats: Dict[str, ChatHistoryController] = {}
+        self.chats = ChatRegistry()
         self.mcp_client_integration_module: Type[MCPIntegration] = self.load_mcp_integration_class()
+        self.admission: AdmissionController = get_admission_controller(self.provider)
+
+
+    async def close(self) -> None:
+        """Releases the connections of the backend on shutdown"""
+        pass
 
 
     @classmethod
@@ -27,7 +43,7 @@ class BaseLLM(ABC):
         pass
 
     @abstractmethod
-    async def call(self, history: List[ChatHistoryMessage], instructions: ChatHistoryMessage, queue: asyncio.Queue[DiscordMessage | None], channel: str, use_help_bot=False):
+    async def call(self, history: List[ChatHistoryMessage], instructions: ChatHistoryMessage, queue: asyncio.Queue[DiscordMessage | None], channel: str, use_help_bot=False, is_dm=False):
         pass
 
 
@@ -35,6 +51,11 @@ class BaseLLM(ABC):
     async def generate(self, chat: ChatHistoryController, model_name: str | None = None, temperature: float | None = None, timeout: float | None = None, tools: List[Dict] | None = None) -> LLMResponse:
         pass
 
+    @abstractmethod
+    def generate_stream(self, chat: ChatHistoryController, model_name: str | None = None, temperature: float | None = None, timeout: float | None = None, tools: List[Dict] | None = None) -> AsyncIterator[LLMResponse]:
+        """Yields the text as LLMResponse deltas, tool calls are yielded once they are complete"""
+        pass
+
 
     @classmethod
     def load_mcp_integration_class(cls):
@@ -53,6 +74,46 @@ class BaseLLM(ABC):
         return MCPIntegration
 
 
+    async def prepare_vision_inputs(self, chat: ChatHistoryController) -> None:
+        """Downscales the images in the history before they are formatted"""
+
+        await image_preprocessor.prepare(chat.history, get_vision_profile(self.provider))
+
+        if self.vision_payload == "path": # Read by the client library
+            return
+
+        vision_inputs = {
+            vision_input
+            for message in chat.history for file in message.files
+            if isinstance(file, ChatHistoryFileSaved) and (vision_input := self.vision_input(file))
+        }
+
+        await asyncio.gather(*(
+            encoded_file_cache.preload(path, mime_type if self.vision_payload == "data_url" else None)
+            for path, mime_type in vision_inputs
+        ))
+
+    @classmethod
+    def vision_input(cls, file: ChatHistoryFileSaved) -> Tuple[Path, str] | None:
+        """Path and mime type of the (downscaled) image to send, None if the file is no vision input"""
+
+        profile = get_vision_profile(cls.provider)
+
+        if file.mime_type not in profile.mime_types or not file.full_path.exists(): # May be deleted by the download sweeper
+            return None
+
+        return image_preprocessor.lookup(file, profile)
+
+    @classmethod
+    def format_history(cls, history: List[ChatHistoryMessage]) -> List[Dict[str, Any]]:
+        """Provider payload of the history, only new or changed messages get formatted"""
+
+        return [cls.format_history_entry_cached(entry) for entry in history]
+
+    @classmethod
+    def format_history_entry_cached(cls, entry: ChatHistoryMessage) -> Dict[str, Any]:
+        return entry.formatted(cls, cls.format_history_entry)
+
     @classmethod
     @abstractmethod
     def format_history_entry(cls, entry: ChatHistoryMessage) -> Dict[str, Any]:
@@ -3,13 +3,15 @@ import json
 import random
 import string
 from abc import abstractmethod
-from typing import List, Dict, Any, Tuple
+from typing import List, Dict, Any, Tuple, AsyncIterator
 
 from core.chat_history import ChatHistoryMessage, ChatHistoryFile, ChatHistoryFileText, ChatHistoryController
 from core.config import Config
 from core.discord_messages import DiscordMessage, DiscordMessageReply
 from providers.base import LLMToolCall, LLMResponse, BaseLLM
+from providers.utils.admission import RequestPriority, current_slot
 from providers.utils.mcp_client import generate_with_mcp
+from providers.utils.streaming import stream_response
 
 
 class DefaultLLM(BaseLLM):
@@ -19,23 +21,40 @@ class DefaultLLM(BaseLLM):
         return ChatHistoryController()
 
 
-    async def call(self, history: List[ChatHistoryMessage], instructions: ChatHistoryMessage, queue: asyncio.Queue[DiscordMessage | None], channel: str, use_help_bot=False):
+    async def call(self, history: List[ChatHistoryMessage], instructions: ChatHistoryMessage, queue: asyncio.Queue[DiscordMessage | None], channel: str, use_help_bot=False, is_dm=False):
 
-        self.chats.setdefault(channel, await self.get_empty_history_controller())
+        async with self.chats.lease(channel, self.get_empty_history_controller) as chat: # Saved to the chat store afterwards
 
-        self.chats[channel].update(history, instructions)
+            await chat.prepare_token_counts(history, chat.tokenizer) # Memoized per message, update() only sums up
+            chat.update(history, instructions)
+            await self.prepare_vision_inputs(chat)
 
-        if Config.MCP_SERVER_URL:
-            await generate_with_mcp(self, self.chats[channel], queue, use_help_bot)
-        else:
-            response = await self.generate(self.chats[channel])
-            await queue.put(DiscordMessageReply(value=response.text))
+            priority = RequestPriority.create(is_dm, chat.count_tokens())
+
+            async with self.admission.slot(priority) as slot:
+
+                token = current_slot.set(slot)
+
+                try:
+                    if Config.MCP_SERVER_URL:
+                        await generate_with_mcp(self, chat, queue, use_help_bot, slot)
+                    elif Config.STREAMING:
+                        await stream_response(self, chat, queue)
+                    else:
+                        response = await self.generate(chat)
+                        await queue.put(DiscordMessageReply(value=response.text))
+                finally:
+                    current_slot.reset(token)
 
 
     @abstractmethod
     async def generate(self, chat: ChatHistoryController, model_name: str | None = None, temperature: float | None = None, timeout: float | None = None, tools: List[Dict] | None = None) -> LLMResponse:
         pass
 
+    @abstractmethod
+    def generate_stream(self, chat: ChatHistoryController, model_name: str | None = None, temperature: float | None = None, timeout: float | None = None, tools: List[Dict] | None = None) -> AsyncIterator[LLMResponse]:
+        pass
+
 
     @classmethod
     def format_history_entry(cls, entry: ChatHistoryMessage) -> Dict[str, Any]:
@@ -107,6 +126,31 @@ class DefaultLLM(BaseLLM):
         for tool_response in tool_responses:
             chat.history.append(ChatHistoryMessage(role="tool", tool_response=tool_response, is_temporary=True))
 
+    @staticmethod
+    def merge_tool_call_deltas(tool_call_deltas: Dict[int, Dict[str, Any]], deltas: List[Any]) -> None:
+        """Accumulates streamed OpenAI style tool call deltas by their index"""
+
+        for position, delta in enumerate(deltas):
+            index = delta.index if getattr(delta, "index", None) is not None else position
+            entry = tool_call_deltas.setdefault(index, {"id": "", "name": "", "arguments": ""})
+
+            if delta.id:
+                entry["id"] = delta.id
+            if delta.function:
+                if delta.function.name:
+                    entry["name"] += delta.function.name
+                if isinstance(delta.function.arguments, dict):
+                    entry["arguments"] = delta.function.arguments
+                elif delta.function.arguments:
+                    entry["arguments"] += delta.function.arguments
+
+    @staticmethod
+    def build_tool_calls(tool_call_deltas: Dict[int, Dict[str, Any]]) -> List[LLMToolCall]:
+        return [
+            LLMToolCall(id=entry["id"], name=entry["name"], arguments=entry["arguments"] if isinstance(entry["arguments"], dict) else json.loads(entry["arguments"] or "{}"))
+            for _, entry in sorted(tool_call_deltas.items())
+        ]
+
     @classmethod
     def extract_custom_tool_call(cls, text: str) -> LLMToolCall:
 
@@ -1,6 +1,5 @@
-import base64
 import logging
-from typing import List, Dict, Any
+from typing import List, Dict, Any, AsyncIterator, Tuple
 
 from google import genai
 from google.genai import types
@@ -10,20 +9,23 @@ from core.chat_history import ChatHistoryFileSaved, ChatHistoryMessage, ChatHist
 from core.config import Config
 from providers.base import LLMResponse, LLMToolCall
 from providers.default import DefaultLLM
+from providers.utils.encoding_cache import encoded_file_cache
+from providers.utils.prompt_cache import prompt_cache_metrics
 
 
 class GeminiLLM(DefaultLLM):
 
 
+    provider = "gemini"
+    vision_payload = "bytes"
+
     client = genai.Client(api_key=Config.GEMINI_API_KEY)
 
 
-    async def generate(self, chat: ChatHistoryController, model_name: str | None = None, temperature: float | None = None,
-                       timeout: float | None = None, tools: List[Dict] | None = None) -> LLMResponse:
+    def build_request(self, chat: ChatHistoryController, temperature: float | None = None, tools: List[Dict] | None = None) -> Tuple[List[Dict[str, Any]], types.GenerateContentConfig]:
 
-        model_name = model_name or Config.GEMINI_MODEL
-        messages = [self.format_history_entry(msg) for msg in chat.history]
-        system_instruction = self.format_history_entry(chat.system_entry) if chat.history else None
+        messages = self.format_history(chat.history)
+        system_instruction = self.format_history_entry_cached(chat.system_entry) if chat.history else None
         if system_instruction:
             messages = messages[1:]
 
@@ -36,12 +38,23 @@ class GeminiLLM(DefaultLLM):
 
         logging.info(config)
 
+        return messages, config
+
+
+    async def generate(self, chat: ChatHistoryController, model_name: str | None = None, temperature: float | None = None,
+                       timeout: float | None = None, tools: List[Dict] | None = None) -> LLMResponse:
+
+        model_name = model_name or Config.GEMINI_MODEL
+        messages, config = self.build_request(chat, temperature, tools)
+
         response = await self.client.aio.models.generate_content(
             model=model_name,
             contents=messages,
             config=config,
         )
 
+        self.record_usage(response.usage_metadata)
+
         message = response.text
 
         tool_calls = []
@@ -58,6 +71,42 @@ class GeminiLLM(DefaultLLM):
         return LLMResponse(message, tool_calls)
 
 
+    async def generate_stream(self, chat: ChatHistoryController, model_name: str | None = None, temperature: float | None = None,
+                              timeout: float | None = None, tools: List[Dict] | None = None) -> AsyncIterator[LLMResponse]:
+
+        model_name = model_name or Config.GEMINI_MODEL
+        messages, config = self.build_request(chat, temperature, tools)
+
+        stream = await self.client.aio.models.generate_content_stream(
+            model=model_name,
+            contents=messages,
+            config=config,
+        )
+
+        usage = None
+
+        async for chunk in stream:
+
+            usage = chunk.usage_metadata or usage # Complete in the last chunk
+
+            if not (chunk.candidates and chunk.candidates[0].content and chunk.candidates[0].content.parts):
+                continue
+
+            for part in chunk.candidates[0].content.parts:
+
+                if call := part.function_call:
+                    yield LLMResponse("", [LLMToolCall(id="", name=call.name, arguments=call.args)])
+                elif part.text and not part.thought:
+                    yield LLMResponse(part.text)
+
+        self.record_usage(usage)
+
+    @staticmethod
+    def record_usage(usage: types.GenerateContentResponseUsageMetadata | None) -> None:
+        if usage:
+            prompt_cache_metrics.record(usage.prompt_token_count, usage.cached_content_token_count) # Implicit caching
+
+
     @classmethod
     def format_history_entry(cls, entry: ChatHistoryMessage) -> Dict[str, Any]:
 
@@ -74,15 +123,12 @@ class GeminiLLM(DefaultLLM):
                     parts.append(types.Part.from_text(
                         text= f"<#File name=\"{file.name}\">{file.text_content}</File>"
                     ))
-                elif isinstance(file, ChatHistoryFileSaved) and file.mime_type in Config.GEMINI_VISION_MODEL_TYPES:
-                    logging.info(f"Using vision for {file}")
-                    with open(file.full_path, "rb") as f:
-                        # b64 = base64.b64encode(f.read()).decode("utf-8")
-                        data = f.read()
-
+                elif isinstance(file, ChatHistoryFileSaved) and (vision_input := cls.vision_input(file)):
+                    logging.debug(f"Using vision for {file}")
+                    path, mime_type = vision_input
                     parts.append(types.Part.from_bytes(
-                        data=data,
-                        mime_type=file.mime_type,
+                        data=encoded_file_cache.get_bytes(path),
+                        mime_type=mime_type,
                     ))
                 else:
                     parts.append(types.Part.from_text(
@@ -113,6 +159,6 @@ class GeminiLLM(DefaultLLM):
             "parts": parts,
         }
 
-        logging.info(formatted_entry)
+        logging.debug(formatted_entry)
 
         return formatted_entry # TODO ROLES
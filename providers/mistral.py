@@ -1,24 +1,26 @@
-import base64
 import json
 import logging
-from typing import List, Dict, Any
+from typing import List, Dict, Any, AsyncIterator
 
 from mistralai import Mistral
 
 from core.chat_history import ChatHistoryMessage, ChatHistoryFileSaved, ChatHistoryController
 from core.config import Config
 from providers.default import DefaultLLM, LLMResponse, LLMToolCall
+from providers.utils.encoding_cache import encoded_file_cache
 
 
 class MistralLLM(DefaultLLM):
 
+    provider = "mistral"
+
     client = Mistral(api_key=Config.MISTRAL_API_KEY)
 
     async def generate(self, chat: ChatHistoryController, model_name: str | None = None, temperature: float | None = None,
                        timeout: float | None = None, tools: List[Dict] | None = None) -> LLMResponse:
 
         model_name = model_name if model_name else Config.MISTRAL_MODEL
-        messages = [self.format_history_entry(msg) for msg in chat.history]
+        messages = self.format_history(chat.history)
 
 
         response = await self.client.chat.complete_async(
@@ -36,6 +38,37 @@ class MistralLLM(DefaultLLM):
 
         return LLMResponse(message.content, tool_calls)
 
+    async def generate_stream(self, chat: ChatHistoryController, model_name: str | None = None, temperature: float | None = None,
+                              timeout: float | None = None, tools: List[Dict] | None = None) -> AsyncIterator[LLMResponse]:
+
+        model_name = model_name if model_name else Config.MISTRAL_MODEL
+        messages = self.format_history(chat.history)
+
+        stream = await self.client.chat.stream_async(
+            model=model_name,
+            messages=messages,
+            temperature=temperature,
+            tools=tools,
+        )
+
+        tool_call_deltas = {}
+
+        async for event in stream:
+
+            if not event.data.choices:
+                continue
+
+            delta = event.data.choices[0].delta
+
+            if delta.tool_calls:
+                self.merge_tool_call_deltas(tool_call_deltas, delta.tool_calls)
+
+            if delta.content and isinstance(delta.content, str):
+                yield LLMResponse(delta.content)
+
+        if tool_call_deltas:
+            yield LLMResponse("", self.build_tool_calls(tool_call_deltas))
+
 
     @classmethod
     def add_error_message(cls, chat: ChatHistoryController, message: str):
@@ -46,21 +79,16 @@ class MistralLLM(DefaultLLM):
         formatted_entry = super().format_history_entry(entry)
 
         for file in entry.files:
-            logging.info(file)
             if isinstance(file, ChatHistoryFileSaved):
-                logging.info(f"Found saved file entry in history: {file}")
-                if file.mime_type in Config.AZURE_OPENAI_VISION_MODEL_TYPES:
-                    logging.info(f"Is image")
-                    with open(file.full_path, "rb") as f:
-                        b64 = base64.b64encode(f.read()).decode("utf-8")
-
-                        formatted_entry["content"].append({
-                            "type": "image_url",
-                            "image_url": {
-                                "url": f"data:{file.mime_type};base64,{b64}",
-                            }
-                        })
-
-        logging.info(formatted_entry)
+                logging.debug(f"Found saved file entry in history: {file}")
+                if vision_input := cls.vision_input(file):
+                    formatted_entry["content"].append({
+                        "type": "image_url",
+                        "image_url": {
+                            "url": encoded_file_cache.get_data_url(*vision_input),
+                        }
+                    })
+
+        logging.debug(formatted_entry)
 
         return formatted_entry
\ No newline at end of file
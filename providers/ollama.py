@@ -2,8 +2,10 @@ import asyncio
 import logging
 import random
 import string
-from typing import List, Dict, Literal, Any, Tuple
+from contextlib import nullcontext
+from typing import List, Dict, Literal, Any, Tuple, AsyncIterator
 
+import httpx
 from ollama import AsyncClient
 
 from core.chat_history import ChatHistoryMessage, ChatHistoryFileSaved, ChatHistoryFile, ChatHistoryFileText, \
@@ -11,62 +13,99 @@ from core.chat_history import ChatHistoryMessage, ChatHistoryFileSaved, ChatHist
 from core.config import Config
 from core.discord_messages import DiscordMessage
 from providers.default import DefaultLLM, LLMResponse, LLMToolCall
-from providers.utils.vram import wait_for_vram
+from providers.utils.vram import vram_monitor
 
-class ChatHistoryControllerOllama(ChatHistoryController):
 
-    client: AsyncClient
+_clients: Dict[str, AsyncClient] = {}
 
-    def __init__(self, client: AsyncClient):
-        super().__init__()
 
-        self.client = client
+def get_ollama_client(host: str | None = None) -> AsyncClient:
+    """One keep-alive connection pool per Ollama host, shared by all channels"""
+
+    host = host if host else Config.OLLAMA_URL
+
+    if host not in _clients:
+        _clients[host] = AsyncClient(
+            host=host,
+            limits=httpx.Limits(max_connections=Config.OLLAMA_MAX_CONNECTIONS, max_keepalive_connections=Config.OLLAMA_MAX_KEEPALIVE_CONNECTIONS),
+        )
+        logging.info(f"Created Ollama client for {host}")
+
+    return _clients[host]
+
+
+async def close_ollama_clients() -> None:
+
+    while _clients:
+        host, client = _clients.popitem()
+        await client._client.aclose() # The underlying httpx.AsyncClient
+        logging.info(f"Closed Ollama client for {host}")
 
 
 class OllamaLLM(DefaultLLM):
 
-    @classmethod
-    async def get_empty_history_controller(cls) -> ChatHistoryController:
-        return ChatHistoryControllerOllama(AsyncClient(host=Config.OLLAMA_URL))
+    provider = "ollama"
+    vision_payload = "path"
 
+    @property
+    def client(self) -> AsyncClient:
+        return get_ollama_client(Config.OLLAMA_URL)
 
-    async def generate(self, chat: ChatHistoryControllerOllama, model_name: str | None = None, temperature: str | None = None, think: bool | Literal["low", "medium", "high"] | None = None, keep_alive: str | float | None = None, timeout: float | None = None, tools: List[Dict] | None = None) -> LLMResponse:
+    async def close(self) -> None:
+        await close_ollama_clients()
 
-        if Config.OLLAMA_REQUIRED_VRAM_IN_GB:
-            await wait_for_vram(required_gb=Config.OLLAMA_REQUIRED_VRAM_IN_GB, timeout=Config.OLLAMA_WAIT_FOR_REQUIRED_VRAM)
-        else:
-            logging.warning("Waiting for VRAM is disabled")
+    async def build_request(self, chat: ChatHistoryController, model_name: str | None = None, temperature: str | None = None, think: bool | Literal["low", "medium", "high"] | None = None, keep_alive: str | float | None = None, tools: List[Dict] | None = None) -> Dict[str, Any]:
 
         model_name = model_name if model_name else Config.OLLAMA_MODEL
-        messages = [self.format_history_entry(msg) for msg in chat.history]
+        messages = self.format_history(chat.history)
         temperature = temperature if temperature else Config.OLLAMA_MODEL_TEMPERATURE
         think = think if think else Config.OLLAMA_THINK
         keep_alive = keep_alive if keep_alive else Config.OLLAMA_KEEP_ALIVE
-        timeout = timeout if timeout else Config.OLLAMA_TIMEOUT
 
-        logging.info(messages)
-        logging.info(chat.client)
+        logging.debug(messages)
+
+        return {
+            "model": model_name,
+            "messages": messages,
+            "keep_alive": keep_alive,
+            "options": {
+                **({"temperature": temperature} if temperature is not None else {})
+            },
+            **({"think": think} if think is not None else {}),
+            **({"tools": tools} if tools is not None else {}),
+        }
+
+    @staticmethod
+    def reserve_vram():
+        """Holds the required VRAM back from other requests while the model loads and generates"""
+
+        if not Config.OLLAMA_REQUIRED_VRAM_IN_GB:
+            logging.warning("Waiting for VRAM is disabled")
+            return nullcontext()
+
+        return vram_monitor.reserve(required_gb=Config.OLLAMA_REQUIRED_VRAM_IN_GB, timeout=Config.OLLAMA_WAIT_FOR_REQUIRED_VRAM)
+
+    @staticmethod
+    def convert_tool_calls(tool_calls) -> List[LLMToolCall]:
+        return [LLMToolCall(id=''.join(random.choices(string.digits, k=9)), name=t.function.name, arguments=dict(t.function.arguments)) for t in tool_calls] if tool_calls else []
+
+
+    async def generate(self, chat: ChatHistoryController, model_name: str | None = None, temperature: str | None = None, think: bool | Literal["low", "medium", "high"] | None = None, keep_alive: str | float | None = None, timeout: float | None = None, tools: List[Dict] | None = None) -> LLMResponse:
+
+        request = await self.build_request(chat, model_name, temperature, think, keep_alive, tools)
+        timeout = timeout if timeout else Config.OLLAMA_TIMEOUT
 
         try:
 
-            response = await asyncio.wait_for(
-                chat.client.chat(
-                    model=model_name,
-                    messages=messages,
-                    stream=False,
-                    keep_alive=keep_alive,
-                    options={
-                        **({"temperature": temperature} if temperature is not None else {})
-                    },
-                    **({"think": think} if think is not None else {}),
-                    **({"tools": tools} if tools is not None else {}),
-                ),
-                timeout=timeout,
-            )
+            async with self.reserve_vram():
+                response = await asyncio.wait_for(
+                    self.client.chat(**request, stream=False),
+                    timeout=timeout,
+                )
 
             logging.info(response)
 
-            tool_calls = [LLMToolCall(id=''.join(random.choices(string.digits, k=9)), name=t.function.name, arguments=dict(t.function.arguments)) for t in response.message.tool_calls] if response.message.tool_calls else []
+            tool_calls = self.convert_tool_calls(response.message.tool_calls)
 
             return LLMResponse(text=response.message.content, tool_calls=tool_calls)
 
@@ -75,6 +114,30 @@ class OllamaLLM(DefaultLLM):
             logging.error(e, exc_info=True)
             raise Exception(f"Ollama Error: {e}")
 
+
+    async def generate_stream(self, chat: ChatHistoryController, model_name: str | None = None, temperature: str | None = None, think: bool | Literal["low", "medium", "high"] | None = None, keep_alive: str | float | None = None, timeout: float | None = None, tools: List[Dict] | None = None) -> AsyncIterator[LLMResponse]:
+
+        request = await self.build_request(chat, model_name, temperature, think, keep_alive, tools)
+        timeout = timeout if timeout else Config.OLLAMA_TIMEOUT
+
+        try:
+
+            async with self.reserve_vram(), asyncio.timeout(timeout):
+
+                stream = await self.client.chat(**request, stream=True)
+
+                async for part in stream:
+
+                    if part.message.tool_calls:
+                        yield LLMResponse("", self.convert_tool_calls(part.message.tool_calls))
+
+                    if part.message.content:
+                        yield LLMResponse(part.message.content)
+
+        except Exception as e:
+            logging.error(e, exc_info=True)
+            raise Exception(f"Ollama Error: {e}")
+
     @classmethod
     def add_tool_call_results_message(cls, chat: ChatHistoryController, tool_responses: [Tuple[LLMToolCall, str]]) -> None:
 
@@ -108,9 +171,9 @@ class OllamaLLM(DefaultLLM):
             if isinstance(file, ChatHistoryFile):
                 if isinstance(file, ChatHistoryFileText):
                     content += f"\n<#File name=\"{file.name}\">{file.text_content}</File>"
-                elif isinstance(file, ChatHistoryFileSaved) and file.mime_type in Config.OLLAMA_VISION_MODEL_TYPES:
-                    logging.info(f"Found saved image entry in history: {file}")
-                    images.append(file.full_path)
+                elif isinstance(file, ChatHistoryFileSaved) and (vision_input := cls.vision_input(file)):
+                    logging.debug(f"Found saved image entry in history: {file}")
+                    images.append(vision_input[0])
                     content += f"\n<#Image name=\"{file.name}\">"
                 else:
                     content += f"\n<#File name=\"{file.name}\">"
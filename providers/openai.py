@@ -1,19 +1,22 @@
-import base64
 import json
 import logging
-from typing import List, Dict, Any
+from typing import List, Dict, Any, AsyncIterator
 
-from openai import AsyncOpenAI
+from openai import AsyncOpenAI, omit
 
 from core.chat_history import ChatHistoryFileSaved, ChatHistoryMessage, ChatHistoryController
 from core.config import Config
 from providers.base import LLMResponse, LLMToolCall
 from providers.default import DefaultLLM
+from providers.utils.encoding_cache import encoded_file_cache
+from providers.utils.prompt_cache import record_openai_usage, get_prompt_cache_key
 
 
 class OpenAILLM(DefaultLLM):
 
 
+    provider = "openai"
+
     client = AsyncOpenAI(
         api_key=Config.OPENAI_API_KEY,
     )
@@ -22,16 +25,19 @@ class OpenAILLM(DefaultLLM):
                        timeout: float | None = None, tools: List[Dict] | None = None) -> LLMResponse:
 
         model_name = model_name or Config.OPENAI_MODEL
-        messages = [self.format_history_entry(msg) for msg in chat.history]
+        messages = self.format_history(chat.history)
 
 
         completion = await self.client.chat.completions.create(
             model=model_name,
             messages=messages,
             temperature=temperature,
-            tools=tools
+            tools=tools,
+            prompt_cache_key=get_prompt_cache_key(chat) or omit,
         )
 
+        record_openai_usage(completion.usage)
+
         message = completion.choices[0].message
 
         tool_calls = []
@@ -43,27 +49,59 @@ class OpenAILLM(DefaultLLM):
 
         return LLMResponse(message.content, tool_calls)
 
+    async def generate_stream(self, chat: ChatHistoryController, model_name: str | None = None, temperature: float | None = None,
+                              timeout: float | None = None, tools: List[Dict] | None = None) -> AsyncIterator[LLMResponse]:
+
+        model_name = model_name or Config.OPENAI_MODEL
+        messages = self.format_history(chat.history)
+
+        stream = await self.client.chat.completions.create(
+            model=model_name,
+            messages=messages,
+            temperature=temperature,
+            tools=tools,
+            stream=True,
+            stream_options={"include_usage": True},
+            prompt_cache_key=get_prompt_cache_key(chat) or omit,
+        )
+
+        tool_call_deltas = {}
+
+        async for chunk in stream:
+
+            if chunk.usage: # Sent with the last chunk
+                record_openai_usage(chunk.usage)
+
+            if not chunk.choices:
+                continue
+
+            delta = chunk.choices[0].delta
+
+            if delta.tool_calls:
+                self.merge_tool_call_deltas(tool_call_deltas, delta.tool_calls)
+
+            if delta.content:
+                yield LLMResponse(delta.content)
+
+        if tool_call_deltas:
+            yield LLMResponse("", self.build_tool_calls(tool_call_deltas))
+
 
     @classmethod
     def format_history_entry(cls, entry: ChatHistoryMessage) -> Dict[str, Any]:
         formatted_entry = super().format_history_entry(entry)
 
         for file in entry.files:
-            logging.info(file)
             if isinstance(file, ChatHistoryFileSaved):
-                logging.info(f"Found saved file entry in history: {file}")
-                if file.mime_type in Config.AZURE_OPENAI_VISION_MODEL_TYPES:
-                    logging.info(f"Is image")
-                    with open(file.full_path, "rb") as f:
-                        b64 = base64.b64encode(f.read()).decode("utf-8")
-
-                        formatted_entry["content"].append({
-                            "type": "image_url",
-                            "image_url": {
-                                "url": f"data:{file.mime_type};base64,{b64}",
-                            }
-                        })
-
-        logging.info(formatted_entry)
+                logging.debug(f"Found saved file entry in history: {file}")
+                if vision_input := cls.vision_input(file):
+                    formatted_entry["content"].append({
+                        "type": "image_url",
+                        "image_url": {
+                            "url": encoded_file_cache.get_data_url(*vision_input),
+                        }
+                    })
+
+        logging.debug(formatted_entry)
 
         return formatted_entry
@@ -0,0 +1,66 @@
+import importlib
+import logging
+import time
+from dataclasses import dataclass
+from typing import Dict, List, Type, TYPE_CHECKING
+
+from core.config import Config
+
+if TYPE_CHECKING:
+    from providers.base import BaseLLM
+
+
+@dataclass(frozen=True)
+class ProviderSpec:
+    class_path: str
+    """Module and class name, the module is only imported when the backend is used"""
+    required_env: List[str]
+
+
+PROVIDERS: Dict[str, ProviderSpec] = {
+    "mistral": ProviderSpec("providers.mistral.MistralLLM", ["MISTRAL_MODEL", "MISTRAL_VISION_MODEL_TYPES"]),
+    "azure":   ProviderSpec("providers.azure.AzureLLM", ["AZURE_OPENAI_API_VERSION", "AZURE_OPENAI_ENDPOINT", "AZURE_OPENAI_MODEL", "AZURE_OPENAI_VISION_MODEL_TYPES"]),
+    "gemini":  ProviderSpec("providers.gemini.GeminiLLM", ["GEMINI_ENDPOINT", "GEMINI_MODEL", "GEMINI_VISION_MODEL_TYPES"]),
+    "openai":  ProviderSpec("providers.openai.OpenAILLM", ["OPENAI_MODEL", "OPENAI_VISION_MODEL_TYPES"]),
+    "ollama":  ProviderSpec("providers.ollama.OllamaLLM", ["OLLAMA_URL", "OLLAMA_MODEL", "OLLAMA_VISION_MODEL_TYPES", "OLLAMA_WAIT_FOR_REQUIRED_VRAM"]),
+    "router":  ProviderSpec("providers.router.RouterLLM", ["AI_BACKENDS"]),
+}
+
+import_times: Dict[str, float] = {}
+"""Seconds needed to import (and construct) each loaded backend"""
+
+
+def load_provider_class(name: str) -> Type["BaseLLM"]:
+
+    spec = PROVIDERS.get(name)
+
+    if not spec:
+        raise ValueError("Invalid value for AI in the configuration")
+
+    Config.require_envs(spec.required_env)
+
+    module_name, class_name = spec.class_path.rsplit(".", 1)
+
+    start = time.perf_counter()
+    module = importlib.import_module(module_name)
+    import_times[module_name] = time.perf_counter() - start
+
+    logging.info(f"Imported {module_name} in {import_times[module_name]:.3f}s")
+
+    return getattr(module, class_name)
+
+
+def create_provider(name: str) -> "BaseLLM":
+
+    provider_class = load_provider_class(name)
+
+    if name == "router":
+        if "router" in Config.AI_BACKENDS:
+            raise ValueError("The router can not be one of its own AI_BACKENDS")
+        backends = [create_provider(backend) for backend in Config.AI_BACKENDS]
+
+    start = time.perf_counter()
+    llm = provider_class(backends) if name == "router" else provider_class()
+    import_times[f"{provider_class.__name__}()"] = time.perf_counter() - start
+
+    return llm
@@ -0,0 +1,265 @@
+import asyncio
+import logging
+import statistics
+import time
+from collections import deque
+from contextlib import AsyncExitStack
+from typing import List, Dict, AsyncIterator, Callable, Awaitable, TypeVar, Deque, Tuple
+
+from core.chat_history import ChatHistoryController
+from core.config import Config
+from providers.base import BaseLLM
+from providers.default import DefaultLLM, LLMResponse
+from providers.utils.admission import AdmissionController, RequestPriority, LLMBusyError, current_slot
+
+T = TypeVar("T")
+
+WINDOW = 50
+"""Requests per backend in the rolling latency and error window"""
+MIN_SAMPLES = 10
+"""Latency samples needed before percentiles are used for ranking and hedging"""
+ERROR_PENALTY = 10
+"""Seconds added to the ranking latency per error rate, e.g. 2s at 20% errors"""
+
+
+class BackendState:
+    """Rolling latency and error window of one backend"""
+
+    def __init__(self, llm: BaseLLM, window: int = WINDOW):
+        self.llm = llm
+        self.latencies: Dict[str, Deque[float]] = {"generate": deque(maxlen=window), "stream": deque(maxlen=window)}
+        """Full response time for generate, time to the first chunk for streams"""
+        self.errors: Deque[bool] = deque(maxlen=window)
+        self.consecutive_errors = 0
+        self.down_until = 0
+
+        self.requests = 0
+        self.hedges = 0
+        self.wins = 0
+
+    @property
+    def name(self) -> str:
+        return self.llm.provider
+
+    def record(self, kind: str, latency: float) -> None:
+        self.latencies[kind].append(latency)
+        self.errors.append(False)
+        self.consecutive_errors = 0
+
+    def record_error(self) -> None:
+        self.errors.append(True)
+        self.consecutive_errors += 1
+
+        if self.consecutive_errors >= Config.ROUTER_MAX_CONSECUTIVE_ERRORS:
+            self.down_until = time.monotonic() + Config.ROUTER_COOLDOWN
+            logging.warning(f"ROUTER: {self.name} is down for {Config.ROUTER_COOLDOWN}s after {self.consecutive_errors} errors")
+
+    def error_rate(self) -> float:
+        return sum(self.errors) / len(self.errors) if self.errors else 0
+
+    def percentile(self, kind: str, q: int) -> float | None:
+
+        latencies = self.latencies[kind]
+
+        if len(latencies) < MIN_SAMPLES:
+            return None
+
+        return statistics.quantiles(latencies, n=100, method="inclusive")[q - 1]
+
+    @property
+    def saturated(self) -> bool:
+        return self.llm.admission.active >= self.llm.admission.max_concurrent
+
+    def score(self, kind: str, neutral: float) -> Tuple[bool, bool, float]:
+        """Lower is better, backends in cooldown come last and backends without a free slot after the others.
+        Unmeasured backends rank with the neutral latency"""
+
+        p50 = self.percentile(kind, 50)
+        return time.monotonic() < self.down_until, self.saturated, (p50 if p50 is not None else neutral) + ERROR_PENALTY * self.error_rate()
+
+    def stats(self) -> Dict[str, int | float | None]:
+        p50, p95 = self.percentile("generate", 50), self.percentile("generate", 95)
+        ttft_p50, ttft_p95 = self.percentile("stream", 50), self.percentile("stream", 95)
+        return {
+            "requests": self.requests,
+            "wins": self.wins,
+            "hedges": self.hedges,
+            "error_rate": round(self.error_rate(), 3),
+            "p50": round(p50, 3) if p50 else None,
+            "p95": round(p95, 3) if p95 else None,
+            "ttft_p50": round(ttft_p50, 3) if ttft_p50 else None,
+            "ttft_p95": round(ttft_p95, 3) if ttft_p95 else None,
+        }
+
+
+class RouterLLM(DefaultLLM):
+    """Routes each generation to the best of several backends.
+
+    Backends are ranked by their rolling median latency plus a penalty for their error rate, backends
+    without enough samples yet rank like the fastest measured one. On an
+    error the next backend is tried. With ROUTER_HEDGING a second backend is started when the
+    first has not answered (or streamed its first chunk) within its p95 latency, the slower one
+    is cancelled. Only the first response of a request is hedged, tool iterations and calls outside
+    of a request are not. Requests are shed by the router's own admission, each backend keeps its
+    limits and is queued for with the priority of the request without shedding again. Backends
+    with a free slot are preferred, a busy backend is skipped without counting as an error. The
+    history is kept in the generic format of DefaultLLM and formatted by the selected backend."""
+
+    provider = "router"
+
+    def __init__(self, backends: List[BaseLLM]):
+        super().__init__()
+
+        if not backends:
+            raise ValueError("The router needs at least one backend in AI_BACKENDS")
+
+        self.backends = [BackendState(backend) for backend in backends]
+        self.admission = AdmissionController(
+            name=self.provider,
+            max_concurrent=sum(backend.admission.max_concurrent for backend in backends),
+            max_queue_wait=Config.LLM_MAX_QUEUE_WAIT,
+        )
+
+    async def close(self) -> None:
+        for state in self.backends:
+            await state.llm.close()
+
+    async def prepare_vision_inputs(self, chat: ChatHistoryController) -> None:
+        await asyncio.gather(*(state.llm.prepare_vision_inputs(chat) for state in self.backends))
+
+    def ranked(self, kind: str) -> List[BackendState]:
+
+        measured = [p50 for state in self.backends if (p50 := state.percentile(kind, 50)) is not None]
+        neutral = min(measured, default=0)
+
+        return sorted(self.backends, key=lambda state: state.score(kind, neutral)) # Stable, ties keep the configured order
+
+    @staticmethod
+    def request_priority() -> RequestPriority:
+        """Priority of the request being served, including its tool iterations"""
+
+        slot = current_slot.get()
+        return slot.priority if slot else RequestPriority()
+
+    @staticmethod
+    def is_latency_critical() -> bool:
+        """The first response of a request, somebody waits for it"""
+
+        slot = current_slot.get()
+        return slot is not None and slot.priority.tool_iteration == 0
+
+    async def route(self, kind: str, attempt: Callable[[BaseLLM], Awaitable[T]], discard: Callable[[T], Awaitable[None]] | None = None, hedge: bool = False) -> T:
+        """Runs the attempt on the best backend, fails over on errors and hedges slow attempts if hedge is set.
+        Results of attempts that finished but lost are passed to discard"""
+
+        candidates = self.ranked(kind)
+        running: Dict[asyncio.Task, BackendState] = {}
+        errors: List[Exception] = []
+
+        async def measure(state: BackendState) -> T:
+            state.requests += 1
+            start = time.monotonic()
+            try:
+                result = await attempt(state.llm)
+            except asyncio.CancelledError:
+                raise # Lost against a hedged request, no error of the backend
+            except LLMBusyError:
+                raise # Load, no error of the backend
+            except Exception:
+                state.record_error()
+                raise
+            state.record(kind, time.monotonic() - start)
+            return result
+
+        def launch() -> None:
+            state = candidates.pop(0)
+            running[asyncio.create_task(measure(state))] = state
+
+        try:
+            while candidates or running:
+
+                if not running:
+                    launch()
+
+                timeout = None
+                if hedge and candidates and len(running) == 1:
+                    primary = next(iter(running.values()))
+                    timeout = primary.percentile(kind, 95)
+
+                done, _ = await asyncio.wait(running, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+
+                if not done: # Slower than usual, hedge with the next backend
+                    primary.hedges += 1
+                    logging.info(f"ROUTER: {primary.name} exceeded its p95 of {timeout:.2f}s, hedging with {candidates[0].name}")
+                    launch()
+                    continue
+
+                for task in done:
+                    state = running.pop(task)
+
+                    if task.exception() is None:
+                        state.wins += 1
+                        logging.info(f"ROUTER: Answered by {state.name}: {self.stats()}")
+                        return task.result()
+
+                    errors.append(task.exception())
+                    logging.warning(f"ROUTER: {state.name} failed, trying the next backend: {task.exception()}")
+
+            raise errors[-1] if errors else RuntimeError("No backend available")
+
+        finally:
+            for task in running:
+                task.cancel()
+            results = await asyncio.gather(*running, return_exceptions=True)
+
+            if discard:
+                for result in results:
+                    if not isinstance(result, BaseException):
+                        await discard(result)
+
+    async def generate(self, chat: ChatHistoryController, model_name: str | None = None, temperature: float | None = None,
+                       timeout: float | None = None, tools: List[Dict] | None = None) -> LLMResponse:
+
+        priority = self.request_priority()
+
+        async def attempt(llm: BaseLLM) -> LLMResponse:
+            async with llm.admission.slot(priority, shed=False): # Already admitted by the router
+                return await llm.generate(chat, temperature=temperature, timeout=timeout, tools=tools)
+
+        return await self.route("generate", attempt, hedge=Config.ROUTER_HEDGING and self.is_latency_critical())
+
+    async def generate_stream(self, chat: ChatHistoryController, model_name: str | None = None, temperature: float | None = None,
+                              timeout: float | None = None, tools: List[Dict] | None = None) -> AsyncIterator[LLMResponse]:
+
+        priority = self.request_priority()
+
+        async def attempt(llm: BaseLLM) -> Tuple[AsyncExitStack, AsyncIterator[LLMResponse], LLMResponse | None]:
+            """Opens the stream and waits for its first chunk, the stack holds the admission slot and the stream"""
+
+            stack = AsyncExitStack()
+            try:
+                await stack.enter_async_context(llm.admission.slot(priority, shed=False))
+                stream = llm.generate_stream(chat, temperature=temperature, timeout=timeout, tools=tools)
+                stack.push_async_callback(stream.aclose)
+                return stack, stream, await anext(stream, None)
+            except BaseException:
+                await stack.aclose()
+                raise
+
+        async def discard(result: Tuple[AsyncExitStack, AsyncIterator[LLMResponse], LLMResponse | None]) -> None:
+            await result[0].aclose()
+
+        stack, stream, first = await self.route("stream", attempt, discard, hedge=Config.ROUTER_HEDGING and self.is_latency_critical())
+
+        async with stack:
+
+            if first is None:
+                return
+
+            yield first
+
+            async for chunk in stream:
+                yield chunk
+
+    def stats(self) -> Dict[str, Dict[str, int | float | None]]:
+        return {state.name: state.stats() for state in self.backends}
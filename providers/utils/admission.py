@@ -0,0 +1,185 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import time
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from typing import Dict, List, Tuple
+
+from core.config import Config
+
+
+class LLMBusyError(Exception):
+    """Raised when a request would have to wait longer than LLM_MAX_QUEUE_WAIT"""
+
+    def __init__(self, estimated_wait: float):
+        self.estimated_wait = estimated_wait
+
+        match Config.LANGUAGE:
+            case "de":
+                message = "Ich bin gerade ausgelastet, bitte versuche es gleich noch einmal."
+            case _:
+                message = "I'm busy right now, please try again in a moment."
+
+        super().__init__(message)
+
+
+@dataclass(order=True)
+class RequestPriority:
+    """Lower values are admitted first: short tool loops, DMs and short prompts"""
+
+    tool_iteration: int = 0
+    channel_class: int = 1
+    """0 for direct messages, 1 for guild channels"""
+    prompt_size_class: int = 0
+
+    @classmethod
+    def create(cls, is_dm: bool, prompt_tokens: int) -> "RequestPriority":
+        return cls(channel_class=0 if is_dm else 1, prompt_size_class=prompt_tokens // 1000)
+
+
+@dataclass
+class AdmissionSlot:
+    controller: "AdmissionController"
+    priority: RequestPriority
+    yielded_time: float = 0
+    held: bool = True
+    _paused_at: float = 0
+
+    def pause(self) -> None:
+        """Frees the slot while the LLM is not needed (e.g. while tools run)"""
+
+        if self.held:
+            self.controller.release()
+            self.held = False
+            self._paused_at = time.monotonic()
+
+    async def resume(self) -> None:
+        """Queues again for the slot, one tool iteration later than before"""
+
+        if not self.held:
+            self.priority = RequestPriority(self.priority.tool_iteration + 1, self.priority.channel_class, self.priority.prompt_size_class)
+            await self.controller.acquire(self.priority, shed=False)
+            self.held = True
+            self.yielded_time += time.monotonic() - self._paused_at
+
+
+current_slot: ContextVar[AdmissionSlot | None] = ContextVar("current_slot", default=None)
+"""Slot of the request the current task serves, e.g. so the router queues at its backends with the same priority"""
+
+
+@dataclass
+class AdmissionController:
+    """Bounds the concurrent LLM requests of one provider with a priority queue and load shedding"""
+
+    name: str
+    max_concurrent: int
+    max_queue_wait: float | None = None
+
+    active: int = 0
+    admitted: int = 0
+    shed: int = 0
+    avg_wait: float = 0
+    avg_service_time: float = 0
+    _waiters: List[Tuple[RequestPriority, int, asyncio.Future]] = field(default_factory=list)
+    _counter: itertools.count = field(default_factory=itertools.count)
+
+    def estimated_wait(self) -> float:
+        if self.active < self.max_concurrent and not self._waiters:
+            return 0
+        return self.avg_service_time * (len(self._waiters) + 1) / self.max_concurrent
+
+    async def acquire(self, priority: RequestPriority, shed: bool = True) -> None:
+
+        start = time.monotonic()
+
+        if self.active < self.max_concurrent and not self._waiters:
+            self.active += 1
+        else:
+            estimated_wait = self.estimated_wait()
+            if shed and self.max_queue_wait is not None and estimated_wait > self.max_queue_wait:
+                self.shed += 1
+                logging.warning(f"ADMISSION {self.name}: Shedding request, estimated wait {estimated_wait:.1f}s: {self.stats()}")
+                raise LLMBusyError(estimated_wait)
+
+            future = asyncio.get_running_loop().create_future()
+            heapq.heappush(self._waiters, (priority, next(self._counter), future))
+            logging.info(f"ADMISSION {self.name}: Queued with {priority}: {self.stats()}")
+
+            try:
+                await future # The slot is handed over by release()
+            except asyncio.CancelledError:
+                if future.done() and not future.cancelled():
+                    self.release()
+                else:
+                    self._waiters = [w for w in self._waiters if w[2] is not future]
+                    heapq.heapify(self._waiters)
+                raise
+
+        waited = time.monotonic() - start
+        self.avg_wait = 0.9 * self.avg_wait + 0.1 * waited
+        self.admitted += 1
+
+    def release(self) -> None:
+
+        while self._waiters:
+            _, _, future = heapq.heappop(self._waiters)
+            if not future.done():
+                future.set_result(None) # Slot stays active for the waiter
+                return
+
+        self.active -= 1
+
+    @asynccontextmanager
+    async def slot(self, priority: RequestPriority, shed: bool = True):
+
+        await self.acquire(priority, shed)
+        slot = AdmissionSlot(self, priority)
+        start = time.monotonic()
+
+        try:
+            yield slot
+        finally:
+            if slot.held:
+                self.release()
+            service_time = time.monotonic() - start - slot.yielded_time
+            self.avg_service_time = 0.9 * self.avg_service_time + 0.1 * service_time if self.avg_service_time else service_time
+            logging.info(f"ADMISSION {self.name}: Released: {self.stats()}")
+
+    def stats(self) -> Dict[str, int | float]:
+        return {
+            "active": self.active,
+            "queued": len(self._waiters),
+            "max_concurrent": self.max_concurrent,
+            "admitted": self.admitted,
+            "shed": self.shed,
+            "avg_wait": round(self.avg_wait, 3),
+            "avg_service_time": round(self.avg_service_time, 3),
+        }
+
+
+_controllers: Dict[str, AdmissionController] = {}
+
+
+def get_admission_controller(provider: str) -> AdmissionController:
+    """One shared controller per provider"""
+
+    if provider not in _controllers:
+
+        max_concurrent_configs = {
+            "mistral": Config.MISTRAL_MAX_CONCURRENT_CALLS,
+            "azure":   Config.AZURE_OPENAI_MAX_CONCURRENT_CALLS,
+            "gemini":  Config.GEMINI_MAX_CONCURRENT_CALLS,
+            "openai":  Config.OPENAI_MAX_CONCURRENT_CALLS,
+            "ollama":  Config.OLLAMA_MAX_CONCURRENT_CALLS,
+        }
+
+        _controllers[provider] = AdmissionController(
+            name=provider,
+            max_concurrent=max_concurrent_configs.get(provider, 1),
+            max_queue_wait=Config.LLM_MAX_QUEUE_WAIT,
+        )
+
+    return _controllers[provider]
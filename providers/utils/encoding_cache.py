@@ -0,0 +1,122 @@
+import base64
+import logging
+from collections import OrderedDict
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Dict, Tuple
+
+from core.config import Config
+from core.executors import thread_executor
+
+
+@dataclass
+class EncodedFile:
+    data: bytes
+    data_url: str | None = None
+
+    @property
+    def size(self) -> int:
+        return len(self.data) + (len(self.data_url) if self.data_url else 0)
+
+
+class EncodedFileCache:
+    """LRU cache of file bytes and base64 data URLs for the vision inputs, shared by all providers.
+
+    Entries are addressed by path, modification time and size. Saved attachments are named by
+    their content hash and never change, so equal images are read and encoded only once."""
+
+    def __init__(self, max_bytes: int = Config.VISION_CACHE_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.entries: OrderedDict[Tuple[str, int, int], EncodedFile] = OrderedDict()
+        self.current_bytes = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def key(path: Path) -> Tuple[str, int, int]:
+        stat = path.stat()
+        return str(path.resolve()), stat.st_mtime_ns, stat.st_size
+
+    def get(self, path: Path) -> Tuple[Tuple[str, int, int], EncodedFile]:
+
+        key = self.key(path)
+
+        if entry := self.entries.get(key):
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return key, entry
+
+        self.misses += 1
+        entry = EncodedFile(path.read_bytes())
+        self.insert(key, entry)
+
+        return key, entry
+
+    def insert(self, key: Tuple[str, int, int], entry: EncodedFile) -> None:
+        self.entries[key] = entry
+        self.current_bytes += entry.size
+        self.evict()
+
+    @staticmethod
+    def encode(path: Path, mime_type: str | None) -> EncodedFile:
+        """Blocking, runs in the thread executor"""
+
+        data = path.read_bytes()
+        return EncodedFile(data, f"data:{mime_type};base64,{base64.b64encode(data).decode('utf-8')}" if mime_type else None)
+
+    async def preload(self, path: Path, mime_type: str | None = None) -> None:
+        """Reads (and with mime_type encodes) the file off the event loop, so formatting the history only hits the cache"""
+
+        try:
+            key = await thread_executor.run("vision_stat", self.key, path)
+            entry = self.entries.get(key)
+
+            if entry is None or (mime_type and entry.data_url is None):
+                if entry is not None:
+                    del self.entries[key]
+                    self.current_bytes -= entry.size
+                self.insert(key, await thread_executor.run("vision_read", self.encode, path, mime_type))
+
+        except FileNotFoundError:
+            return
+
+    def get_bytes(self, path: Path) -> bytes:
+        _, entry = self.get(path)
+        return entry.data
+
+    def get_data_url(self, path: Path, mime_type: str) -> str:
+
+        key, entry = self.get(path)
+
+        if entry.data_url is None:
+            entry.data_url = f"data:{mime_type};base64,{base64.b64encode(entry.data).decode('utf-8')}"
+            if key in self.entries:
+                self.current_bytes += len(entry.data_url)
+                self.evict()
+
+        return entry.data_url
+
+    def evict(self):
+
+        while self.current_bytes > self.max_bytes and len(self.entries) > 1:
+            _, entry = self.entries.popitem(last=False)
+            self.current_bytes -= entry.size
+            self.evictions += 1
+
+        logging.debug(f"ENCODED FILE CACHE: {self.stats()}")
+
+    def stats(self) -> Dict[str, int | float]:
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0,
+            "evictions": self.evictions,
+            "entries": len(self.entries),
+            "bytes": self.current_bytes,
+        }
+
+
+encoded_file_cache = EncodedFileCache()
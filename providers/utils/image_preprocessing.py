@@ -0,0 +1,198 @@
+import asyncio
+import logging
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Dict, List, Tuple
+
+from PIL import Image, ImageOps
+
+from core.chat_history import ChatHistoryMessage, ChatHistoryFileSaved
+from core.config import Config
+from core.download_sweeper import download_sweeper
+from core.executors import process_executor
+
+
+PREFERRED_FORMATS: Dict[str, Tuple[str, str]] = {
+    "image/webp": ("WEBP", ".webp"),
+    "image/jpeg": ("JPEG", ".jpg"),
+    "image/png":  ("PNG", ".png"),
+}
+"""Output formats in order of preference, the first one supported by the provider is used"""
+
+
+@dataclass(frozen=True)
+class VisionProfile:
+    max_edge: int
+    """Longest image edge in pixels, 0 disables the preprocessing"""
+    mime_types: Tuple[str, ...]
+
+
+def get_vision_profile(provider: str) -> VisionProfile:
+
+    match provider:
+        case "mistral":
+            return VisionProfile(Config.MISTRAL_VISION_MAX_EDGE, tuple(Config.MISTRAL_VISION_MODEL_TYPES))
+        case "azure":
+            return VisionProfile(Config.AZURE_OPENAI_VISION_MAX_EDGE, tuple(Config.AZURE_OPENAI_VISION_MODEL_TYPES))
+        case "gemini":
+            return VisionProfile(Config.GEMINI_VISION_MAX_EDGE, tuple(Config.GEMINI_VISION_MODEL_TYPES))
+        case "openai":
+            return VisionProfile(Config.OPENAI_VISION_MAX_EDGE, tuple(Config.OPENAI_VISION_MODEL_TYPES))
+        case "ollama":
+            return VisionProfile(Config.OLLAMA_VISION_MAX_EDGE, tuple(Config.OLLAMA_VISION_MODEL_TYPES))
+        case _:
+            return VisionProfile(0, ())
+
+
+def downscale_image(source: str, target: str, max_edge: int, image_format: str) -> bool:
+    """Runs in the process executor. Returns False if the original is already smaller than the variant"""
+
+    with Image.open(source) as image:
+
+        if getattr(image, "is_animated", False): # Would lose all frames but the first
+            return False
+
+        image = ImageOps.exif_transpose(image) # Applies the rotation before the metadata is dropped
+        image.thumbnail((max_edge, max_edge), Image.Resampling.LANCZOS)
+
+        if image_format == "JPEG" and image.mode not in ("RGB", "L"):
+            background = Image.new("RGB", image.size, (255, 255, 255))
+            background.paste(image, mask=image.convert("RGBA").getchannel("A"))
+            image = background
+        elif image.mode not in ("RGB", "RGBA", "L", "LA"):
+            image = image.convert("RGBA")
+
+        tmp_path = Path(f"{target}.tmp")
+        image.save(tmp_path, format=image_format, quality=85, optimize=True) # No exif or info is passed, so metadata is stripped
+
+    if tmp_path.stat().st_size >= Path(source).stat().st_size:
+        tmp_path.unlink(missing_ok=True)
+        return False
+
+    tmp_path.replace(target)
+    return True
+
+
+class ImagePreprocessor:
+    """Downscales and recompresses images for the vision models in a process pool.
+
+    Variants are saved next to the original as <name>.<max_edge>px<ext> and reused across
+    requests and restarts. Until a variant is ready, the original is sent."""
+
+    def __init__(self):
+        self._variants: Dict[Tuple[Path, int, str], Path | None] = {}
+        """Variant per (original, max edge, mime type), None if the original is smaller"""
+        self._tasks: Dict[Tuple[Path, int, str], asyncio.Task] = {}
+
+        self.processed = 0
+        self.failed = 0
+        self.bytes_saved = 0
+
+    @staticmethod
+    def target_format(profile: VisionProfile) -> Tuple[str, str, str] | None:
+        for mime_type, (image_format, ext) in PREFERRED_FORMATS.items():
+            if mime_type in profile.mime_types:
+                return mime_type, image_format, ext
+        return None
+
+    def key(self, file: ChatHistoryFileSaved, profile: VisionProfile) -> Tuple[Path, int, str] | None:
+
+        if not profile.max_edge or file.mime_type not in profile.mime_types:
+            return None
+
+        if not (target := self.target_format(profile)):
+            return None
+
+        return file.full_path, profile.max_edge, target[0]
+
+    def variant_path(self, key: Tuple[Path, int, str]) -> Path:
+        path, max_edge, mime_type = key
+        return path.with_name(f"{path.stem}.{max_edge}px{PREFERRED_FORMATS[mime_type][1]}")
+
+    def lookup(self, file: ChatHistoryFileSaved, profile: VisionProfile) -> Tuple[Path, str]:
+        """Path and mime type to send for the file, the original if no variant is ready"""
+
+        key = self.key(file, profile)
+
+        if key is None:
+            return file.full_path, file.mime_type
+
+        if key not in self._variants and self.variant_path(key).exists(): # Saved by a previous run
+            self._variants[key] = self.variant_path(key)
+
+        if variant := self._variants.get(key):
+            return variant, key[2]
+
+        return file.full_path, file.mime_type
+
+    async def prepare(self, history: List[ChatHistoryMessage], profile: VisionProfile) -> None:
+        """Creates the missing variants for all saved images in the history"""
+
+        tasks = []
+
+        for message in history:
+            for file in message.files:
+
+                if not isinstance(file, ChatHistoryFileSaved):
+                    continue
+
+                key = self.key(file, profile)
+
+                if key is None or key in self._variants:
+                    continue
+
+                if key not in self._tasks:
+                    self._tasks[key] = asyncio.create_task(self.process(key))
+
+                tasks.append(self._tasks[key])
+
+        if tasks:
+            await asyncio.gather(*tasks)
+
+    async def process(self, key: Tuple[Path, int, str]) -> None:
+
+        path, max_edge, mime_type = key
+        variant = self.variant_path(key)
+
+        try:
+            if variant.exists() or await process_executor.run(
+                "downscale_image", downscale_image, str(path), str(variant), max_edge, PREFERRED_FORMATS[mime_type][0]
+            ):
+                self._variants[key] = variant
+                self.bytes_saved += path.stat().st_size - variant.stat().st_size
+                logging.info(f"Prepared vision input {variant}")
+            else:
+                self._variants[key] = None
+
+            self.processed += 1
+
+        except Exception as e:
+            self.failed += 1
+            self._variants[key] = None
+            logging.exception(f"Preprocessing of '{path}' failed, sending the original: {e}")
+
+        finally:
+            self._tasks.pop(key, None)
+
+        logging.debug(f"IMAGE PREPROCESSOR: {self.stats()}")
+
+    def forget(self, paths: List[Path]) -> None:
+        """Drops the variants of deleted originals and the deleted variants"""
+
+        deleted = set(paths)
+
+        for key, variant in list(self._variants.items()):
+            if key[0] in deleted or variant in deleted:
+                del self._variants[key]
+
+    def stats(self) -> Dict[str, int | float]:
+        return {
+            "processed": self.processed,
+            "failed": self.failed,
+            "variants": len(self._variants),
+            "bytes_saved": self.bytes_saved,
+        }
+
+
+image_preprocessor = ImagePreprocessor()
+download_sweeper.on_delete.append(image_preprocessor.forget)
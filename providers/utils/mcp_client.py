@@ -4,169 +4,229 @@ import logging
 import re
 from typing import List
 
-from fastmcp import Client
+from mcp import Tool
 from mcp.types import CallToolResult
 
-from core.chat_history import ChatHistoryController
+from core.chat_history import ChatHistoryController, ChatHistoryMessage
 from core.config import Config
 from core.discord_messages import DiscordMessage, DiscordMessageReplyTmp, \
     DiscordMessageRemoveTmp, DiscordMessageReply, DiscordMessageReplyTmpError
 from providers.base import BaseLLM, LLMToolCall
+from providers.utils.admission import AdmissionSlot
 from providers.utils.error_reasoning import error_reasoning
+from providers.utils.mcp_client_integrations.base import MCPIntegration
+from providers.utils.mcp_session_pool import mcp_session_pool
 from providers.utils.response_filtering import filter_response
-from providers.utils.tool_calls import mcp_to_dict_tools, get_custom_tools_system_prompt, get_tools_system_prompt
+from providers.utils.streaming import stream_response
+from providers.utils.tool_calls import get_compiled_tools, is_serial_tool, get_tool_cache_ttl
+from providers.utils.tool_result_cache import tool_result_cache
 
 
-async def generate_with_mcp(llm: BaseLLM, chat: ChatHistoryController, queue: asyncio.Queue[DiscordMessage | None], use_help_bot: bool = False):
+async def generate_with_mcp(llm: BaseLLM, chat: ChatHistoryController, queue: asyncio.Queue[DiscordMessage | None], use_help_bot: bool = False, slot: AdmissionSlot | None = None):
 
     if not Config.MCP_SERVER_URL:
         raise Exception("Kein MCP Server URL verfügbar")
 
     integration = llm.mcp_client_integration_module(llm, queue)
-    client = Client(Config.MCP_SERVER_URL, log_handler=integration.log_handler, progress_handler=integration.progress_handler)
 
-    async with client:
+    mcp_tools = await mcp_session_pool.list_tools()
 
-        mcp_tools = await client.list_tools()
+    mcp_tools = integration.filter_tool_list(mcp_tools)
+    mcp_dict_tools, tools_prompt = get_compiled_tools(mcp_tools, mcp_session_pool.tools_version)
 
-        mcp_tools = integration.filter_tool_list(mcp_tools)
-        mcp_dict_tools = mcp_to_dict_tools(mcp_tools)
+    logging.debug(mcp_dict_tools)
 
-        logging.info(mcp_tools)
-        logging.info(mcp_dict_tools)
+    chat.system_entry = ChatHistoryMessage.from_segments("system", [*chat.system_entry.as_segments(chat.tokenizer), tools_prompt], chat.tokenizer) # Tools stay in the stable prefix
 
-        if not Config.TOOL_INTEGRATION:
-            chat.system_entry.content += get_custom_tools_system_prompt(mcp_tools)
-        else:
-            chat.system_entry.content += get_tools_system_prompt()
+    logging.info(f"SYSTEM PROMPT TOKEN COUNT WITH FUNCTION INSTRUCTIONS: {chat.count_tokens([chat.system_entry])}")
+
+    tool_call_errors = False
 
-        logging.info(f"SYSTEM PROMPT TOKEN COUNT WITH FUNCTION INSTRUCTIONS: {chat.count_tokens([chat.system_entry])}")
 
-        tool_call_errors = False
+    for i in range(Config.MAX_TOOL_CALLS):
 
+        logging.info(f"Tool Call Errors: {tool_call_errors}")
 
-        for i in range(Config.MAX_TOOL_CALLS):
+        deny_tools = Config.DENY_RECURSIVE_TOOL_CALLING and not tool_call_errors and i > 0
 
-            logging.info(f"Tool Call Errors: {tool_call_errors}")
+        use_integrated_tools = Config.TOOL_INTEGRATION and not deny_tools
 
-            deny_tools = Config.DENY_RECURSIVE_TOOL_CALLING and not tool_call_errors and i > 0
+        logging.info(f"Use integrated tools: {use_integrated_tools}")
 
-            use_integrated_tools = Config.TOOL_INTEGRATION and not deny_tools
+        if slot:
+            await slot.resume()
 
-            logging.info(f"Use integrated tools: {use_integrated_tools}")
+        chat.trim_to_budget() # Tool results may have grown the history
+        await llm.prepare_vision_inputs(chat) # Generated images
 
-            response = await llm.generate(chat, tools= mcp_to_dict_tools(mcp_tools) if use_integrated_tools else None)
+        if Config.STREAMING:
+            response = await stream_response(llm, chat, queue, tools=mcp_dict_tools if use_integrated_tools else None)
+        else:
+            response = await llm.generate(chat, tools=mcp_dict_tools if use_integrated_tools else None)
 
-            logging.info(f"RESPONSE: {response}")
+        logging.info(f"RESPONSE: {response}")
 
 
-            if response.text:
+        if response.text:
 
-                filtered_text = filter_response(response.text, Config.OLLAMA_MODEL)
+            filtered_text = filter_response(response.text, Config.OLLAMA_MODEL)
 
-                llm.add_assistant_message(chat, filtered_text)
+            llm.add_assistant_message(chat, filtered_text)
+            if not Config.STREAMING: # Already sent while streaming
                 await queue.put(DiscordMessageReply(value=filtered_text))
 
-            if deny_tools:
-                break
+        if deny_tools:
+            break
+
+
+        try:
+            if Config.TOOL_INTEGRATION and response.tool_calls:
+                tool_calls = response.tool_calls
+            else:
+                tool_calls = extract_custom_tool_calls(llm, response.text)
+
+            tool_call_errors = False
 
+        except Exception as e:
+
+            logging.exception(e, exc_info=True)
+
+            if Config.MCP_ERROR_HELP_DISCORD_ID and use_help_bot:
+                await queue.put(DiscordMessageReplyTmpError(
+                    value=f"<@{Config.MCP_ERROR_HELP_DISCORD_ID}> {e}",
+                    embed=False
+                ))
+                break
 
             try:
-                if Config.TOOL_INTEGRATION and response.tool_calls:
-                    tool_calls = response.tool_calls
-                else:
-                    tool_calls = extract_custom_tool_calls(llm, response.text)
+                await queue.put(DiscordMessageReplyTmp(
+                    key="reasoning",
+                    value="Analyzing Error..."
+                ))
+                reasoning = await error_reasoning(str(e), llm, chat)
 
-                tool_call_errors = False
+            except Exception as f:
+                logging.error(f, exc_info=True)
+                reasoning = str(e)
 
-            except Exception as e:
+            finally:
+                await queue.put(DiscordMessageRemoveTmp(key="reasoning"))
 
-                logging.exception(e, exc_info=True)
+            llm.add_error_message(chat, reasoning)
+            tool_call_errors = True
 
-                if Config.MCP_ERROR_HELP_DISCORD_ID and use_help_bot:
-                    await queue.put(DiscordMessageReplyTmpError(
-                        value=f"<@{Config.MCP_ERROR_HELP_DISCORD_ID}> {e}",
-                        embed=False
-                    ))
-                    break
+            continue
 
-                try:
-                    await queue.put(DiscordMessageReplyTmp(
-                        key="reasoning",
-                        value="Analyzing Error..."
-                    ))
-                    reasoning = await error_reasoning(str(e), llm, chat)
 
-                except Exception as f:
-                    logging.error(f, exc_info=True)
-                    reasoning = str(e)
+        if tool_calls:
+
+            run_again = False
+
+            if slot:
+                slot.pause() # The LLM slot is free while tools run
+
+            results = await execute_tool_calls(queue, integration, tool_calls, mcp_tools)
 
-                finally:
-                    await queue.put(DiscordMessageRemoveTmp(key="reasoning"))
+            for tool_call, result in zip(tool_calls, results):
 
-                llm.add_error_message(chat, reasoning)
-                tool_call_errors = True
+                logging.info(f"TOOL CALL: {tool_call}")
+                llm.add_tool_call_message(chat, [tool_call])
 
-                continue
+                try:
 
+                    if isinstance(result, Exception):
+                        raise result
 
-            if tool_calls:
+                    if not result.content:
+                        logging.warning("Empty Tool Result Content, asserting manual break")
+                        continue
 
-                run_again = False
+                    run_again = await integration.process_tool_result(tool_call, result, chat) or run_again
 
-                for tool_call in tool_calls:
+                except Exception as e:
+                    logging.exception(e, exc_info=True)
 
-                    logging.info(f"TOOL CALL: {tool_call}")
-                    llm.add_tool_call_message(chat, [tool_call])
+                    if Config.MCP_ERROR_HELP_DISCORD_ID and use_help_bot:
+                        await queue.put(DiscordMessageReplyTmpError(
+                            value=f"<@{Config.MCP_ERROR_HELP_DISCORD_ID}> {e}",
+                            embed=False
+                        ))
+                        break
 
                     try:
+                        await queue.put(DiscordMessageReplyTmp(key="reasoning", value="Analyzing Error..."))
+                        if slot:
+                            await slot.resume() # The reasoning is an LLM request, paused while the tools ran
+                        reasoning = await error_reasoning(str(e), llm, chat)
 
-                        result = await handle_tool_call(queue, client, tool_call)
+                    except Exception as f:
+                        logging.error(f, exc_info=True)
+                        reasoning = str(e)
 
-                        if not result.content:
-                            logging.warning("Empty Tool Result Content, asserting manual break")
-                            continue
+                    finally:
+                        await queue.put(DiscordMessageRemoveTmp(key="reasoning"))
 
-                        run_again = await integration.process_tool_result(tool_call, result, chat) or run_again
+                    llm.add_tool_call_results_message(chat, [(tool_call, reasoning)])
 
-                    except Exception as e:
-                        logging.exception(e, exc_info=True)
+                    tool_call_errors = True
+                    run_again = True
 
-                        if Config.MCP_ERROR_HELP_DISCORD_ID and use_help_bot:
-                            await queue.put(DiscordMessageReplyTmpError(
-                                value=f"<@{Config.MCP_ERROR_HELP_DISCORD_ID}> {e}",
-                                embed=False
-                            ))
-                            break
 
-                        try:
-                            await queue.put(DiscordMessageReplyTmp(key="reasoning", value="Analyzing Error..."))
-                            reasoning = await error_reasoning(str(e), llm, chat)
+            logging.info(chat.history)
 
-                        except Exception as f:
-                            logging.error(f, exc_info=True)
-                            reasoning = str(e)
+            if not run_again:
+                logging.info("The LLM is not instructed to run again on tool results")
+                break
 
-                        finally:
-                            await queue.put(DiscordMessageRemoveTmp(key="reasoning"))
+        else:
+            break
 
-                        llm.add_tool_call_results_message(chat, [(tool_call, reasoning)])
 
-                        tool_call_errors = True
-                        run_again = True
+async def execute_tool_calls(queue: asyncio.Queue[DiscordMessage | None], integration: MCPIntegration, tool_calls: List[LLMToolCall], mcp_tools: List[Tool]) -> List[CallToolResult | Exception]:
+    """Runs the tool calls of one turn concurrently, up to MCP_MAX_PARALLEL_TOOL_CALLS at once.
 
+    Serial tools run alone after the calls before them finished. The results keep the order of the calls."""
 
-                logging.info(chat.history)
+    serial_tools = {tool.name for tool in mcp_tools if is_serial_tool(tool)}
+    cache_ttls = {tool.name: ttl for tool in mcp_tools if (ttl := get_tool_cache_ttl(tool))}
+    semaphore = asyncio.Semaphore(Config.MCP_MAX_PARALLEL_TOOL_CALLS)
 
-                if not run_again:
-                    logging.info("The LLM is not instructed to run again on tool results")
-                    break
+    async def run(tool_call: LLMToolCall) -> CallToolResult | Exception:
 
-            else:
-                break
+        ttl = cache_ttls.get(tool_call.name)
+
+        if ttl and (result := tool_result_cache.get(tool_call.name, tool_call.arguments)):
+            return result
+
+        async with semaphore:
+            try:
+                result = await handle_tool_call(queue, integration, tool_call)
+            except Exception as e:
+                return e
+
+        if ttl:
+            tool_result_cache.put(tool_call.name, tool_call.arguments, result, ttl)
+
+        return result
+
+    results: List[CallToolResult | Exception] = []
+    batch: List[LLMToolCall] = []
+
+    for tool_call in tool_calls:
+
+        if tool_call.name in serial_tools:
+            results.extend(await asyncio.gather(*(run(call) for call in batch)))
+            results.append(await run(tool_call))
+            batch = []
+        else:
+            batch.append(tool_call)
+
+    results.extend(await asyncio.gather(*(run(call) for call in batch)))
+
+    return results
 
 
-async def handle_tool_call(queue: asyncio.Queue[DiscordMessage | None], client: Client, tool_call: LLMToolCall) -> CallToolResult:
+async def handle_tool_call(queue: asyncio.Queue[DiscordMessage | None], integration: MCPIntegration, tool_call: LLMToolCall) -> CallToolResult:
 
     message = f"Das Tool **{tool_call.name}** wird aufgerufen"
     formatted_args = "\n".join(f" - **{k}:** {v}" for k, v in tool_call.arguments.items())
@@ -174,7 +234,7 @@ async def handle_tool_call(queue: asyncio.Queue[DiscordMessage | None], client:
         message += f":\n{formatted_args}"
     await queue.put(DiscordMessageReplyTmp(key=tool_call.id, value=message))
 
-    result = await client.call_tool(tool_call.name, tool_call.arguments)
+    result = await mcp_session_pool.call_tool(tool_call.name, tool_call.arguments, integration)
 
     logging.info(f"Tool Call Result bekommen für {tool_call}")
 
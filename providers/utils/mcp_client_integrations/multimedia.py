@@ -2,7 +2,6 @@ import base64
 import logging
 import mimetypes
 import secrets
-from pathlib import Path
 from typing import List
 
 from fastmcp.client.logging import LogMessage
@@ -79,14 +78,13 @@ class MultimediaMCPIntegration(MCPIntegration):
 
             if result.content[0].type == "image":
 
-                with open(Path("downloads") / filename, "wb") as f:
-                    f.write(file_content)
+                Config.DOWNLOAD_FOLDER.mkdir(parents=True, exist_ok=True)
+                saved_file = ChatHistoryFileSaved(name=filename, mime_type=mime_type, full_path=Config.DOWNLOAD_FOLDER / filename)
+                await saved_file.save(file_content)
 
                 await self.queue.put(DiscordMessageFile(value=file_content, filename=filename))
                 chat.history.append(
-                    ChatHistoryMessage(role="assistant", files=[
-                        ChatHistoryFileSaved(name=filename, mime_type=mime_type, full_path=Path(Config.DOWNLOAD_FOLDER) / filename)
-                    ])
+                    ChatHistoryMessage(role="assistant", files=[saved_file])
                 )
 
             else:
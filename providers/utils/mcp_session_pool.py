@@ -0,0 +1,205 @@
+import asyncio
+import logging
+from contextlib import asynccontextmanager
+from typing import Dict, List, TYPE_CHECKING, Any
+
+from fastmcp import Client
+from fastmcp.client.logging import LogMessage
+from fastmcp.client.messages import MessageHandler
+from fastmcp.exceptions import ToolError
+from mcp import McpError, Tool
+from mcp.types import CallToolResult, ToolListChangedNotification
+
+from core.config import Config
+
+if TYPE_CHECKING:
+    from providers.utils.mcp_client_integrations.base import MCPIntegration
+
+
+class MCPNotificationHandler(MessageHandler):
+
+    def __init__(self, pool: "MCPSessionPool"):
+        self.pool = pool
+
+    async def on_tool_list_changed(self, notification: ToolListChangedNotification) -> None:
+        logging.info("MCP: Tool list changed")
+        self.pool.invalidate_tools()
+
+
+class PooledMCPSession:
+    """Long-lived MCP client, its log and progress notifications go to the integration that leased it"""
+
+    def __init__(self, pool: "MCPSessionPool"):
+        self.pool = pool
+        self.client: Client | None = None
+        self.integration: "MCPIntegration | None" = None
+        self._connect_lock = asyncio.Lock()
+        self._was_connected = False
+
+    async def log_handler(self, message: LogMessage):
+        if self.integration:
+            await self.integration.log_handler(message)
+        else:
+            logging.info(f"MCP LOG: {message.data}")
+
+    async def progress_handler(self, progress: float, total: float | None, message: str | None):
+        if self.integration:
+            await self.integration.progress_handler(progress, total, message)
+
+    async def connect(self) -> Client:
+
+        async with self._connect_lock:
+
+            if self.client and self.client.is_connected():
+                return self.client
+
+            if self.client: # Connection was lost
+                await self.reset()
+
+            client = Client(self.pool.url, log_handler=self.log_handler, progress_handler=self.progress_handler, message_handler=self.pool.notification_handler)
+            await client.__aenter__()
+            self.client = client
+            self.pool.connects += 1
+            logging.info(f"MCP: Connected to {self.pool.url}")
+
+            if self._was_connected: # The server may have restarted with other tools
+                self.pool.reconnects += 1
+                self.pool.invalidate_tools()
+            self._was_connected = True
+
+            return self.client
+
+    async def reset(self) -> None:
+
+        client, self.client = self.client, None
+
+        if client:
+            try:
+                await client.__aexit__(None, None, None)
+            except Exception as e:
+                logging.warning(f"MCP: Closing a broken session failed: {e}")
+
+
+class MCPSessionPool:
+    """Pool of persistent MCP sessions with a cached tool list.
+
+    A request leases a session for each tool call, so the notifications of that call reach
+    the integration of the request. Calls without an integration (e.g. bot actions) share an
+    extra session that is never leased, so they are not queued behind long running tools and
+    their errors do not reset a leased session. Every reconnect invalidates the tool list."""
+
+    def __init__(self, url: str | None = Config.MCP_SERVER_URL, size: int = Config.MCP_SESSION_POOL_SIZE):
+        self.url = url
+        self.notification_handler = MCPNotificationHandler(self)
+        leasable = [PooledMCPSession(self) for _ in range(max(size, 1))]
+        self.shared_session = PooledMCPSession(self)
+        """Used by calls without an integration"""
+        self.sessions = [*leasable, self.shared_session]
+        self._idle: asyncio.Queue[PooledMCPSession] = asyncio.Queue()
+        for session in leasable:
+            self._idle.put_nowait(session)
+
+        self._tools: List[Tool] | None = None
+        self._tools_lock = asyncio.Lock()
+        self.tools_version = 0
+        """Incremented with each fetched and each invalidated tool list"""
+        self._invalidations = 0
+
+        self.connects = 0
+        self.reconnects = 0
+        self.leases = 0
+        self.tool_list_hits = 0
+        self.tool_list_misses = 0
+
+    async def start(self) -> None:
+        """Connects all sessions and fetches the tool list, failures are retried on use"""
+
+        try:
+            await asyncio.gather(*(session.connect() for session in self.sessions))
+            await self.list_tools()
+            logging.info(f"MCP SESSION POOL: Started {self.stats()}")
+        except Exception as e:
+            logging.exception(f"MCP SESSION POOL: Start failed, connecting on first use: {e}")
+
+    async def close(self) -> None:
+        await asyncio.gather(*(session.reset() for session in self.sessions))
+
+    @asynccontextmanager
+    async def session(self, integration: "MCPIntegration | None" = None):
+
+        if integration is None:
+            session = self.shared_session
+        else:
+            session = await self._idle.get()
+            session.integration = integration
+            self.leases += 1
+
+        try:
+            yield await session.connect()
+        except (ToolError, McpError):
+            raise # Errors of the server, the session is fine
+        except Exception:
+            await session.reset() # Reconnects on the next use
+            raise
+        finally:
+            if integration is not None:
+                session.integration = None
+                self._idle.put_nowait(session)
+
+    async def list_tools(self) -> List[Tool]:
+
+        if self._tools is not None:
+            self.tool_list_hits += 1
+            return self._tools
+
+        async with self._tools_lock:
+
+            if self._tools is None:
+                self.tool_list_misses += 1
+                invalidations = self._invalidations
+
+                try:
+                    async with self.session() as client:
+                        tools = await client.list_tools()
+                except (ToolError, McpError):
+                    raise
+                except Exception as e: # Retry once on a fresh connection
+                    logging.warning(f"MCP: Listing tools failed, reconnecting: {e}")
+                    async with self.session() as client:
+                        tools = await client.list_tools()
+
+                self.tools_version += 1
+                logging.info(f"MCP: Fetched {len(tools)} tools (version {self.tools_version})")
+
+                if invalidations != self._invalidations: # Changed again while listing
+                    return tools
+
+                self._tools = tools
+
+            return self._tools
+
+    def invalidate_tools(self) -> None:
+        self._tools = None
+        self._invalidations += 1
+        self.tools_version += 1 # The compiled tools prompt is stale as well
+
+    async def call_tool(self, name: str, arguments: Dict[str, Any], integration: "MCPIntegration | None" = None) -> CallToolResult:
+
+        async with self.session(integration) as client:
+            return await client.call_tool(name, arguments)
+
+    def stats(self) -> Dict[str, int | float]:
+        return {
+            "sessions": len(self.sessions),
+            "idle": self._idle.qsize(),
+            "connected": sum(1 for session in self.sessions if session.client and session.client.is_connected()),
+            "connects": self.connects,
+            "reconnects": self.reconnects,
+            "leases": self.leases,
+            "tool_list_hits": self.tool_list_hits,
+            "tool_list_misses": self.tool_list_misses,
+            "tools_version": self.tools_version,
+        }
+
+
+mcp_session_pool = MCPSessionPool()
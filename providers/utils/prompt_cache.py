@@ -0,0 +1,57 @@
+import hashlib
+import logging
+from dataclasses import dataclass
+from typing import Dict
+
+from core.chat_history import ChatHistoryController
+from core.config import Config
+
+
+@dataclass
+class PromptCacheMetrics:
+    """Prompt tokens served from the prefix cache of the provider, as reported in the usage fields"""
+
+    requests: int = 0
+    prompt_tokens: int = 0
+    cached_tokens: int = 0
+
+    def record(self, prompt_tokens: int | None, cached_tokens: int | None) -> None:
+
+        if not prompt_tokens:
+            return
+
+        self.requests += 1
+        self.prompt_tokens += prompt_tokens
+        self.cached_tokens += cached_tokens or 0
+
+        logging.info(f"PROMPT CACHE: {cached_tokens or 0}/{prompt_tokens} tokens cached, {self.stats()}")
+
+    def stats(self) -> Dict[str, int | float]:
+        return {
+            "requests": self.requests,
+            "prompt_tokens": self.prompt_tokens,
+            "cached_tokens": self.cached_tokens,
+            "hit_rate": round(self.cached_tokens / self.prompt_tokens, 3) if self.prompt_tokens else 0,
+        }
+
+
+prompt_cache_metrics = PromptCacheMetrics()
+
+
+def get_prompt_cache_key(chat: ChatHistoryController) -> str | None:
+    """Equal for all requests with the same stable prompt prefix, routes them to the same provider cache"""
+
+    if not chat.system_entry:
+        return None
+
+    digest = hashlib.sha256(chat.system_entry.stable_prefix().encode("utf-8")).hexdigest()
+
+    return f"{Config.NAME}-{digest[:16]}"
+
+
+def record_openai_usage(usage) -> None:
+    """Records the usage of the OpenAI compatible chat completions API (OpenAI, Azure)"""
+
+    if usage:
+        details = getattr(usage, "prompt_tokens_details", None)
+        prompt_cache_metrics.record(usage.prompt_tokens, getattr(details, "cached_tokens", None))
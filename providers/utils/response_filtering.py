@@ -1,9 +1,9 @@
 import logging
 
 
-def filter_response(response: str, model: str) -> str:
+def filter_response(response: str, model: str | None) -> str:
 
-    if model.startswith("gemma3"):
+    if model and model.startswith("gemma3"):
         return response.replace("<start_of_image>", "")
 
     logging.debug(f"Kein Filter für {model} gefunden")
@@ -0,0 +1,92 @@
+import asyncio
+import itertools
+import logging
+import time
+from dataclasses import dataclass
+from typing import List, Dict
+
+from core.chat_history import ChatHistoryController, LLMResponse, LLMToolCall
+from core.config import Config
+from core.discord_messages import DiscordMessage, DiscordMessageStream
+from providers.base import BaseLLM
+from providers.utils.response_filtering import filter_response
+
+
+@dataclass
+class TimeToFirstTokenMetrics:
+    count: int = 0
+    last: float = 0
+    avg: float = 0
+    max: float = 0
+
+    def record(self, seconds: float) -> None:
+        self.count += 1
+        self.last = seconds
+        self.avg += (seconds - self.avg) / self.count
+        self.max = max(self.max, seconds)
+
+    def stats(self) -> Dict[str, int | float]:
+        return {"count": self.count, "last": round(self.last, 3), "avg": round(self.avg, 3), "max": round(self.max, 3)}
+
+
+ttft_metrics = TimeToFirstTokenMetrics()
+
+_stream_ids = itertools.count()
+
+MAX_OPEN_TAG = 64
+"""Characters after an unclosed '<' that are held back, they may still become a filtered tag"""
+
+
+def stable_length(text: str) -> int:
+    """Length of the filtered text that later chunks can no longer change"""
+
+    start = text.rfind("<", max(len(text) - MAX_OPEN_TAG, 0))
+    return start if start != -1 and ">" not in text[start:] else len(text)
+
+
+async def stream_response(llm: BaseLLM, chat: ChatHistoryController, queue: asyncio.Queue[DiscordMessage | None], tools: List[Dict] | None = None) -> LLMResponse:
+    """Streams the text deltas of generate_stream to the queue and returns the complete response"""
+
+    key = f"{id(chat)}-{next(_stream_ids)}"
+    start = time.monotonic()
+    first_token = True
+
+    raw_text = ""
+    text = ""
+    """Filtered text sent so far"""
+    tool_calls: List[LLMToolCall] = []
+
+    try:
+        async for chunk in llm.generate_stream(chat, tools=tools):
+
+            tool_calls.extend(chunk.tool_calls)
+
+            if not chunk.text:
+                continue
+
+            if first_token:
+                first_token = False
+                ttft_metrics.record(time.monotonic() - start)
+                logging.info(f"TIME TO FIRST TOKEN: {ttft_metrics.stats()}")
+
+            raw_text += chunk.text
+            filtered = filter_response(raw_text, Config.OLLAMA_MODEL) # Patterns may be split across chunks
+            filtered = filtered[:stable_length(filtered)]
+
+            if len(filtered) > len(text) and filtered.startswith(text):
+                await queue.put(DiscordMessageStream(value=filtered[len(text):], key=key))
+                text = filtered
+
+        filtered = filter_response(raw_text, Config.OLLAMA_MODEL)
+
+        if filtered.startswith(text) and len(filtered) > len(text):
+            await queue.put(DiscordMessageStream(value=filtered[len(text):], key=key))
+        elif not filtered.startswith(text):
+            logging.warning(f"STREAMING: The filtered reply changed after it was sent: {filtered}")
+
+        text = filtered
+
+    finally:
+        await queue.put(DiscordMessageStream(value="", key=key, done=True))
+
+    return LLMResponse(text, tool_calls)
@@ -1,9 +1,11 @@
 import json
-from typing import List, Dict
+import logging
+from typing import List, Dict, Tuple
 
 from fastmcp.tools import Tool
 from toon_format import encode
 
+from core.chat_history import PromptSegment
 from core.config import Config
 
 
@@ -24,6 +26,51 @@ def mcp_to_dict_tools(mcp_tools: List[Tool]) -> List[Dict[str, str|Dict]]:
     return dict_tools
 
 
+_compiled_tools: Dict[Tuple, Tuple[List[Dict[str, str|Dict]], PromptSegment]] = {}
+
+
+def get_compiled_tools(mcp_tools: List[Tool], tools_version: int) -> Tuple[List[Dict[str, str|Dict]], PromptSegment]:
+    """Tool schemas and the tools system prompt with its token count, compiled once per tool list version and language"""
+
+    key = (tools_version, Config.LANGUAGE, Config.TOOL_INTEGRATION, tuple(tool.name for tool in mcp_tools))
+
+    if key not in _compiled_tools:
+
+        if any(cached_key[0] != tools_version for cached_key in _compiled_tools): # Tool list changed
+            _compiled_tools.clear()
+
+        dict_tools = mcp_to_dict_tools(mcp_tools)
+        prompt = get_custom_tools_system_prompt(mcp_tools) if not Config.TOOL_INTEGRATION else get_tools_system_prompt()
+
+        _compiled_tools[key] = (dict_tools, PromptSegment.compile(prompt))
+
+        logging.info(f"Compiled tools prompt for tool list version {tools_version}: {_compiled_tools[key][1].token_count} tokens")
+
+    return _compiled_tools[key]
+
+
+def is_serial_tool(tool: Tool) -> bool:
+    """Tools with "serial": true in their meta or the fastmcp tag "serial" must not run concurrently with other tools"""
+
+    meta = getattr(tool, "meta", None) or {}
+
+    return meta.get("serial") is True or "serial" in meta.get("_fastmcp", {}).get("tags", [])
+
+
+def get_tool_cache_ttl(tool: Tool) -> float | None:
+    """Seconds the results of an idempotent tool may be reused, set by "cache_ttl" in its meta or the fastmcp tag "cacheable" """
+
+    meta = getattr(tool, "meta", None) or {}
+
+    if isinstance(ttl := meta.get("cache_ttl"), (int, float)) and not isinstance(ttl, bool):
+        return ttl if ttl > 0 else None
+
+    if "cacheable" in meta.get("_fastmcp", {}).get("tags", []):
+        return Config.MCP_TOOL_CACHE_TTL
+
+    return None
+
+
 def get_custom_tools_system_prompt(mcp_tools: List[Tool]) -> str:
 
     dict_tools = mcp_to_dict_tools(mcp_tools)
@@ -0,0 +1,73 @@
+import json
+import logging
+import time
+from collections import OrderedDict
+from typing import Dict, Tuple, Any
+
+from mcp.types import CallToolResult
+
+from core.config import Config
+
+
+class ToolResultCache:
+    """LRU cache with a TTL per entry for the results of idempotent MCP tools, shared by all channels"""
+
+    def __init__(self, max_entries: int = Config.MCP_TOOL_CACHE_SIZE):
+        self.max_entries = max_entries
+        self.entries: OrderedDict[Tuple[str, str], Tuple[float, CallToolResult]] = OrderedDict()
+
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+        self.evictions = 0
+
+    @staticmethod
+    def key(name: str, arguments: Dict[str, Any]) -> Tuple[str, str]:
+        return name, json.dumps(arguments, sort_keys=True, separators=(",", ":"), ensure_ascii=False, default=str)
+
+    def get(self, name: str, arguments: Dict[str, Any]) -> CallToolResult | None:
+
+        key = self.key(name, arguments)
+        entry = self.entries.get(key)
+
+        if entry and entry[0] < time.monotonic():
+            del self.entries[key]
+            self.expired += 1
+            entry = None
+
+        if not entry:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        self.entries.move_to_end(key)
+        logging.info(f"TOOL RESULT CACHE HIT: {name} {self.stats()}")
+
+        return entry[1]
+
+    def put(self, name: str, arguments: Dict[str, Any], result: CallToolResult, ttl: float) -> None:
+
+        if result.isError:
+            return
+
+        key = self.key(name, arguments)
+        self.entries[key] = (time.monotonic() + ttl, result)
+        self.entries.move_to_end(key)
+
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    def stats(self) -> Dict[str, int | float]:
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0,
+            "expired": self.expired,
+            "evictions": self.evictions,
+            "entries": len(self.entries),
+        }
+
+
+tool_result_cache = ToolResultCache()
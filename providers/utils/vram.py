@@ -1,32 +1,224 @@
 import asyncio
 import logging
 import time
+from collections import deque
+from contextlib import asynccontextmanager
+from dataclasses import dataclass, field
+from typing import Deque, Dict, List, Protocol
 
-import pynvml
+from core.executors import thread_executor
 
-def check_free_vram(required_gb:float=8):
-    pynvml.nvmlInit()
-    handle = pynvml.nvmlDeviceGetHandleByIndex(0)  # Nur GPU 0
-    info = pynvml.nvmlDeviceGetMemoryInfo(handle)
-    free_gb = info.free / 1024**3
-    if free_gb < required_gb:
-        logging.warning(f"NOT Enough VRAM: {free_gb:.2f} GB free, {required_gb} GB required")
-        raise RuntimeError(f"Not enough VRAM: {free_gb:.2f} GB free, {required_gb} GB required")
-    logging.info(f"Enough VRAM: {free_gb:.2f} GB free, {required_gb} GB required")
+GB = 1024**3
 
-async def wait_for_vram(required_gb:float=8, timeout:float=20, interval:float=1):
 
-    logging.info("Waiting for VRAM")
+class VRAMSource(Protocol):
 
-    start = time.time()
+    def free_bytes(self) -> int:
+        """Blocking, called in a worker thread"""
+        ...
+
+
+class NVMLSource:
+    """Free memory of one GPU, NVML is initialized once on the first sample"""
+
+    def __init__(self, index: int = 0):
+        self.index = index
+        self._handle = None
+
+    def free_bytes(self) -> int:
+
+        import pynvml
+
+        if self._handle is None:
+            pynvml.nvmlInit()
+            self._handle = pynvml.nvmlDeviceGetHandleByIndex(self.index)
+
+        return pynvml.nvmlDeviceGetMemoryInfo(self._handle).free
+
+
+class FakeVRAMSource:
+    """Source with settable free memory, to run the monitor without a GPU"""
+
+    def __init__(self, free_gb: float):
+        self.free = int(free_gb * GB)
+        self.samples = 0
+
+    def free_bytes(self) -> int:
+        self.samples += 1
+        return self.free
+
+
+@dataclass(eq=False)
+class VRAMReservation:
+    required: int
+    materialized: bool = False
+    """The model memory shows up in the samples, so it no longer needs to be held back"""
+
+
+@dataclass(eq=False)
+class VRAMWaiter:
+    required: int
+    future: asyncio.Future
+    queued_at: float = field(default_factory=time.monotonic)
+
+
+class VRAMMonitor:
+    """Samples the free VRAM in one background task and grants reservations in FIFO order.
+
+    A granted reservation is subtracted from the free memory until the sampled free memory has
+    dropped by the reserved amount (the model is loaded) or the request ends. Each drop is
+    attributed once, to the oldest pending reservations first, so two waiters are never let
+    through for the same memory. The task only runs while somebody waits or reserves."""
+
+    def __init__(self, source: VRAMSource | None = None, interval: float = 1):
+        self.source = source if source else NVMLSource()
+        self.interval = interval
+        self.free: int | None = None
+        self._waiters: Deque[VRAMWaiter] = deque()
+        self._reservations: List[VRAMReservation] = []
+        self._unattributed = 0
+        """Drop of the free memory while reservations were pending that no reservation accounts for yet"""
+        self._task: asyncio.Task | None = None
+
+        self.granted = 0
+        self.timeouts = 0
+        self.samples = 0
+        self.avg_wait = 0
+
+    @property
+    def reserved(self) -> int:
+        return sum(reservation.required for reservation in self._reservations if not reservation.materialized)
+
+    @asynccontextmanager
+    async def reserve(self, required_gb: float, timeout: float | None = None):
+
+        reservation = await self.acquire(int(required_gb * GB), timeout)
 
-    while True:
         try:
-            check_free_vram(required_gb=required_gb)
-            break
-        except RuntimeError as e:
-            if (time.time() - start) >= timeout:
-                logging.exception(f"Wait for vram timeout: {timeout}s, interval: {interval}")
-                raise TimeoutError(f"Timeout: {e}")
-            else:
-                await asyncio.sleep(interval)
\ No newline at end of file
+            yield reservation
+        finally:
+            self.release(reservation)
+
+    async def acquire(self, required: int, timeout: float | None = None) -> VRAMReservation:
+
+        waiter = VRAMWaiter(required, asyncio.get_running_loop().create_future())
+        self._waiters.append(waiter)
+        self.start()
+
+        if self.free is not None:
+            self.grant()
+
+        if not waiter.future.done():
+            logging.info(f"Waiting for VRAM: {required / GB:.2f} GB required, {self.stats()}")
+
+        try:
+            reservation = await asyncio.wait_for(asyncio.shield(waiter.future), timeout)
+        except asyncio.TimeoutError:
+            self.cancel(waiter)
+            self.timeouts += 1
+            free_gb = (self.free - self.reserved) / GB if self.free is not None else 0
+            logging.exception(f"Wait for vram timeout: {timeout}s, {self.stats()}")
+            raise TimeoutError(f"Timeout: Not enough VRAM: {free_gb:.2f} GB free, {required / GB:.2f} GB required")
+        except asyncio.CancelledError:
+            self.cancel(waiter)
+            raise
+
+        waited = time.monotonic() - waiter.queued_at
+        self.avg_wait = 0.9 * self.avg_wait + 0.1 * waited
+        logging.info(f"Enough VRAM: {required / GB:.2f} GB reserved after {waited:.1f}s, {self.stats()}")
+
+        return reservation
+
+    def cancel(self, waiter: VRAMWaiter) -> None:
+
+        if waiter.future.done() and not waiter.future.cancelled():
+            self.release(waiter.future.result()) # Granted in the meantime
+        else:
+            waiter.future.cancel()
+
+        if waiter in self._waiters:
+            self._waiters.remove(waiter)
+
+        self.grant() # The next waiter may fit now
+
+    def release(self, reservation: VRAMReservation) -> None:
+
+        if reservation in self._reservations:
+            self._reservations.remove(reservation)
+            self.grant()
+
+    def grant(self) -> None:
+        """Grants the waiters in FIFO order, a large waiter at the head is not overtaken"""
+
+        if self.free is None:
+            return
+
+        while self._waiters and self._waiters[0].required <= self.free - self.reserved:
+
+            waiter = self._waiters.popleft()
+
+            if waiter.future.done():
+                continue
+
+            reservation = VRAMReservation(waiter.required)
+            self._reservations.append(reservation)
+            waiter.future.set_result(reservation)
+            self.granted += 1
+
+    def start(self) -> None:
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self.run())
+
+    async def run(self) -> None:
+
+        try:
+            while self._waiters or self._reservations:
+
+                try:
+                    self.observe(await thread_executor.run("vram_sample", self.source.free_bytes))
+                    self.samples += 1
+                except Exception as e:
+                    logging.exception(f"VRAM sampling failed: {e}")
+
+                logging.debug(f"VRAM MONITOR: {self.stats()}")
+
+                await asyncio.sleep(self.interval)
+        finally:
+            self.free = None # Stale once nobody samples anymore
+            self._unattributed = 0
+            self._task = None
+
+    def observe(self, free: int) -> None:
+        """Marks the pending reservations whose memory showed up as materialized, oldest first"""
+
+        pending = [reservation for reservation in self._reservations if not reservation.materialized]
+
+        if pending and self.free is not None:
+            self._unattributed = max(self._unattributed + self.free - free, 0) # Unloaded models free memory again
+        else:
+            self._unattributed = 0
+
+        self.free = free
+
+        for reservation in pending:
+            if reservation.required > self._unattributed:
+                break
+            reservation.materialized = True
+            self._unattributed -= reservation.required
+
+        self.grant()
+
+    def stats(self) -> Dict[str, int | float]:
+        return {
+            "free_gb": round(self.free / GB, 2) if self.free is not None else -1,
+            "reserved_gb": round(self.reserved / GB, 2),
+            "waiting": len(self._waiters),
+            "reservations": len(self._reservations),
+            "granted": self.granted,
+            "timeouts": self.timeouts,
+            "samples": self.samples,
+            "avg_wait": round(self.avg_wait, 3),
+        }
+
+
+vram_monitor = VRAMMonitor()
@@ -0,0 +1,68 @@
+"""Tests of the chat history.
+
+Run from the project root with a configured .env:
+    python -m pytest tests
+"""
+from typing import List
+
+import pytest
+
+from core.chat_history import ChatHistoryController, ChatHistoryMessage
+from core.config import Config
+
+
+class WordTokenizer:
+    """One token per word, so the budgets are easy to follow"""
+
+    def encode(self, text: str) -> List[str]:
+        return text.split()
+
+    def decode(self, tokens: List[str]) -> str:
+        return " ".join(tokens)
+
+
+def discord_window(first: int, last: int) -> List[ChatHistoryMessage]:
+    """Messages first to last, rendered again from Discord for every call (equal but not identical objects)"""
+
+    return [
+        ChatHistoryMessage(role="user" if i % 2 == 0 else "assistant", content=f"message {i} " + "word " * 8)
+        for i in range(first, last + 1)
+    ]
+
+
+@pytest.fixture
+def chat(monkeypatch) -> ChatHistoryController:
+    monkeypatch.setattr(Config, "RESPONSE_TOKEN_RESERVE", 0)
+    return ChatHistoryController(max_tokens=60, tokenizer=WordTokenizer())
+
+
+def test_update_after_trim_continues_the_history(chat):
+
+    instructions = ChatHistoryMessage(role="system", content="You are a bot")
+
+    chat.update(discord_window(0, 9), instructions)
+
+    assert chat.history[0] is instructions
+    assert 1 < len(chat.history) < 11
+
+    for first in range(1, 20): # The window slides by one message per call
+
+        previous = chat.history
+        chat.update(discord_window(first, first + 9), instructions)
+
+        assert chat.count_tokens() <= 60
+        assert chat.history[-1].content.startswith(f"message {first + 9} ")
+        assert [msg.content for msg in chat.history[1:]] == [msg.content for msg in discord_window(first + 11 - len(chat.history), first + 9)]
+        assert all(any(msg is old for old in previous) for msg in chat.history[:-1]) # Continued, not reset and trimmed again
+
+
+def test_update_after_trim_resets_without_overlap(chat):
+
+    instructions = ChatHistoryMessage(role="system", content="You are a bot")
+
+    chat.update(discord_window(0, 9), instructions)
+    chat.update(discord_window(50, 59), instructions)
+
+    assert chat.history[0] is instructions
+    assert chat.history[-1].content.startswith("message 59 ")
+    assert [msg.content for msg in chat.history[1:]] == [msg.content for msg in discord_window(61 - len(chat.history), 59)]
@@ -0,0 +1,70 @@
+"""Tests of the VRAM monitor, without a GPU.
+
+Run from the project root with a configured .env:
+    python -m pytest tests
+"""
+import asyncio
+
+import pytest
+
+from providers.utils.vram import FakeVRAMSource, VRAMMonitor, GB
+
+
+async def sampled(monitor: VRAMMonitor) -> None:
+    """Waits for a few samples of the monitor"""
+    await asyncio.sleep(monitor.interval * 5)
+
+
+def test_one_drop_materializes_one_reservation():
+
+    async def scenario():
+
+        source = FakeVRAMSource(free_gb=10)
+        monitor = VRAMMonitor(source, interval=0.01)
+
+        first = await monitor.acquire(4 * GB)
+        second = await monitor.acquire(4 * GB) # Granted from the same sample
+
+        source.free = 6 * GB # Only the first model is loaded
+        await sampled(monitor)
+
+        assert first.materialized
+        assert not second.materialized
+        assert monitor.free - monitor.reserved == 2 * GB
+
+        with pytest.raises(TimeoutError):
+            await monitor.acquire(4 * GB, timeout=0.05) # The memory of the second model is still held back
+
+        source.free = 2 * GB # The second model is loaded as well
+        await sampled(monitor)
+
+        assert second.materialized
+
+        monitor.release(first)
+        monitor.release(second)
+
+    asyncio.run(scenario())
+
+
+def test_waiter_is_granted_when_memory_is_freed():
+
+    async def scenario():
+
+        source = FakeVRAMSource(free_gb=4)
+        monitor = VRAMMonitor(source, interval=0.01)
+
+        first = await monitor.acquire(3 * GB)
+        waiter = asyncio.create_task(monitor.acquire(3 * GB))
+        await sampled(monitor)
+
+        assert not waiter.done()
+
+        monitor.release(first)
+        second = await asyncio.wait_for(waiter, 1)
+
+        assert not second.materialized
+        assert monitor.granted == 2
+
+        monitor.release(second)
+
+    asyncio.run(scenario())